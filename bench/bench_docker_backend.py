@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Compare the Engine API client and the docker CLI, against a fake daemon
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname, join
+
+proj_dir = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, proj_dir)
+
+from scuba import dockerutil
+from scuba.dockerapi import APIClient
+from tests.fakedockerd import FakeDockerDaemon, make_image
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Benchmark the Docker backends')
+    ap.add_argument('-n', '--number', type=int, default=20,
+            help='Number of operations per measurement (default: %(default)s)')
+    return ap.parse_args()
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='scuba-bench') as path:
+        sock = join(path, 'docker.sock')
+        with FakeDockerDaemon(sock) as daemon:
+            daemon.images['busybox:latest'] = make_image('busybox', cmd=['sh'])
+            client = APIClient(sock)
+            run_args = ['docker', 'run', '-i', '--rm', 'busybox', 'true']
+
+            with open(os.devnull, 'r+b') as devnull:
+                results = [
+                    ('API inspect', bench(lambda: client.inspect_image('busybox'), args.number)),
+                    ('API run',     bench(lambda: client.run(run_args, devnull, devnull, devnull),
+                                          args.number)),
+                ]
+
+            if shutil.which('docker'):
+                env = dict(os.environ, DOCKER_HOST='unix://' + sock)
+                def cli_inspect():
+                    subprocess.run(['docker', 'inspect', '--type', 'image', 'busybox'],
+                            env=env, stdout=subprocess.DEVNULL, check=True)
+                results.append(('CLI inspect', bench(cli_inspect, args.number)))
+            else:
+                print('docker CLI not found; only measuring the API client')
+
+    for name, t in results:
+        print('{:12} {:8.2f} ms'.format(name + ':', t * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Measure ScubaDive.prepare, with and without fetching the image metadata in
+# the background, against a fake daemon
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname, join
+from unittest import mock
+
+proj_dir = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, proj_dir)
+
+import scuba.__main__ as main
+import scuba.imagecache
+from tests.fakedockerd import FakeDockerDaemon, make_image
+
+
+class ForegroundCall(object):
+    '''A drop-in for BackgroundCall which calls the function immediately'''
+    def __init__(self, func, *args, **kwargs):
+        self._result = self._exc = None
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception as e:
+            self._exc = e
+
+    def result(self):
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+
+def prepare():
+    # Every invocation starts without any image metadata
+    scuba.imagecache._inspected.clear()
+    dive = main.ScubaDive([])
+    try:
+        dive.prepare()
+    finally:
+        dive.cleanup_tempfiles()
+
+def bench(number):
+    return min(timeit.repeat(prepare, number=number, repeat=5)) / number
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Benchmark ScubaDive.prepare')
+    ap.add_argument('-n', '--number', type=int, default=50,
+            help='Number of operations per measurement (default: %(default)s)')
+    ap.add_argument('-d', '--delay', type=float, default=2,
+            help='Latency of the daemon per inspect, in ms (default: %(default)s)')
+    return ap.parse_args()
+
+def serve(sock, delay, ready):
+    # The daemon runs in its own process, so it doesn't compete with scuba
+    # for the GIL.
+    with FakeDockerDaemon(sock) as daemon:
+        daemon.images['busybox:latest'] = make_image('busybox', entrypoint=['/ep'], cmd=['sh'])
+        daemon.inspect_delay = delay
+        ready.set()
+        multiprocessing.Event().wait()
+
+def main_():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='scuba-bench') as path:
+        os.chdir(path)
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+            f.write('hooks:\n')
+            f.write('  root: echo root\n')
+            f.write('  user: echo user\n')
+
+        sock = join(path, 'docker.sock')
+        env = dict(SCUBA_NO_CACHE='1', SCUBA_RUNTIME_DIR=path)
+        ready = multiprocessing.Event()
+        daemon = multiprocessing.Process(target=serve, args=(sock, args.delay / 1000, ready),
+                daemon=True)
+        daemon.start()
+        ready.wait()
+
+        with mock.patch.dict('os.environ', env), \
+             mock.patch('scuba.dockerapi.DEFAULT_SOCKET', sock), \
+             mock.patch('scuba.__main__.g_verbose', False, create=True):
+            os.environ.pop('DOCKER_HOST', None)
+            os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+            with mock.patch('scuba.__main__.BackgroundCall', ForegroundCall):
+                serial = bench(args.number)
+            background = bench(args.number)
+
+        daemon.terminate()
+
+    print('Daemon latency: {:.2f} ms per inspect'.format(args.delay))
+    print('{:12} {:8.2f} ms'.format('Serial:', serial * 1000))
+    print('{:12} {:8.2f} ms'.format('Background:', background * 1000))
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Compare the pure-Python and libyaml loaders on a large .scuba.yml
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname, join
+
+proj_dir = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, proj_dir)
+
+from scuba import yamlloader
+
+
+def write_config(path, num_aliases):
+    '''Write a .scuba.yml with many aliases, some using !from_yaml'''
+    with open(join(path, 'common.yml'), 'w') as f:
+        for i in range(num_aliases):
+            f.write('job{}:\n'.format(i))
+            f.write('  image: registry.example.com/build/image{}:latest\n'.format(i % 10))
+            f.write('  script:\n')
+            f.write('    - make -j8 target{}\n'.format(i))
+            f.write('    - make check\n')
+
+    with open(join(path, '.scuba.yml'), 'w') as f:
+        f.write('image: !from_yaml common.yml job0.image\n')
+        f.write('environment:\n')
+        f.write('  FOO: foo\n')
+        f.write('aliases:\n')
+        for i in range(num_aliases):
+            if i % 2:
+                f.write('  alias{}: !from_yaml common.yml job{}\n'.format(i, i))
+            else:
+                f.write('  alias{}:\n'.format(i))
+                f.write('    image: debian:{}\n'.format(i))
+                f.write('    environment:\n')
+                f.write('      BAR: "{}"\n'.format(i))
+                f.write('    script:\n')
+                f.write('      - echo "alias {}"\n'.format(i))
+                f.write('      - make all\n')
+
+def bench(loader_cls, path, number):
+    def load():
+        with open(join(path, '.scuba.yml'), 'r') as f:
+            return yamlloader.load(f, loader_cls)
+
+    return min(timeit.repeat(load, number=number, repeat=3)) / number
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Benchmark the YAML loaders')
+    ap.add_argument('-a', '--aliases', type=int, default=2000,
+            help='Number of aliases to generate (default: %(default)s)')
+    ap.add_argument('-n', '--number', type=int, default=5,
+            help='Number of loads per measurement (default: %(default)s)')
+    return ap.parse_args()
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='scuba-bench') as path:
+        write_config(path, args.aliases)
+        size = os.path.getsize(join(path, '.scuba.yml')) + \
+               os.path.getsize(join(path, 'common.yml'))
+        print('{} aliases, {} KiB of YAML'.format(args.aliases, size // 1024))
+
+        py_time = bench(yamlloader.PyLoader, path, args.number)
+        print('PyLoader: {:8.1f} ms'.format(py_time * 1000))
+
+        if not yamlloader.CLoader:
+            print('CLoader:  unavailable (PyYAML was built without libyaml)')
+            return
+
+        c_time = bench(yamlloader.CLoader, path, args.number)
+        print('CLoader:  {:8.1f} ms  ({:.1f}x faster)'.format(
+            c_time * 1000, py_time / c_time))
+
+if __name__ == '__main__':
+    main()
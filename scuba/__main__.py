@@ -3,33 +3,37 @@
 # https://github.com/JonathonReinhart/scuba
 # PYTHON_ARGCOMPLETE_OK
 
+# NOTE: scuba is typically invoked many times per build, so its startup time
+# matters. Modules which are expensive to import, and which are not needed on
+# every code path (e.g. argcomplete, tempfile, shutil, yaml, subprocess, json)
+# are imported only where they are used, as are scuba's modules which only
+# scuba-admin uses (e.g. bundle). This is verified by test_importtime.
+
 import os.path
-from pwd import getpwuid
-from grp import getgrgid
 import sys
 import shlex
 import itertools
 import argparse
-try:
-    import argcomplete
-except ImportError:
-    class argcomplete(object):
-        @staticmethod
-        def autocomplete(_):
-            pass
-import tempfile
-import shutil
+import time
 from collections.abc import Mapping
 from io import StringIO
 
 from .constants import *
-from .config import find_config, load_config, ScubaConfig, \
-        ConfigError, ConfigNotFoundError
+from .config import find_config, locate_config, load_config, get_lock_path, \
+        ScubaConfig, ConfigError, ConfigNotFoundError
 from .utils import *
-from .version import __version__
-from .dockerutil import get_image_command, get_image_entrypoint, make_vol_opt, \
-        DockerError, DockerExecuteError
+from .version import get_version
+from .dockerutil import make_vol_opt, DockerError, DockerExecuteError
+from .imagecache import get_image_command, get_image_entrypoint
 from . import dockerutil
+from . import lockfile
+from . import plan
+from . import pool
+from . import pull
+from . import reap
+from . import trace
+from . import usage
+from . import userdb
 
 # This is the path where all scuba-related things will be bind-mounted into the
 # container.
@@ -42,34 +46,67 @@ def verbose_msg(fmt, *args):
     if g_verbose:
         appmsg(fmt, *args)
 
-def get_umask():
-    # Same logic as bash/builtins/umask.def
-    val = os.umask(0o22)
-    os.umask(val)
-    return val
-
 def writeln(f, line):
     f.write(line + '\n')
 
 
+class VersionAction(argparse.Action):
+    '''Prints the version, like argparse's 'version' action
+
+    The full version is determined only when requested, as doing so may
+    require running git (when running from a source checkout).
+    '''
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, **kw):
+        super().__init__(option_strings, dest=dest, nargs=0,
+                help="show program's version number and exit", **kw)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print('scuba ' + get_version())
+        parser.exit()
+
+
+def autocomplete(ap):
+    '''Perform command line completion, if requested by the shell
+
+    argcomplete only does anything when invoked from the shell completion hook,
+    which sets _ARGCOMPLETE; it is not imported otherwise. Completion is
+    silently unavailable if argcomplete is not installed.
+    '''
+    if '_ARGCOMPLETE' not in os.environ:
+        return
+
+    try:
+        import argcomplete
+    except ImportError:
+        return
+
+    argcomplete.autocomplete(ap, always_complete_options=False)
+
+
+@trace.traced('parse_scuba_args')
 def parse_scuba_args(argv):
 
     def _list_images_completer(**_):
-        return dockerutil.get_images()
+        from .completion import list_images
+        return list_images()
 
     def _list_aliases_completer(parsed_args, **_):
         # We don't want to try to complete any aliases if one was already given
         if parsed_args.command:
             return []
 
+        from .completion import list_aliases
         try:
-            _, _, config = find_config()
-            return sorted(config.aliases)
+            return list_aliases()
         except (ConfigNotFoundError, ConfigError):
+            import argcomplete
             argcomplete.warn('No or invalid config found.  Cannot auto-complete aliases.')
             return []
 
     ap = argparse.ArgumentParser(description='Simple Container-Utilizing Build Apparatus')
+    ap.add_argument('--async-rm', action='store_true', default='SCUBA_ASYNC_RM' in os.environ,
+            help="Don't wait for the container to be removed after it exits; "
+                 "remove it in the background (also set by SCUBA_ASYNC_RM)")
     ap.add_argument('-d', '--docker-arg', dest='docker_args', action='append',
             type=lambda x: shlex.split(x), default=[],
             help="Pass additional arguments to 'docker run'")
@@ -80,19 +117,33 @@ def parse_scuba_args(argv):
             help='Override the default ENTRYPOINT of the image')
     ap.add_argument('--image', help='Override Docker image').completer = _list_images_completer
     ap.add_argument('--shell', help='Override shell used in Docker container')
+    ap.add_argument('--exec', action='store_true', default='SCUBA_EXEC' in os.environ,
+            help="Replace scuba with the docker CLI, rather than waiting for it "
+                 "(also set by SCUBA_EXEC)")
+    ap.add_argument('--check-config', action='store_true',
+            help="Validate the entire config (including all aliases) and exit")
+    ap.add_argument('--mount-userdb', action='store_true',
+            default='SCUBA_MOUNT_USERDB' in os.environ,
+            help="Generate /etc/passwd, /etc/group, and /etc/shadow on the host, "
+                 "and bind-mount them into the container (also set by SCUBA_MOUNT_USERDB)")
     ap.add_argument('-n', '--dry-run', action='store_true',
             help="Don't actually invoke docker; just print the docker cmdline")
     ap.add_argument('-r', '--root', action='store_true',
             help="Run container as root (don't create scubauser)")
-    ap.add_argument('-v', '--version', action='version', version='scuba ' + __version__)
+    ap.add_argument('--trace', metavar='FILE',
+            help="Append a trace of this invocation (in Chrome trace format) to FILE")
+    ap.add_argument('-v', '--version', action=VersionAction)
     ap.add_argument('-V', '--verbose', action='store_true',
             help="Be verbose")
     ap.add_argument('command', nargs=argparse.REMAINDER,
             help="Command (and arguments) to run in the container").completer = _list_aliases_completer
 
-    argcomplete.autocomplete(ap, always_complete_options=False)
+    autocomplete(ap)
     args = ap.parse_args(argv)
 
+    if args.exec and args.async_rm:
+        ap.error('--exec and --async-rm cannot be combined')
+
     # Flatten docker arguments into single list
     args.docker_args = list(itertools.chain.from_iterable(args.docker_args))
 
@@ -114,8 +165,10 @@ class ScubaError(Exception):
     pass
 
 class ScubaDive(object):
+    @trace.traced('ScubaDive.__init__')
     def __init__(self, user_command, docker_args=None, env=None, as_root=False, verbose=False,
-            image_override=None, entrypoint=None, shell_override=None):
+            image_override=None, entrypoint=None, shell_override=None, async_rm=False,
+            detach=False, mount_userdb=False):
 
         env = env or {}
         if not isinstance(env, Mapping):
@@ -127,6 +180,9 @@ class ScubaDive(object):
         self.image_override = image_override
         self.entrypoint_override = entrypoint
         self.shell_override = shell_override
+        self.async_rm = async_rm
+        self.detach = detach
+        self.mount_userdb = mount_userdb
 
         # These will be added to docker run cmdline
         self.env_vars = env
@@ -134,10 +190,17 @@ class ScubaDive(object):
         self.options = docker_args or []
         self.workdir = None
 
+        # Files copied into the scubadir, by name, and their source paths
+        self.scubadir_copies = {}
+
+        # Whether the docker command line depends on metadata from the image
+        self.uses_image_metadata = False
+
         self.__locate_scubainit()
         self.__load_config()
 
 
+    @trace.traced('ScubaDive.prepare')
     def prepare(self):
         '''Prepare to run the docker command'''
         self.__make_scubadir()
@@ -188,9 +251,15 @@ class ScubaDive(object):
 
 
     def cleanup_tempfiles(self):
+        import shutil
         shutil.rmtree(self.__scubadir_hostpath)
 
 
+    @property
+    def scubadir_hostpath(self):
+        '''The host path of the scubadir (see prepare)'''
+        return self.__scubadir_hostpath
+
     @property
     def is_remote_docker(self):
         return 'DOCKER_HOST' in os.environ
@@ -257,7 +326,7 @@ class ScubaDive(object):
     def __make_scubadir(self):
         '''Make temp directory where all ancillary files are bind-mounted
         '''
-        self.__scubadir_hostpath = tempfile.mkdtemp(prefix='scubadir')
+        self.__scubadir_hostpath = make_scubadir()
         self.__scubadir_contpath = '/.scuba'
         self.add_volume(self.__scubadir_hostpath, self.__scubadir_contpath)
 
@@ -271,6 +340,12 @@ class ScubaDive(object):
         context = self.config.process_command(self.user_command,
                 image=self.image_override, shell=self.shell_override)
 
+        # The image is prepared (see __setup_image) in the background, while
+        # the local files are set up, as it may take round-trips to docker.
+        needs_cmd = not context.script
+        needs_entrypoint = self.entrypoint_override is None and context.entrypoint is None
+        image_setup = BackgroundCall(self.__setup_image, context, needs_cmd, needs_entrypoint)
+
         # Pass variables to scubainit
         self.add_env('SCUBAINIT_UMASK', '{:04o}'.format(get_umask()))
 
@@ -278,10 +353,11 @@ class ScubaDive(object):
         if not self.as_root and not context.as_root:
             uid = os.getuid()
             gid = os.getgid()
+            user, group = userdb.get_names(uid, gid)
             self.add_env('SCUBAINIT_UID', uid)
             self.add_env('SCUBAINIT_GID', gid)
-            self.add_env('SCUBAINIT_USER', getpwuid(uid).pw_name)
-            self.add_env('SCUBAINIT_GROUP', getgrgid(gid).gr_name)
+            self.add_env('SCUBAINIT_USER', user)
+            self.add_env('SCUBAINIT_GROUP', group)
 
         if self.verbose:
             self.add_env('SCUBAINIT_VERBOSE', 1)
@@ -298,7 +374,7 @@ class ScubaDive(object):
 
         # allocate TTY if scuba's output is going to a terminal
         # and stdin is not redirected
-        if sys.stdout.isatty() and sys.stdin.isatty():
+        if not self.detach and sys.stdout.isatty() and sys.stdin.isatty():
             self.add_option('--tty')
 
 
@@ -307,18 +383,30 @@ class ScubaDive(object):
         default CMD is run. Because we set the entrypiont, scuba must emulate the
         default behavior itself.
         '''
-        if not context.script:
+        # Make scubainit the real entrypoint, and use the defined entrypoint as
+        # the docker command (if it exists)
+        self.add_option('--entrypoint={}'.format(scubainit_cpath))
+
+        # If the user command is known, its script is written while waiting
+        # for the image.
+        if not needs_cmd:
+            command_cpath = self.__write_command_script(context.script)
+
+        with trace.span('wait for image'):
+            context.image, default_cmd, image_entrypoint = image_setup.result()
+
+        if self.mount_userdb and 'SCUBAINIT_UID' in self.env_vars:
+            self.__mount_userdb(context)
+
+        if needs_cmd:
             # No user-provided command; we want to run the image's default command
             verbose_msg('No user command; getting command from image')
-            default_cmd = get_image_command(context.image)
+            self.uses_image_metadata = True
             if not default_cmd:
                 raise ScubaError('No command given and no image-specified command')
             verbose_msg('{} Cmd: "{}"'.format(context.image, default_cmd))
             context.script = [shell_quote_cmd(default_cmd)]
-
-        # Make scubainit the real entrypoint, and use the defined entrypoint as
-        # the docker command (if it exists)
-        self.add_option('--entrypoint={}'.format(scubainit_cpath))
+            command_cpath = self.__write_command_script(context.script)
 
         self.docker_cmd = []
         if self.entrypoint_override is not None:
@@ -330,19 +418,85 @@ class ScubaDive(object):
             if context.entrypoint != '':
                 self.docker_cmd = [context.entrypoint]
         else:
-            ep = get_image_entrypoint(context.image)
-            if ep:
-                self.docker_cmd = ep
+            self.uses_image_metadata = True
+            if image_entrypoint:
+                self.docker_cmd = image_entrypoint
+
+        self.docker_cmd += [context.shell, command_cpath]
+
+        self.context = context
 
-        # The user command is executed via a generated shell script
+    def __mount_userdb(self, context):
+        '''Bind-mount user database files which include the scuba user and group
+
+        scubainit then leaves those files alone, so the container's root
+        filesystem can be read-only.
+        '''
+        uid = self.env_vars['SCUBAINIT_UID']
+        gid = self.env_vars['SCUBAINIT_GID']
+        user = self.env_vars['SCUBAINIT_USER']
+        home = '/home/' + user
+
+        # The generated files depend on the image's originals
+        self.uses_image_metadata = True
+        with trace.span('userdb'):
+            try:
+                files = userdb.add_user(userdb.get_image_files(context.image),
+                        uid, gid, user, self.env_vars['SCUBAINIT_GROUP'], home)
+            except userdb.UserDBError as e:
+                raise ScubaError(str(e))
+
+            for path in userdb.USERDB_FILES:
+                with self.open_scubadir_file(path.lstrip('/'), 'wb') as f:
+                    f.write(files[path].encode('utf-8', 'surrogateescape'))
+                os.chmod(f.name, userdb.USERDB_MODES[path])
+                self.add_volume(f.name, path, ['ro'])
+        self.add_env('SCUBAINIT_USERDB_MOUNTED', 1)
+
+        # With a read-only root, the home directory needs somewhere to live
+        if self.__is_read_only():
+            self.add_option('--tmpfs={}:exec,mode=0700,uid={},gid={}'.format(home, uid, gid))
+
+    def __is_read_only(self):
+        '''Determine whether the container's root filesystem is read-only'''
+        read_only = False
+        for opt in self.options:
+            try:
+                value = parse_bool_flag(opt, '--read-only')
+            except ValueError:
+                continue    # (docker reports it)
+            if value is not None:
+                read_only = value
+        return read_only
+
+    def __write_command_script(self, script):
+        '''Write the script which executes the user command
+
+        Returns: Its path in the container
+        '''
         with self.open_scubadir_file('command.sh', 'wt') as f:
-            self.docker_cmd += [context.shell, f.container_path]
             writeln(f, '# Auto-generated from scuba')
             writeln(f, 'set -e')
-            for cmd in context.script:
+            for cmd in script:
                 writeln(f, cmd)
+        return f.container_path
 
-        self.context = context
+    def __setup_image(self, context, needs_cmd, needs_entrypoint):
+        '''Apply the pull policy of the image, and get the metadata needed from it
+
+        Returns: The reference by which to run the image (see
+                 lockfile.local_ref), and the image's default command and
+                 entrypoint, or None for those not needed
+        '''
+        with trace.span('setup image', image=context.image):
+            image = lockfile.local_ref(context.image)
+
+            # The image is pulled first if its policy requires it, so the
+            # metadata is that of the image which will be run.
+            pull.ensure_image(image, context.pull_policy)
+            cmd = get_image_command(image) if needs_cmd else None
+            ep = get_image_entrypoint(image) if needs_entrypoint else None
+        return image, cmd, ep
 
 
 
@@ -368,9 +522,11 @@ class ScubaDive(object):
 
         Returns the container-path of the copied file
         '''
+        import shutil
         dest = os.path.join(self.__scubadir_hostpath, name)
         assert not os.path.exists(dest)
         shutil.copy2(source, dest)
+        self.scubadir_copies[name] = source
 
         return os.path.join(self.__scubadir_contpath, name)
 
@@ -397,12 +553,16 @@ class ScubaDive(object):
 
     def get_docker_cmdline(self):
         args = ['docker', 'run',
-            # interactive: keep STDIN open
-            '-i',
+            # run in the background, or interactive: keep STDIN open
+            '--detach' if self.detach else '-i',
+        ]
 
+        if self.async_rm:
+            # remove container in the background, once it has exited
+            args += reap.run_options(os.path.join(self.__scubadir_hostpath, reap.CIDFILE_NAME))
+        else:
             # remove container after exit
-            '--rm',
-        ]
+            args.append('--rm')
 
         for name,val in self.env_vars.items():
             args.append('--env={}={}'.format(name, val))
@@ -424,7 +584,95 @@ class ScubaDive(object):
         return args
 
 
+def _record_image(image, image_id):
+    # Record that the image is used (for `scuba-admin gc`), by its ID if it is
+    # already known (e.g. from a plan), to avoid resolving it again.
+    if image_id:
+        usage.record_use(image_id, image)
+        return True
+    return usage.record_image(image)
+
+def run_docker(run_args, image=None, cid=None, image_id=None):
+    # An image which doesn't exist yet is recorded once docker has pulled it.
+    recorded = image and _record_image(image, image_id)
+
+    # Explicitly pass sys.stdin/stdout/stderr so they apply to the
+    # child process if overridden (by tests).
+    rc = dockerutil.run(
+            run_args,
+            stdin = sys.stdin,
+            stdout = sys.stdout,
+            stderr = sys.stderr,
+            cid = cid,
+            )
+
+    if image and not recorded:
+        usage.record_image(image)
+
+    cidfile = reap.get_cidfile(run_args)
+    if cidfile:
+        reap.reap_later(cidfile)
+    return rc
+
+
+def exec_docker(run_args, image=None, trace_path=None, image_id=None):
+    '''Replace this process with `docker run` (see --exec)
+
+    As nothing is left to remove the scubadir once the container exits, it is
+    removed by a later invocation (see sweep_scubadirs).
+    '''
+    if image:
+        _record_image(image, image_id)
+    sweep_scubadirs()
+
+    # This process won't get to write its trace after running docker
+    try:
+        trace.finish(trace_path)
+    except OSError as e:
+        appmsg('Failed to write trace to {}: {}', trace_path, e.strerror)
+
+    dockerutil.exec_run(run_args)
+
+
+def run_plan(plan, run=run_docker):
+    '''Run a cached plan (see scuba.plan)'''
+    if run is run_docker and pool.get_pool_size():
+        pooled = pool.claim(plan)
+        if pool.needs_fill(plan.id):
+            pool.fill_later(plan.id)
+        if pooled:
+            try:
+                return run_docker(pooled.args, plan.image, cid=pooled.container,
+                        image_id=plan.image_id)
+            finally:
+                pooled.cleanup_tempfiles()
+
+    try:
+        return run(plan.materialize(), plan.image, image_id=plan.image_id)
+    finally:
+        plan.cleanup_tempfiles()
+
+
 def run_scuba(scuba_args):
+    run = run_docker
+    if scuba_args.exec:
+        trace_path = scuba_args.trace or os.getenv(trace.ENV_VAR)
+        run = lambda run_args, image, image_id=None: \
+                exec_docker(run_args, image, trace_path, image_id)
+
+    # Finding a matching session requires preparing the invocation, so the
+    # plan cache is not used while there are any.
+    from . import session
+    use_sessions = not scuba_args.exec and session.have_sessions()
+
+    plan_key = None
+    if plan.is_usable(scuba_args) and not use_sessions:
+        plan_key = plan.make_key(scuba_args)
+        with trace.span('Plan.load'):
+            cached_plan = plan.Plan.load(plan_key)
+        if cached_plan:
+            return run_plan(cached_plan, run)
+
     dive = ScubaDive(
         scuba_args.command,
         docker_args = scuba_args.docker_args,
@@ -434,6 +682,8 @@ def run_scuba(scuba_args):
         image_override = scuba_args.image,
         entrypoint = scuba_args.entrypoint,
         shell_override = scuba_args.shell,
+        async_rm = scuba_args.async_rm,
+        mount_userdb = scuba_args.mount_userdb,
         )
 
     try:
@@ -450,14 +700,21 @@ def run_scuba(scuba_args):
         if scuba_args.dry_run:
             sys.exit(42)
 
-        # Explicitly pass sys.stdin/stdout/stderr so they apply to the
-        # child process if overridden (by tests).
-        return dockerutil.call(
-                args = run_args,
-                stdin = sys.stdin,
-                stdout = sys.stdout,
-                stderr = sys.stderr,
-                )
+        if use_sessions:
+            active = session.find_session(dive)
+            if active:
+                verbose_msg('Running in session {}', active.id)
+                return session.exec_command(active, dive)
+
+        if plan_key:
+            plan.Plan.store(plan_key, dive, run_args)
+            if run is run_docker and pool.get_pool_size():
+                # The plan is new, so the pool is filled even if it isn't
+                # empty, to replace the containers of the previous plan.
+                pool.record_miss()
+                pool.fill_later(plan.get_plan_id(plan_key))
+
+        return run(run_args, dive.context.image)
 
     finally:
         if scuba_args.dry_run:
@@ -466,11 +723,334 @@ def run_scuba(scuba_args):
             dive.cleanup_tempfiles()
 
 
-def main(argv=None):
-    scuba_args = parse_scuba_args(argv)
+def check_config():
+    '''Validate the config, without running anything'''
+    _, _, cfg_path = locate_config()
+    load_config(cfg_path).validate()
+    appmsg('{} is valid', cfg_path)
+
+
+################################################################################
+# Subcommands
+#
+# These are run by the `scuba-admin` command (see admin_main), by their name
+# as its first argument, so they never conflict with the aliases and commands
+# run by `scuba`.
+
+def pull_main(argv):
+    ap = argparse.ArgumentParser(prog='scuba-admin pull',
+            description='Pull all images referenced by .scuba.yml which do not exist locally')
+    ap.add_argument('-j', '--jobs', type=int, default=pull.DEFAULT_JOBS,
+            help='Number of images to pull concurrently (default: %(default)s)')
+    args = ap.parse_args(argv)
+
+    _, _, cfg_path = locate_config()
+    config = load_config(cfg_path)
+    # Pinned images loaded from a bundle exist by their local tags
+    images = [lockfile.local_ref(config.pinned_image(i)) for i in pull.config_images(config)]
+    missing = pull.missing_images(images)
+    appmsg('{} of {} image(s) need to be pulled', len(missing), len(images))
+
+    errors = pull.pull_images(missing, jobs=args.jobs)
+    if errors:
+        raise ScubaError('Failed to pull {} image(s): {}'.format(
+            len(errors), ', '.join(errors)))
+
+def lock_main(argv):
+    ap = argparse.ArgumentParser(prog='scuba-admin lock',
+            description='Pin all images referenced by .scuba.yml to their digests, '
+                        'in {}'.format(SCUBA_LOCK))
+    ap.add_argument('-u', '--update', action='store_true',
+            help='Pull all images and pin their current versions, '
+                 'rather than keeping existing pins')
+    args = ap.parse_args(argv)
+
+    _, _, cfg_path = locate_config()
+    config = load_config(cfg_path)
+    locked = lockfile.lock_images(pull.config_images(config),
+            locked=config.locked_images, update=args.update)
+
+    for image, digest_ref in sorted(locked.items()):
+        changed = '' if config.locked_images.get(image) == digest_ref else ' (new)'
+        print('{} => {}{}'.format(image, digest_ref, changed))
+
+    lock_path = get_lock_path(cfg_path)
+    lockfile.write_lock_file(lock_path, locked)
+    appmsg('Wrote {}', lock_path)
+
+def bundle_main(argv):
+    from . import bundle
+
+    ap = argparse.ArgumentParser(prog='scuba-admin bundle',
+            description='Save the images referenced by .scuba.yml to a bundle file, '
+                        'or load them from one')
+    sub = ap.add_subparsers(dest='action', metavar='ACTION')
+    sub.required = True
+
+    p = sub.add_parser('save', help='Save the images to a bundle')
+    p.add_argument('-o', '--output', default=bundle.DEFAULT_BUNDLE,
+            help='Path of the bundle (default: %(default)s)')
+
+    p = sub.add_parser('load', help='Load the images from a bundle, if they do not exist')
+    p.add_argument('-i', '--input', default=bundle.DEFAULT_BUNDLE,
+            help='Path of the bundle (default: %(default)s)')
+
+    args = ap.parse_args(argv)
+
+    try:
+        if args.action == 'save':
+            _, _, cfg_path = locate_config()
+            config = load_config(cfg_path)
+            images = pull.config_images(config)
+            bundle.save_bundle(args.output, images, config.locked_images)
+            appmsg('Saved {} image(s) to {}', len(images), args.output)
+        else:
+            loaded, present = bundle.load_bundle(args.input)
+            appmsg('Loaded {} image(s) from {}; {} already existed',
+                    len(loaded), args.input, len(present))
+    except bundle.BundleError as e:
+        raise ScubaError(str(e))
+    except OSError as e:
+        raise ScubaError('{}: {}'.format(e.filename, e.strerror))
+
+def _locked_image_ids():
+    '''Get the IDs of the images pinned by the lock file of the config, if any'''
+    try:
+        _, _, cfg_path = locate_config()
+        pins = list(load_config(cfg_path).locked_images.values())
+    except ConfigError:
+        return set()
+    # Pinned images loaded from a bundle exist by their local tags
+    pins = [lockfile.local_ref(p) for p in pins]
+    infos = dockerutil.docker_inspect_many(pins) if pins else {}
+    return {info['Id'] for info in infos.values() if info}
+
+def gc_main(argv):
+    ap = argparse.ArgumentParser(prog='scuba-admin gc',
+            description='Remove the least recently used images run by scuba. Images '
+                        'used by running containers, and those pinned by {} (if in a '
+                        'scuba project) are kept.'.format(SCUBA_LOCK))
+    ap.add_argument('--max-size', type=parse_size, metavar='SIZE',
+            help='Remove images until those run by scuba take at most SIZE (e.g. 20G)')
+    ap.add_argument('--max-age', type=parse_duration, metavar='AGE',
+            help='Remove images which have not been run for longer than AGE (e.g. 30d)')
+    ap.add_argument('--containers', action='store_true',
+            help='Only remove the stopped containers left behind by --async-rm')
+    ap.add_argument('-n', '--dry-run', action='store_true',
+            help='Only show which images would be removed')
+    args = ap.parse_args(argv)
+    if args.max_size is None and args.max_age is None and not args.containers:
+        ap.error('--max-size and/or --max-age is required')
+
+    # Stopped (and pooled) containers would keep their images from being removed
+    if not args.dry_run:
+        sweep_scubadirs()
+        pool.clear(stats=False)
+        reaped = reap.reap_stopped()
+        if reaped or args.containers:
+            appmsg('Removed {} stopped container(s)', len(reaped))
+    if args.containers:
+        return
+
+    records = usage.get_usage()
+    infos = dockerutil.docker_inspect_many(list(records)) if records else {}
+    for image_id, info in infos.items():
+        if info is None:
+            usage.forget(image_id)      # Removed by other means
+    sizes = {i: info['Size'] for i, info in infos.items() if info}
+
+    protected = dockerutil.get_running_image_ids() | _locked_image_ids()
+
+    now = time.time()
+    selected = usage.select_images(records, sizes, protected,
+            max_size=args.max_size, max_age=args.max_age, now=now)
+
+    removed = freed = 0
+    for image_id in selected:
+        last_used, ref = records[image_id]
+        desc = '{} ({}, last run {:.1f} days ago)'.format(ref or image_id,
+                format_size(sizes[image_id]), (now - last_used) / (24*60*60))
+        if args.dry_run:
+            print('Would remove ' + desc)
+            continue
+
+        try:
+            usage.remove_image(infos[image_id])
+        except DockerError as e:
+            appmsg('Failed to remove {}: {}', ref or image_id, e)
+            continue
+        print('Removed ' + desc)
+        removed += 1
+        freed += sizes[image_id]
+
+    if not args.dry_run:
+        appmsg('Removed {} image(s), freeing up to {}', removed, format_size(freed))
+
+def _format_age(seconds):
+    for unit, n in (('d', 24*60*60), ('h', 60*60), ('m', 60)):
+        if seconds >= n:
+            return '{}{}'.format(int(seconds // n), unit)
+    return '{}s'.format(int(seconds))
+
+def session_main(argv):
+    from . import session
+
+    ap = argparse.ArgumentParser(prog='scuba-admin session',
+            description='Manage sessions: persistent containers in which scuba runs '
+                        'commands using docker exec')
+    sub = ap.add_subparsers(dest='action', metavar='ACTION')
+    sub.required = True
+
+    p = sub.add_parser('start', help='Start a session for the image of .scuba.yml '
+                                     '(or of an alias)')
+    p.add_argument('--idle-timeout', type=parse_duration, metavar='DURATION',
+            default=session.DEFAULT_IDLE_TIMEOUT,
+            help='Stop the session after no command has run in it for DURATION '
+                 '(default: 30m)')
+    p.add_argument('--image', help='Override Docker image')
+    p.add_argument('-r', '--root', action='store_true',
+            help="Run commands as root (don't create scubauser)")
+    p.add_argument('alias', nargs='?', help='Alias whose image to use')
+
+    p = sub.add_parser('stop', help='Stop the sessions of this directory, or those given')
+    p.add_argument('--all', action='store_true', help='Stop all sessions')
+    p.add_argument('ids', nargs='*', metavar='ID', help='ID of a session to stop')
+
+    sub.add_parser('list', help='List the running sessions')
+
+    args = ap.parse_args(argv)
+
+    try:
+        if args.action == 'start':
+            _, _, cfg_path = locate_config()
+            context = load_config(cfg_path).process_command(
+                    [args.alias] if args.alias else [], image=args.image)
+            dive = ScubaDive(session.session_command(context.shell, args.idle_timeout),
+                    as_root = args.root or context.as_root,
+                    image_override = context.image,
+                    detach = True,
+                    )
+            try:
+                dive.prepare()
+                started = session.start_session(dive, args.idle_timeout)
+            finally:
+                dive.cleanup_tempfiles()
+            appmsg('Started session {} for {}', started.id, started.image)
+
+        elif args.action == 'stop':
+            sessions = session.list_sessions()
+            if args.ids:
+                sessions = [s for s in sessions
+                            if any(s.container.startswith(i) for i in args.ids)]
+            elif not args.all:
+                top_path, _, _ = find_config()
+                sessions = [s for s in sessions if s.directory == top_path]
+            for s in sessions:
+                session.stop_session(s)
+                appmsg('Stopped session {}', s.id)
+
+        else:
+            now = time.time()
+            for s in session.list_sessions():
+                print('{}  {}  {}  up {}, idle {}'.format(s.id, s.image, s.directory,
+                        _format_age(now - s.started), _format_age(now - s.last_used)))
+
+    except session.SessionError as e:
+        raise ScubaError(str(e))
+
+def pool_main(argv):
+    ap = argparse.ArgumentParser(prog='scuba-admin pool',
+            description='Show how often a pooled container was available to run a '
+                        'command, or clear the pool. The pool is enabled by setting '
+                        '{} to the number of containers to keep for each command.'.format(
+                        pool.ENV_VAR))
+    ap.add_argument('action', nargs='?', choices=('stats', 'clear'), default='stats',
+            help='stats (the default) shows the hit rate; clear removes all pooled '
+                 'containers and resets the stats')
+    args = ap.parse_args(argv)
+
+    if args.action == 'clear':
+        appmsg('Removed {} pooled container(s)', pool.clear())
+        return
+
+    hits, misses = pool.get_stats()
+    total = hits + misses
+    print('Pool size: {}{}'.format(pool.get_pool_size(),
+            '' if pool.get_pool_size() else ' (disabled)'))
+    print('Pooled containers: {}'.format(pool.get_pooled_count()))
+    print('Hits: {}, misses: {} ({:.0f}% hit rate)'.format(hits, misses,
+            100.0 * hits / total if total else 0))
+
+def daemon_main(argv):
+    from . import daemon
+
+    ap = argparse.ArgumentParser(prog='scuba-admin daemon',
+            description='Manage scubad, which runs scuba invocations without starting '
+                        'a new Python process for each one')
+    sub = ap.add_subparsers(dest='action', metavar='ACTION')
+    sub.required = True
+    sub.add_parser('start', help='Start scubad in the background')
+    sub.add_parser('stop', help='Stop scubad, once the invocations it is running are done')
+    sub.add_parser('status', help='Show whether scubad is running, and its latency counters')
+    args = ap.parse_args(argv)
+
+    try:
+        if args.action == 'start':
+            if daemon.is_running():
+                raise ScubaError('scubad is already running')
+            appmsg('Started scubad (pid {})', daemon.start_later())
+        elif args.action == 'stop':
+            daemon.stop()
+            appmsg('Stopped scubad')
+        else:
+            sys.stdout.write(daemon.get_status())
+    except daemon.DaemonError as e:
+        raise ScubaError(str(e))
+
+SUBCOMMANDS = dict(
+    bundle = bundle_main,
+    daemon = daemon_main,
+    gc = gc_main,
+    lock = lock_main,
+    pool = pool_main,
+    pull = pull_main,
+    session = session_main,
+)
+
+def admin_main(argv=None):
+    '''The `scuba-admin` command, which runs the management subcommands
+
+    These are kept out of the `scuba` command, so that `scuba ARGS...` always
+    runs ARGS in the container.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    ap = argparse.ArgumentParser(prog='scuba-admin',
+            description="Manage scuba's images, containers, and processes")
+    ap.add_argument('-v', '--version', action=VersionAction)
+    ap.add_argument('subcommand', choices=sorted(SUBCOMMANDS))
+    ap.add_argument('args', nargs=argparse.REMAINDER,
+            help="Arguments of the subcommand (see scuba-admin SUBCOMMAND --help)")
+    args = ap.parse_args(argv)
+
+    _main(SUBCOMMANDS[args.subcommand], args.args)
 
+################################################################################
+
+
+def scuba_main(scuba_args):
+    if scuba_args.check_config:
+        check_config()
+        return 0
+
+    return run_scuba(scuba_args)
+
+
+def _main(func, *args):
+    '''Call func, and exit with its return value, or an error status'''
     try:
-        rc = run_scuba(scuba_args) or 0
+        rc = func(*args) or 0
         sys.exit(rc)
     except ConfigError as e:
         appmsg("Config error: " + str(e))
@@ -482,5 +1062,26 @@ def main(argv=None):
         appmsg(str(e))
         sys.exit(128)
 
+
+def main(argv=None):
+    # Spans are recorded from the start, as the trace file (--trace) isn't
+    # known until the arguments have been parsed.
+    trace.start()
+    trace_path = os.getenv(trace.ENV_VAR)
+
+    try:
+        with trace.span('main'):
+            if argv is None:
+                argv = sys.argv[1:]
+
+            scuba_args = parse_scuba_args(argv)
+            trace_path = scuba_args.trace or trace_path
+            _main(scuba_main, scuba_args)
+    finally:
+        try:
+            trace.finish(trace_path)
+        except OSError as e:
+            appmsg('Failed to write trace to {}: {}', trace_path, e.strerror)
+
 if __name__ == '__main__':
     main()
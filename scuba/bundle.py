@@ -0,0 +1,228 @@
+# Offline bundles of the images used by a config (`scuba-admin bundle`)
+#
+# A bundle is a gzip-compressed tar archive. Its first member is an index
+# (INDEX_NAME) of the images it contains, followed by the members of the
+# archive written by `docker save`, in which each layer is stored once, by
+# its digest. Reading the index first lets `scuba-admin bundle load` find out
+# whether there is anything to load without decompressing the layers.
+#
+# Images pinned by .scuba.lock are saved by their digest references. As
+# `docker load` doesn't restore repository digests, they are then tagged with
+# their local tags (see lockfile.local_tag), by which they are run.
+import os
+
+from . import dockerutil
+from . import lockfile
+
+# Version of the bundle format
+BUNDLE_VERSION = 2
+
+# Versions of the bundle format which can be loaded
+LOADABLE_VERSIONS = (1, 2)
+
+# Name of the index member of a bundle
+INDEX_NAME = 'scuba-bundle.json'
+
+# Default path of a bundle
+DEFAULT_BUNDLE = 'scuba-bundle.tar.gz'
+
+# Bundles are mostly layers, which are usually compressed already; a lower
+# level is much faster, for little difference in size.
+COMPRESS_LEVEL = 4
+
+
+class BundleError(Exception):
+    pass
+
+
+def _add_bytes(tar, name, data):
+    import io
+    import tarfile
+    import time
+
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def save_bundle(path, images, digests=None):
+    '''Save images to a bundle
+
+    Images which don't exist locally are pulled first.
+
+    Args:
+        path: The path of the bundle, which is replaced
+        images: The images (references, e.g. gcc:9) to save
+        digests: The digest references images are pinned to (e.g. by
+                 .scuba.lock), which are saved instead
+
+    Returns: A dict of the references to their image IDs
+    '''
+    import gzip
+    import json
+    import tarfile
+
+    digests = {i: digests[i] for i in images if i in (digests or {})}
+    saved = [digests.get(i, i) for i in images]
+    index = {i: dockerutil.docker_inspect_or_pull(s)['Id']
+             for i, s in zip(images, saved)}
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with gzip.open(tmp_path, 'wb', compresslevel=COMPRESS_LEVEL) as gz, \
+             tarfile.open(fileobj=gz, mode='w|', format=tarfile.PAX_FORMAT) as out:
+            _add_bytes(out, INDEX_NAME, json.dumps(dict(
+                version = BUNDLE_VERSION,
+                images = index,
+                digests = digests,
+            ), indent=2, sort_keys=True).encode('utf-8'))
+
+            # Copy the members of the saved archive, as they are streamed
+            with dockerutil.docker_save(saved) as archive, \
+                 tarfile.open(fileobj=archive, mode='r|') as src:
+                for member in src:
+                    out.addfile(member, src.extractfile(member) if member.isfile() else None)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return index
+
+
+def _read_index(tar):
+    '''Read the index of a bundle
+
+    Returns: images, digests; dicts of the references of the images to their
+             IDs, and to the digest references they are pinned to
+    '''
+    import json
+
+    member = tar.next()
+    if member is None or member.name != INDEX_NAME:
+        raise BundleError('Not a scuba bundle')
+
+    try:
+        index = json.loads(tar.extractfile(member).read().decode('utf-8'))
+    except ValueError as e:
+        raise BundleError('Invalid bundle index: {}'.format(e))
+    if not index.get('version') in LOADABLE_VERSIONS:
+        raise BundleError('Unsupported bundle version: {}'.format(index.get('version')))
+    return index['images'], index.get('digests', {})
+
+
+def _stream_members(src, fileobj):
+    '''Write the remaining members of a tar archive to a file, as an archive'''
+    import tarfile
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as out:
+        # (Iterating over src would start again from its first member.)
+        while True:
+            member = src.next()
+            if member is None:
+                break
+            out.addfile(member, src.extractfile(member) if member.isfile() else None)
+
+
+def load_bundle(path):
+    '''Load the images from a bundle which don't exist locally
+
+    The images are loaded with `docker load`. If an image in the bundle
+    already exists locally (even if it differs from the bundled one), it is
+    kept as-is. Pinned images are tagged with their local tags.
+
+    Returns: loaded, present; lists of the references of the images which
+             were loaded, and which already existed
+    '''
+    import tarfile
+
+    with open(path, 'rb') as f:
+        try:
+            src = tarfile.open(fileobj=f, mode='r|gz')
+        except (tarfile.TarError, EOFError) as e:
+            raise BundleError('Failed to read bundle: {}'.format(e))
+
+        with src:
+            try:
+                index, digests = _read_index(src)
+            except (tarfile.TarError, EOFError) as e:
+                raise BundleError('Failed to read bundle: {}'.format(e))
+
+            loaded, present, local = _load_missing(src, index, digests)
+
+    for ref in loaded:
+        if ref in digests:
+            dockerutil.docker_tag(index[ref], lockfile.local_tag(digests[ref]))
+
+    # docker load (re-)tags every image in the archive; restore the tags of
+    # those which already existed.
+    for ref in present:
+        if not ref in digests and local[ref]['Id'] != index[ref]:
+            dockerutil.docker_tag(local[ref]['Id'], ref)
+
+    return loaded, present
+
+
+def _load_missing(src, index, digests):
+    '''Load the archive in a bundle, if any of its images don't exist
+
+    A pinned image exists if its digest reference or its local tag does.
+
+    Args:
+        src: The bundle, as a streaming tarfile, positioned after the index
+        index: The images in the bundle
+        digests: The digest references of the pinned images in the bundle
+
+    Returns: loaded, present, local; where local is the inspect data of the
+             images which already existed
+    '''
+    refs = {}
+    for i in index:
+        if i in digests:
+            refs[i] = [digests[i], lockfile.local_tag(digests[i])]
+        else:
+            refs[i] = [i]
+    infos = dockerutil.docker_inspect_many([r for rs in refs.values() for r in rs])
+    local = {i: next((infos[r] for r in rs if infos[r]), None) for i, rs in refs.items()}
+
+    present = [i for i in index if local[i] is not None]
+    loaded = [i for i in index if local[i] is None]
+    if not loaded:
+        return loaded, present, local
+
+    import threading
+
+    # The saved archive is piped to docker load as it is decompressed.
+    rfd, wfd = os.pipe()
+    errors = []
+    def writer():
+        try:
+            with open(wfd, 'wb') as pipe:
+                _stream_members(src, pipe)
+        except BrokenPipeError:
+            pass    # docker load failed, and will report why
+        except BaseException as e:
+            errors.append(e)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    load_error = None
+    try:
+        with open(rfd, 'rb') as pipe:
+            dockerutil.docker_load(pipe)
+    except dockerutil.DockerError as e:
+        load_error = e
+    t.join()
+
+    # A broken bundle would also make docker load fail
+    if errors:
+        raise BundleError('Failed to read bundle: {}'.format(errors[0]))
+    if load_error:
+        raise load_error
+
+    return loaded, present, local
@@ -0,0 +1,178 @@
+import os
+
+# NOTE: json is imported lazily, so that importing this module is cheap.
+
+# Cache files held in memory, by path, as (file_stamp, data); None unless
+# enabled by keep_in_memory()
+_memory = None
+
+def is_enabled():
+    '''Determine whether scuba's on-disk caches are enabled
+
+    Setting SCUBA_NO_CACHE disables all caching.
+    '''
+    return 'SCUBA_NO_CACHE' not in os.environ
+
+def get_cache_dir():
+    '''Get the directory where scuba keeps its on-disk caches
+
+    This is $SCUBA_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/scuba
+    (defaulting to ~/.cache/scuba).
+    '''
+    path = os.getenv('SCUBA_CACHE_DIR')
+    if path:
+        return path
+
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'scuba')
+
+def get_cache_path(name):
+    return os.path.join(get_cache_dir(), name)
+
+
+def keep_in_memory():
+    '''Keep the cache files loaded by this process in memory
+
+    This is used by scubad (see daemon), which serves many invocations. A file
+    held in memory is only read again once its stamp changes (which it does
+    whenever it is stored, as it is replaced).
+    '''
+    global _memory
+    if _memory is None:
+        _memory = {}
+
+def is_kept_in_memory():
+    return _memory is not None
+
+def get_memory_paths():
+    '''Get the paths of the cache files held in memory'''
+    return list(_memory or ())
+
+def load(name):
+    '''Load a cache file
+
+    Returns: The cached data, or None if the cache file does not exist or
+             can not be read. A cache is never a reason to fail.
+    '''
+    if not is_enabled():
+        return None
+    return load_path(get_cache_path(name))
+
+def load_path(path):
+    '''Load a cache file, by its path (see load)'''
+    import json
+
+    if _memory is not None:
+        import copy
+        stamp = file_stamp(path)
+        held = _memory.get(path)
+        if held and stamp and held[0] == stamp:
+            return copy.deepcopy(held[1])
+
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if _memory is not None and stamp:
+        # (Stamped before reading, so a change in between is noticed later)
+        _memory[path] = (stamp, copy.deepcopy(data))
+    return data
+
+def store(name, data):
+    '''Store a cache file
+
+    The file is replaced atomically, so concurrent readers always see either
+    the old or new content. Errors are ignored.
+    '''
+    if not is_enabled():
+        return
+
+    import json
+    path = get_cache_path(name)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def file_stamp(path):
+    '''Get a stamp used to detect changes to a file
+
+    Returns: A list of [mtime_ns, size, inode], or None if the file can not
+             be stat'd (e.g. it does not exist)
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def file_digest(path):
+    '''Get a digest of the content of a file'''
+    import hashlib
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def content_stamp(path):
+    '''Get a stamp used to detect changes to the content of a file
+
+    Returns: A list of [mtime_ns, size, digest], or None if the file can not
+             be read (e.g. it does not exist)
+    '''
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size, file_digest(path)]
+    except OSError:
+        return None
+
+def content_unchanged(path, stamp):
+    '''Determine whether a file's content matches a stamp from content_stamp()
+
+    The file is only read (to compare its digest) if its mtime or size differ,
+    or if the stamp was taken too soon after the file was modified to be
+    trusted (see make_stamp_trusted).
+    '''
+    if stamp is None:
+        return not os.path.exists(path)
+
+    mtime_ns, size, digest = stamp
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+
+    if st.st_size != size:
+        return False
+    if st.st_mtime_ns == mtime_ns:
+        return True
+
+    try:
+        return file_digest(path) == digest
+    except OSError:
+        return False
+
+# A file modified less than this long (in ns) before it was stamped may be
+# modified again without its mtime changing (depending on the filesystem's
+# timestamp granularity).
+RACY_WINDOW_NS = 2 * 10**9
+
+def make_stamp_trusted(stamp, now_ns):
+    '''Adjust a content_stamp() taken at now_ns for storage
+
+    If the file was modified too recently for its mtime to be trusted, the
+    mtime is dropped from the stamp, so content_unchanged() will always
+    compare the digest.
+    '''
+    if stamp is not None and now_ns - stamp[0] < RACY_WINDOW_NS:
+        stamp = [None] + stamp[1:]
+    return stamp
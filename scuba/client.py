@@ -0,0 +1,15 @@
+# The `scuba` command
+# PYTHON_ARGCOMPLETE_OK
+#
+# If scubad is running (see daemon), the invocation is run by it, which saves
+# importing most of scuba and loading its caches and config in every process.
+# Otherwise, scuba runs in this process as usual.
+import sys
+
+def main():
+    from . import daemon
+    rc = daemon.forward(sys.argv[1:])
+    if rc is None:
+        from .__main__ import main as scuba_main
+        scuba_main()
+    sys.exit(rc)
@@ -0,0 +1,70 @@
+# Command line completion support
+#
+# Completion runs on every TAB press, so the results of the expensive lookups
+# (loading .scuba.yml, running `docker images`) are kept in an on-disk index.
+import os
+import time
+
+from .config import locate_config, load_config
+from . import cache
+from . import dockerutil
+from . import imagecache
+
+ALIASES_CACHE = 'completion-aliases.json'
+IMAGES_CACHE = 'completion-images.json'
+
+# Maximum age (in seconds) of the cached image list, used when changes to the
+# Docker image store can't be detected (e.g. it is not readable by the user)
+IMAGES_TTL = 60
+
+
+def list_aliases():
+    '''Get the names of the aliases defined in .scuba.yml
+
+    The alias names are cached, keyed on the config file path, and invalidated
+    when the content of the config file, or of any file it references (via
+    !from_yaml), changes.
+
+    Raises ConfigError if the config can not be found or loaded.
+    '''
+    _, _, cfg_path = locate_config()
+
+    index = cache.load(ALIASES_CACHE) or {}
+    entry = index.get(cfg_path)
+    if entry and all(cache.content_unchanged(dep, stamp) for dep, stamp in entry['deps']):
+        return entry['aliases']
+
+    config = load_config(cfg_path)
+    aliases = sorted(config.aliases)
+
+    if config.dependencies is not None:
+        index[cfg_path] = dict(deps=config.dependencies, aliases=aliases)
+        cache.store(ALIASES_CACHE, index)
+    return aliases
+
+
+def list_images():
+    '''Get the current list of docker images
+
+    The list is cached per Docker host, and invalidated when the Docker image
+    store changes, or (if that can not be detected) after IMAGES_TTL seconds.
+    '''
+    host = os.getenv('DOCKER_HOST', '')
+    now = time.time()
+    stamp = imagecache.image_store_stamp()
+
+    index = cache.load(IMAGES_CACHE) or {}
+    entry = index.get(host)
+    if entry:
+        if stamp is not None:
+            fresh = (entry['stamp'] == stamp)
+        else:
+            fresh = (0 <= now - entry['time'] < IMAGES_TTL)
+        if fresh:
+            return entry['images']
+
+    images = dockerutil.get_images()
+
+    index[host] = dict(stamp=stamp, time=now, images=images)
+    cache.store(IMAGES_CACHE, index)
+    return images
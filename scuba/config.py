@@ -1,10 +1,10 @@
 import os
-import yaml
-import re
-import shlex
+from collections import namedtuple
+from collections.abc import Mapping
 
 from .constants import *
 from .utils import *
+from . import cache
 
 class ConfigError(Exception):
     pass
@@ -12,83 +12,47 @@ class ConfigError(Exception):
 class ConfigNotFoundError(ConfigError):
     pass
 
-# http://stackoverflow.com/a/9577670
-class Loader(yaml.SafeLoader):
-    def __init__(self, stream):
-        self._root = os.path.split(stream.name)[0]
-        self._cache = dict()
-        super(Loader, self).__init__(stream)
 
-    def from_yaml(self, node):
-        '''
-        Implementes a !from_yaml constructor with the following syntax:
-            !from_yaml filename key
-
-        Arguments:
-            filename:   Filename of external YAML document from which to load,
-                        relative to the current YAML file.
-            key:        Key from external YAML document to return,
-                        using a dot-separated syntax for nested keys.
-
-        Examples:
-            !from_yaml external.yml pop
-            !from_yaml external.yml foo.bar.pop
-            !from_yaml "another file.yml" "foo bar.snap crackle.pop"
-        '''
-
-        # Load the content from the node, as a scalar
-        content = self.construct_scalar(node)
+# Name of the cache mapping directories to where their config was found
+DISCOVERY_CACHE = 'discovery.json'
 
-        # Split on unquoted spaces
-        try:
-            parts = shlex.split(content)
-        except UnicodeEncodeError:
-            raise yaml.YAMLError('Non-ASCII arguments to !from_yaml are unsupported')
+# Maximum number of directories kept in the discovery cache
+DISCOVERY_CACHE_MAX_ENTRIES = 1000
 
-        if len(parts) != 2:
-            raise yaml.YAMLError('Two arguments expected to !from_yaml')
-        filename, key = parts
 
-        # path is relative to the current YAML document
-        path = os.path.join(self._root, filename)
+def _config_from_env():
+    '''Get the config location from the environment, if it is overridden
 
-        # Load the other YAML document
-        doc = self._cache.get(path)
-        if not doc:
-            with open(path, 'r') as f:
-                doc = yaml.load(f, self.__class__)
-                self._cache[path] = doc
+    SCUBA_CONFIG gives the path to the config file, and SCUBA_ROOT the
+    directory containing .scuba.yml. Either way, the directory containing the
+    config becomes the scuba root.
 
-        # Retrieve the key
-        try:
-            cur = doc
-            # Use a negative look-behind to split the key on non-escaped '.' characters
-            for k in re.split(r'(?<!\\)\.', key):
-                cur = cur[k.replace('\\.', '.')]  # Be sure to replace any escaped '.' characters with *just* the '.'
-        except KeyError:
-            raise yaml.YAMLError('Key "{}" not found in {}'.format(key, filename))
-        return cur
+    Returns: path, cfg_path; or None if neither variable is set
+    '''
+    cfg_path = os.getenv('SCUBA_CONFIG')
+    if cfg_path:
+        cfg_path = os.path.abspath(cfg_path)
+        return os.path.dirname(cfg_path), cfg_path
 
-Loader.add_constructor('!from_yaml', Loader.from_yaml)
+    path = os.getenv('SCUBA_ROOT')
+    if path:
+        path = os.path.abspath(path)
+        return path, os.path.join(path, SCUBA_YML)
 
+    return None
 
-def find_config():
-    '''Search up the directory hierarchy for .scuba.yml
+def _walk_config_dir(cwd, cross_fs):
+    '''Search up the directory hierarchy from cwd for .scuba.yml
 
-    Returns: path, rel, config on success, or None if not found
-        path    The absolute path of the directory where .scuba.yml was found
-        rel     The relative path from the directory where .scuba.yml was found
-                to the current directory
-        config  The loaded configuration
+    Returns: path, rel
     '''
-    cross_fs = 'SCUBA_DISCOVERY_ACROSS_FILESYSTEM' in os.environ
-    path = os.getcwd()
+    path = cwd
 
     rel = ''
     while True:
         cfg_path = os.path.join(path, SCUBA_YML)
         if os.path.exists(cfg_path):
-            return path, rel, load_config(cfg_path)
+            return path, rel
 
         if not cross_fs and os.path.ismount(path):
             msg = '{} not found here or any parent up to mount point {}'.format(SCUBA_YML, path) \
@@ -103,6 +67,85 @@ def find_config():
         # Accumulate the relative path back to where we started
         rel = os.path.join(rest, rel)
 
+def _find_cached_config_dir(cwd, cross_fs):
+    '''Search for .scuba.yml, using the discovery cache
+
+    A cached result is only used if the config file it found still has the
+    same inode, mtime, and size; this requires just one stat.
+
+    NOTE: A .scuba.yml newly created in a directory between cwd and the
+    cached scuba root is not noticed until the cached config changes.
+
+    Returns: path, rel
+    '''
+    index = cache.load(DISCOVERY_CACHE) or {}
+    entry = index.get(cwd)
+    if entry and entry['cross_fs'] == cross_fs:
+        path = entry['path']
+        if cache.file_stamp(os.path.join(path, SCUBA_YML)) == entry['stamp']:
+            return path, entry['rel']
+
+    path, rel = _walk_config_dir(cwd, cross_fs)
+
+    if len(index) >= DISCOVERY_CACHE_MAX_ENTRIES:
+        index = {}
+    index[cwd] = dict(
+        cross_fs = cross_fs,
+        path = path,
+        rel = rel,
+        stamp = cache.file_stamp(os.path.join(path, SCUBA_YML)),
+    )
+    cache.store(DISCOVERY_CACHE, index)
+    return path, rel
+
+def locate_config():
+    '''Locate the scuba config, without loading it
+
+    The config location is taken from SCUBA_CONFIG or SCUBA_ROOT, if set.
+    Otherwise, the directory hierarchy is searched up for .scuba.yml.
+
+    Returns: path, rel, cfg_path on success; raises ConfigNotFoundError if not found
+        path        The absolute path of the directory where .scuba.yml was found
+        rel         The relative path from the directory where .scuba.yml was found
+                    to the current directory
+        cfg_path    The path of the config file
+    '''
+    cwd = os.getcwd()
+
+    override = _config_from_env()
+    if override:
+        path, cfg_path = override
+        if not os.path.isfile(cfg_path):
+            raise ConfigNotFoundError('{} not found (from environment)'.format(cfg_path))
+
+        rel = os.path.relpath(cwd, path)
+        if rel == os.curdir:
+            rel = ''
+        elif rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            raise ConfigError('Current directory is not beneath scuba root {}'.format(path))
+        return path, rel, cfg_path
+
+    cross_fs = 'SCUBA_DISCOVERY_ACROSS_FILESYSTEM' in os.environ
+    if cache.is_enabled():
+        path, rel = _find_cached_config_dir(cwd, cross_fs)
+    else:
+        path, rel = _walk_config_dir(cwd, cross_fs)
+
+    return path, rel, os.path.join(path, SCUBA_YML)
+
+
+def find_config():
+    '''Locate the scuba config (see locate_config), and load it
+
+    Returns: path, rel, config on success; raises ConfigNotFoundError if not found
+        path    The absolute path of the directory where .scuba.yml was found
+        rel     The relative path from the directory where .scuba.yml was found
+                to the current directory
+        config  The loaded configuration
+    '''
+    path, rel, cfg_path = locate_config()
+    return path, rel, load_config(cfg_path)
+
 
 def _process_script_node(node, name):
     '''Process a script-type node
@@ -132,9 +175,11 @@ def _process_script_node(node, name):
     raise ConfigError("{}: must be string or dict".format(name))
 
 
-def _process_environment(node, name):
+def _process_environment(node, name, inherited=None):
     # Environment can be either a list of strings ("KEY=VALUE") or a mapping
     # Environment keys and values are always strings
+    # The names of variables whose values come from the host environment are
+    # added to the inherited set, if given.
     result = {}
 
     if not node:
@@ -143,10 +188,14 @@ def _process_environment(node, name):
         for k, v in node.items():
             if v is None:
                 v = os.getenv(k, '')
+                if inherited is not None:
+                    inherited.add(k)
             result[k] = str(v)
     elif isinstance(node, list):
         for e in node:
             k, v = parse_env_var(e)
+            if inherited is not None and not '=' in e:
+                inherited.add(k)
             result[k] = v
     else:
         raise ConfigError("'{}' must be list or mapping, not {}".format(
@@ -180,8 +229,38 @@ def _get_entrypoint(data):
     return ep
 
 
+# When the image of a container is pulled (see _get_pull_policy):
+#   mode: 'never', 'missing', 'always', or 'ttl'
+#   ttl:  For 'ttl', the number of seconds for which a check for a newer image
+#         remains fresh; otherwise None
+PullPolicy = namedtuple('PullPolicy', 'mode ttl')
+
+DEFAULT_PULL_POLICY = PullPolicy('missing', None)
+
+def _get_pull_policy(data, name):
+    key = 'pull'
+
+    if not key in data:
+        return None
+
+    node = data[key]
+    if isinstance(node, str):
+        if node in ('never', 'missing', 'always'):
+            return PullPolicy(node, None)
+
+        if node.startswith('ttl='):
+            try:
+                return PullPolicy('ttl', parse_duration(node[4:]))
+            except ValueError:
+                pass
+
+    raise ConfigError("'{}' must be one of never, missing, always, or "
+            "ttl=<duration>, not {!r}".format(name, node))
+
+
 class ScubaAlias(object):
-    def __init__(self, name, script, image, entrypoint, environment, shell, as_root):
+    def __init__(self, name, script, image, entrypoint, environment, shell, as_root,
+            pull_policy=None):
         self.name = name
         self.script = script
         self.image = image
@@ -189,6 +268,7 @@ class ScubaAlias(object):
         self.environment = environment
         self.shell = shell
         self.as_root = as_root
+        self.pull_policy = pull_policy
 
     @classmethod
     def from_dict(cls, name, node):
@@ -198,6 +278,7 @@ class ScubaAlias(object):
         environment = None
         shell = None
         as_root = False
+        pull_policy = None
 
         if isinstance(node, dict):  # Rich alias
             image = node.get('image')
@@ -207,8 +288,33 @@ class ScubaAlias(object):
                     '{}.{}'.format(name, 'environment'))
             shell = node.get('shell')
             as_root = node.get('root', as_root)
+            pull_policy = _get_pull_policy(node, '{}.pull'.format(name))
+
+        return cls(name, script, image, entrypoint, environment, shell, as_root,
+                pull_policy)
 
-        return cls(name, script, image, entrypoint, environment, shell, as_root)
+class ScubaAliases(Mapping):
+    '''A mapping of alias names to ScubaAlias objects
+
+    Each alias is only validated and built from its config node when it is
+    first accessed, as only one alias is typically used per invocation.
+    '''
+    def __init__(self, nodes):
+        self._nodes = nodes
+        self._aliases = {}
+
+    def __getitem__(self, name):
+        alias = self._aliases.get(name)
+        if alias is None:
+            alias = ScubaAlias.from_dict(name, self._nodes[name])
+            self._aliases[name] = alias
+        return alias
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
 
 class ScubaContext(object):
     pass
@@ -216,7 +322,7 @@ class ScubaContext(object):
 class ScubaConfig(object):
     def __init__(self, **data):
         required_nodes = ()
-        optional_nodes = ('image','aliases','hooks','entrypoint','environment','shell')
+        optional_nodes = ('image','aliases','hooks','entrypoint','environment','shell','pull')
 
         # Check for missing required nodes
         missing = [n for n in required_nodes if not n in data]
@@ -233,20 +339,31 @@ class ScubaConfig(object):
         self._image = data.get('image')
         self._shell = data.get('shell', DEFAULT_SHELL)
         self._entrypoint = _get_entrypoint(data)
+        self._pull_policy = _get_pull_policy(data, 'pull') or DEFAULT_PULL_POLICY
         self._load_aliases(data)
         self._load_hooks(data)
+        self._inherited_env = set()
         self._environment = self._load_environment(data)
 
+        # The files this config was loaded from, as a list of [path, stamp]
+        # (see cache.content_stamp). Set by load_config, if caching is enabled.
+        self.dependencies = None
+
+        # Image references pinned to digests by .scuba.lock, by reference.
+        # Set by load_config.
+        self.locked_images = {}
+
 
 
 
     def _load_aliases(self, data):
-        self._aliases = {}
+        nodes = data.get('aliases', {})
 
-        for name, node in data.get('aliases', {}).items():
+        for name in nodes:
             if ' ' in name:
                 raise ConfigError('Alias names cannot contain spaces')
-            self._aliases[name] = ScubaAlias.from_dict(name, node)
+
+        self._aliases = ScubaAliases(nodes)
 
 
     def _load_hooks(self, data):
@@ -259,8 +376,20 @@ class ScubaConfig(object):
                 self._hooks[name] = hook
 
     def _load_environment(self, data):
-         return _process_environment(data.get('environment'), 'environment')
+         return _process_environment(data.get('environment'), 'environment',
+                 self._inherited_env)
+
+
+    def validate(self):
+        '''Validate the entire config
 
+        Some parts of the config (e.g. aliases) are otherwise only validated
+        when they are used.
+
+        Raises ConfigError if the config is invalid.
+        '''
+        for name in self.aliases:
+            self.aliases[name]
 
     @property
     def image(self):
@@ -284,10 +413,27 @@ class ScubaConfig(object):
     def environment(self):
         return self._environment
 
+    @property
+    def inherits_env(self):
+        '''Whether the environment has values from the host environment'''
+        return bool(self._inherited_env)
+
     @property
     def shell(self):
         return self._shell
 
+    @property
+    def pull_policy(self):
+        return self._pull_policy
+
+    def pinned_image(self, image):
+        '''Get the reference to use for an image of the config
+
+        Returns: The digest reference the image is pinned to by .scuba.lock,
+                 or the image itself if it is not pinned
+        '''
+        return self.locked_images.get(image, image)
+
 
     def process_command(self, command, image=None, shell=None):
         '''Processes a user command using aliases
@@ -300,6 +446,7 @@ class ScubaConfig(object):
         Returns: A ScubaContext object with the following attributes:
             script: a list of command line strings
             image: the docker image name to use
+            pull_policy: a PullPolicy for the image
         '''
         result = ScubaContext()
         result.script = None
@@ -308,6 +455,7 @@ class ScubaConfig(object):
         result.environment = self.environment.copy()
         result.shell = self.shell
         result.as_root = False
+        result.pull_policy = self.pull_policy
 
         if command:
             alias = self.aliases.get(command[0])
@@ -325,6 +473,8 @@ class ScubaConfig(object):
                     result.shell = alias.shell
                 if alias.as_root:
                     result.as_root = True
+                if alias.pull_policy:
+                    result.pull_policy = alias.pull_policy
 
                 # Merge/override the environment
                 if alias.environment:
@@ -353,22 +503,168 @@ class ScubaConfig(object):
         # If an image was given, it overrides what might have been set by an alias
         if image:
             result.image = image
+        else:
+            # If the image was still not set, then try to get it from the confg,
+            # which will raise a ConfigError if it is not set
+            if not result.image:
+                result.image = self.image
 
-        # If the image was still not set, then try to get it from the confg,
-        # which will raise a ConfigError if it is not set
-        if not result.image:
-            result.image = self.image
+            # Images from the config are pinned by .scuba.lock
+            result.image = self.pinned_image(result.image)
 
         return result
 
 
-def load_config(path):
+# Version of the format of cached configs
+CONFIG_CACHE_VERSION = 2
+
+# Version of the format of .scuba.lock
+LOCK_FILE_VERSION = 1
+
+def _config_cache_name(path):
+    import hashlib
+    return 'config/{}.json'.format(hashlib.sha1(path.encode('utf-8')).hexdigest())
+
+def _load_cached_config_data(path):
+    '''Load previously-parsed config data from the cache
+
+    Returns: data, locked, deps; or None, None, None if it is not cached, or if
+             the config file or any of its dependencies have changed.
+    '''
+    entry = cache.load(_config_cache_name(path))
+    if not entry or entry.get('version') != CONFIG_CACHE_VERSION:
+        return None, None, None
+    if entry.get('path') != path:
+        return None, None, None
+
+    for dep, stamp in entry['deps']:
+        if not cache.content_unchanged(dep, stamp):
+            return None, None, None
+
+    return entry['data'], entry['locked'], entry['deps']
+
+def _store_cached_config_data(path, deps, data, locked):
+    '''Store parsed config data in the cache
+
+    Returns: The list of [path, stamp] dependencies, as stored
+    '''
+    import json
+    import time
+
+    now_ns = int(time.time() * 10**9)
+    deps = [[dep, cache.make_stamp_trusted(stamp, now_ns)]
+            for dep, stamp in deps.items()]
+
+    # Only data which survives a JSON round-trip unchanged can be cached
+    # (e.g. not timestamps or non-string keys).
+    try:
+        if json.loads(json.dumps(data)) != data:
+            return deps
+    except (TypeError, ValueError):
+        return deps
+
+    cache.store(_config_cache_name(path), dict(
+        version = CONFIG_CACHE_VERSION,
+        path = path,
+        deps = deps,
+        data = data,
+        locked = locked,
+    ))
+    return deps
+
+def _parse_config(path, deps):
+    # Importing yaml is expensive; only do so when a config is actually parsed
+    import yaml
+    from . import yamlloader
+
     try:
         with open(path, 'r') as f:
-            data = yaml.load(f, Loader)
+            return yamlloader.load(f, deps=deps)
     except IOError as e:
         raise ConfigError('Error opening {}: {}'.format(SCUBA_YML, e))
     except yaml.YAMLError as e:
         raise ConfigError('Error loading {}: {}'.format(SCUBA_YML, e))
 
-    return ScubaConfig(**(data or {}))
+def get_lock_path(path):
+    '''Get the path of the lock file of a config file'''
+    return os.path.join(os.path.dirname(path), SCUBA_LOCK)
+
+def load_lock_file(path):
+    '''Load the images pinned by a .scuba.lock file
+
+    Returns: A dict of image references to digest references, which is empty
+             if the file does not exist
+    '''
+    import json
+
+    # Most configs don't have one
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except OSError as e:
+        raise ConfigError('Error opening {}: {}'.format(SCUBA_LOCK, e))
+    except ValueError as e:
+        raise ConfigError('Error loading {}: {}'.format(SCUBA_LOCK, e))
+
+    if not isinstance(data, dict) or data.get('version') != LOCK_FILE_VERSION:
+        raise ConfigError('{}: Unsupported version'.format(SCUBA_LOCK))
+
+    images = data.get('images')
+    if not isinstance(images, dict) or not all(
+            isinstance(v, str) and '@' in v for v in images.values()):
+        raise ConfigError("{}: 'images' must be a mapping of images to digest "
+                "references".format(SCUBA_LOCK))
+    return images
+
+# Loaded configs, by path, if cache files are kept in memory
+_loaded = {}
+
+def get_loaded_paths():
+    '''Get the paths of the configs held in memory'''
+    return list(_loaded)
+
+def load_config(path):
+    '''Load a .scuba.yml config file, and the .scuba.lock file next to it
+
+    The parsed content is cached, along with the content stamps of the files
+    and every external document referenced via !from_yaml. As long as none of
+    them have changed, the config is rebuilt from the cache, without parsing
+    YAML. If cache files are kept in memory (see cache.keep_in_memory), the
+    ScubaConfig itself is reused, unless its environment has values from the
+    host environment, which may differ between invocations (e.g. by scubad).
+    '''
+    if not cache.is_enabled():
+        data = _parse_config(path, None)
+        config = ScubaConfig(**(data or {}))
+        config.locked_images = load_lock_file(get_lock_path(path))
+        return config
+
+    abspath = os.path.abspath(path)
+    if cache.is_kept_in_memory():
+        config = _loaded.get(abspath)
+        if config and all(cache.content_unchanged(dep, stamp)
+                          for dep, stamp in config.dependencies):
+            return config
+
+    data, locked, deps = _load_cached_config_data(abspath)
+    if data is None:
+        # Stamp the files before reading them (see Loader.from_yaml)
+        lock_path = get_lock_path(abspath)
+        deps = {
+            abspath: cache.content_stamp(abspath),
+            lock_path: cache.content_stamp(lock_path),
+        }
+        data = _parse_config(path, deps) or {}
+        locked = load_lock_file(lock_path)
+        deps = _store_cached_config_data(abspath, deps, data, locked)
+
+    config = ScubaConfig(**data)
+    config.locked_images = locked
+    config.dependencies = deps
+
+    if cache.is_kept_in_memory() and not config.inherits_env:
+        _loaded[abspath] = config
+    return config
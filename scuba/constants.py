@@ -1,5 +1,8 @@
 # Name of config file to search for and load
 SCUBA_YML = '.scuba.yml'
 
+# Name of the file, next to the config, which pins images to digests
+SCUBA_LOCK = '.scuba.lock'
+
 # Default shell to run in the container
 DEFAULT_SHELL = '/bin/sh'
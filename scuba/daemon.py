@@ -0,0 +1,555 @@
+# A per-user daemon which runs scuba invocations (`scubad`)
+#
+# Even with its caches, every scuba invocation starts Python, imports most of
+# scuba (and yaml, argparse, json, etc.), and re-reads the cache files and
+# config. scubad does all of that once, and keeps the cache files and loaded
+# configs in memory (see cache.keep_in_memory), revalidating them with a stat
+# when they're used.
+#
+# The `scuba` entry point (see client) forwards its command line, working
+# directory, umask, and environment to scubad over a UNIX socket in the
+# runtime directory, passing its stdin, stdout, and stderr file descriptors
+# along. For each invocation, scubad forks a process which takes on those,
+# and runs scuba as usual. Once that process exits, scubad sends its exit
+# status to the client, and loads anything it held in memory that scubad
+# doesn't yet. Signals received by the client are forwarded to the process,
+# one byte (the signal number) at a time.
+#
+# If scubad isn't running, the client simply runs scuba in its own process.
+# The Docker API is still connected to per request, as connections can't be
+# shared across the fork.
+import os
+import sys
+import time
+
+# Names of the socket, and of the log of scubad's own output (when started
+# by start_later), in the runtime directory
+SOCKET_NAME = 'scubad.sock'
+LOG_NAME = 'scubad.log'
+
+# Setting this environment variable makes the client run scuba in its own
+# process, even if scubad is running
+DISABLE_ENV_VAR = 'SCUBA_NO_DAEMON'
+
+# Signals forwarded by the client
+FORWARDED_SIGNALS = ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT', 'SIGUSR1', 'SIGUSR2')
+
+# Modules imported by scubad up-front, so invocations don't have to
+PRELOAD_MODULES = (
+    'argparse',
+    'http.client',
+    'json',
+    'shutil',
+    'subprocess',
+    'tempfile',
+    'yaml',
+    'scuba.__main__',
+    'scuba.dockerapi',
+    'scuba.pool',
+    'scuba.session',
+    'scuba.yamlloader',
+)
+
+# How long scubad waits for a client to send its request
+REQUEST_TIMEOUT = 5
+
+
+class DaemonError(Exception):
+    pass
+
+
+def get_socket_path():
+    '''Get the path of scubad's socket, or None if there's no runtime directory'''
+    from .runtime import get_runtime_dir
+    path = get_runtime_dir()
+    if not path:
+        return None
+    return os.path.join(path, SOCKET_NAME)
+
+def _connect():
+    '''Connect to scubad
+
+    Returns: The socket, or None if scubad isn't running
+    '''
+    import socket
+
+    path = get_socket_path()
+    if not path or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def is_running():
+    sock = _connect()
+    if sock:
+        sock.close()
+    return sock is not None
+
+
+def _encode(fields):
+    '''Encode a request, from a list of str or bytes fields'''
+    data = b'\0'.join(os.fsencode(f) for f in fields)
+    return len(data).to_bytes(4, 'big') + data
+
+def _recv_request(conn):
+    '''Receive a request, and any file descriptors passed with it
+
+    Returns: A (fields, fds) tuple
+    '''
+    import array
+    import socket
+
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+
+    try:
+        while len(data) < 4 or len(data) < 4 + int.from_bytes(data[:4], 'big'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise DaemonError('Incomplete request')
+            data += chunk
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+    return [os.fsdecode(f) for f in data[4:].split(b'\0')], list(fds)
+
+def _request(kind):
+    '''Send a request, other than to run scuba, and return the response'''
+    sock = _connect()
+    if not sock:
+        raise DaemonError('scubad is not running')
+    with sock:
+        sock.sendall(_encode([kind]))
+        response = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return response.decode('utf-8')
+            response += chunk
+
+def get_status():
+    '''Get a description of scubad's state and latency counters'''
+    return _request('status')
+
+def stop():
+    '''Make scubad exit, once the invocations it is running are done'''
+    _request('stop')
+
+
+def forward(argv):
+    '''Run a scuba invocation in scubad, if it is running
+
+    Args:
+        argv: The scuba command line (excluding the program name)
+
+    Returns: The exit status, or None if scubad isn't running
+    '''
+    # (Shell completion writes to file descriptors other than stdout)
+    if DISABLE_ENV_VAR in os.environ or '_ARGCOMPLETE' in os.environ:
+        return None
+
+    # stdin, stdout, and stderr can only be passed if they are open. (If one
+    # isn't, the socket could also take its place.)
+    try:
+        for fd in (0, 1, 2):
+            os.fstat(fd)
+    except OSError:
+        return None
+
+    sock = _connect()
+    if not sock:
+        return None
+
+    import array
+    import signal
+    import socket
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    fields = ['run', os.getcwd(), str(umask), str(len(argv))] + list(argv)
+    fields += [k + b'=' + v for k, v in os.environb.items()]
+    data = _encode(fields)
+
+    def forward_signal(signum, frame):
+        try:
+            sock.send(bytes([signum]))
+        except OSError:
+            pass
+
+    with sock:
+        sent = sock.sendmsg([data],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [0, 1, 2]))])
+        sock.sendall(data[sent:])
+
+        for name in FORWARDED_SIGNALS:
+            signal.signal(getattr(signal, name), forward_signal)
+
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(64)
+            if not chunk:
+                print('scuba: Lost connection to scubad', file=sys.stderr)
+                return 128
+            reply += chunk
+    return int(reply)
+
+
+def start_later():
+    '''Start scubad, in a detached process
+
+    Returns once it is accepting connections.
+    '''
+    import subprocess
+
+    # scubad must import the same scuba package as this process
+    env = dict(os.environ)
+    pkg_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (pkg_parent, env.get('PYTHONPATH')) if p)
+
+    log_path = os.path.join(os.path.dirname(get_socket_path()), LOG_NAME)
+    with open(log_path, 'w+') as log:
+        p = subprocess.Popen([sys.executable, '-m', 'scuba.daemon'],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                env=env, close_fds=True, start_new_session=True)
+        while not is_running():
+            if p.poll() is not None:
+                log.seek(0)
+                raise DaemonError('scubad exited: {}'.format(log.read().strip()))
+            time.sleep(0.02)
+    return p.pid
+
+
+class _Job(object):
+    '''An invocation being run by a child process of scubad'''
+    def __init__(self, conn, report_fd, accepted, dispatched):
+        self.conn = conn
+        self.report_fd = report_fd
+        self.accepted = accepted
+        self.dispatched = dispatched
+
+
+class Server(object):
+    '''scubad: runs invocations received on a UNIX socket'''
+
+    def __init__(self, path):
+        self.path = path
+        self.listener = None
+        self.jobs = {}          # By PID
+        self.stopping = False
+        self.started = time.time()
+
+        # Latency counters (in seconds)
+        self.requests = 0
+        self.dispatch_total = self.dispatch_max = 0.0
+        self.run_total = self.run_max = 0.0
+
+    def serve(self):
+        '''Serve requests until stopped (by a request, or SIGTERM/SIGINT)'''
+        import importlib
+        import select
+        import signal
+        import socket
+        from . import cache
+
+        for name in PRELOAD_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+        cache.keep_in_memory()
+
+        # SIGCHLD (and SIGTERM/SIGINT) interrupt select() by the wakeup pipe
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        signal.set_wakeup_fd(self._wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._stop_signal)
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(64)
+
+        try:
+            while True:
+                if self.stopping:
+                    self._close_listener()
+                if not self.listener and not self.jobs:
+                    break
+
+                conns = [j.conn for j in self.jobs.values() if j.conn]
+                waitfor = [self._wakeup_r] + conns + ([self.listener] if self.listener else [])
+                readable = select.select(waitfor, [], [])[0]
+
+                if self._wakeup_r in readable:
+                    try:
+                        while os.read(self._wakeup_r, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                self._reap()
+
+                for pid, job in list(self.jobs.items()):
+                    if job.conn and job.conn in readable:
+                        self._forward_signals(pid, job)
+
+                if self.listener and self.listener in readable:
+                    self._accept()
+        finally:
+            self._close_listener()
+
+    def _stop_signal(self, signum, frame):
+        self.stopping = True
+
+    def _close_listener(self):
+        if self.listener:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.listener.close()
+            self.listener = None
+
+    def _accept(self):
+        try:
+            conn, _ = self.listener.accept()
+        except OSError:
+            return
+        accepted = time.monotonic()
+
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            fields, fds = _recv_request(conn)
+        except (OSError, DaemonError):
+            conn.close()
+            return
+        conn.settimeout(None)
+
+        try:
+            if fields[0] == 'run' and len(fds) == 3:
+                self._spawn(conn, fields[1:], fds, accepted)
+                return
+            elif fields[0] == 'status':
+                conn.sendall(self.get_status().encode('utf-8'))
+            elif fields[0] == 'stop':
+                self.stopping = True
+        except OSError:
+            pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+        conn.close()
+
+    def _spawn(self, conn, fields, fds, accepted):
+        '''Run an invocation in a child process'''
+        report_r, report_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(report_r)
+                code = self._child(conn, fields, fds, report_w)
+            finally:
+                os._exit(code)
+
+        os.close(report_w)
+        self.jobs[pid] = _Job(conn, report_r, accepted, time.monotonic())
+
+    def _child(self, conn, fields, fds, report_fd):
+        '''Run an invocation (in the child process)
+
+        Returns: The exit status
+        '''
+        import signal
+        from . import cache
+        from . import config
+
+        signal.set_wakeup_fd(-1)
+        for sig in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self.listener.close()
+        for job in self.jobs.values():
+            if job.conn:
+                job.conn.close()
+            os.close(job.report_fd)
+        conn.close()    # (scubad reports the exit status)
+
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, errors='backslashreplace', closefd=False)
+
+        cwd, umask, argc = fields[0], int(fields[1]), int(fields[2])
+        argv = fields[3:3 + argc]
+        os.environ.clear()
+        os.environ.update(v.split('=', 1) for v in fields[3 + argc:])
+        os.umask(umask)
+        sys.argv = ['scuba'] + argv
+
+        try:
+            os.chdir(cwd)
+            from .__main__ import main
+            main(argv)
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except KeyboardInterrupt:
+            code = 130
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+
+        for f in (sys.stdout, sys.stderr):
+            try:
+                f.flush()
+            except OSError:
+                pass
+
+        # Tell scubad what this process held in memory
+        report = ['cache\t' + p for p in cache.get_memory_paths()]
+        report += ['config\t' + p for p in config.get_loaded_paths()]
+        try:
+            os.set_blocking(report_fd, False)
+            os.write(report_fd, '\n'.join(report).encode('utf-8', 'surrogateescape'))
+        except OSError:
+            pass
+        return code
+
+    def _forward_signals(self, pid, job):
+        try:
+            data = job.conn.recv(64)
+        except OSError:
+            data = b''
+        if not data:
+            # The client has gone away
+            data = bytes([1])   # SIGHUP
+            job.conn.close()
+            job.conn = None
+        for signum in data:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self):
+        '''Report the exit status of the invocations which are done'''
+        while self.jobs:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            job = self.jobs.pop(pid, None)
+            if not job:
+                continue
+
+            if os.WIFSIGNALED(status):
+                code = 128 + os.WTERMSIG(status)
+            else:
+                code = os.WEXITSTATUS(status)
+            if job.conn:
+                try:
+                    job.conn.sendall('{}\n'.format(code).encode('ascii'))
+                except OSError:
+                    pass
+                job.conn.close()
+
+            now = time.monotonic()
+            self.requests += 1
+            dispatch = job.dispatched - job.accepted
+            self.dispatch_total += dispatch
+            self.dispatch_max = max(self.dispatch_max, dispatch)
+            run = now - job.accepted
+            self.run_total += run
+            self.run_max = max(self.run_max, run)
+
+            self._load_report(job.report_fd)
+
+    def _load_report(self, fd):
+        '''Load what a child process held in memory, which scubad doesn't'''
+        from . import cache
+        from . import config
+
+        try:
+            with open(fd, 'rb') as f:
+                report = f.read().decode('utf-8', 'surrogateescape')
+        except OSError:
+            return
+
+        for line in report.splitlines():
+            kind, _, path = line.partition('\t')
+            try:
+                if kind == 'cache':
+                    cache.load_path(path)
+                elif kind == 'config':
+                    config.load_config(path)
+            except (config.ConfigError, OSError):
+                pass
+
+    def get_status(self):
+        '''Describe scubad's state and latency counters'''
+        from . import cache
+        from . import config
+        from .version import get_version
+
+        def ms(total, n=1):
+            return '{:.1f} ms'.format(1000.0 * total / n) if n else '-'
+
+        return '\n'.join([
+            'scubad {} (pid {}), up {:.0f}s'.format(get_version(), os.getpid(),
+                    time.time() - self.started),
+            'Invocations: {} ({} running)'.format(self.requests, len(self.jobs)),
+            'Dispatch latency: {} average, {} max'.format(
+                    ms(self.dispatch_total, self.requests), ms(self.dispatch_max)),
+            'Total time: {} average, {} max'.format(
+                    ms(self.run_total, self.requests), ms(self.run_max)),
+            'In memory: {} config(s), {} cache file(s)'.format(
+                    len(config.get_loaded_paths()), len(cache.get_memory_paths())),
+        ]) + '\n'
+
+
+def main(argv=None):
+    import argparse
+    ap = argparse.ArgumentParser(prog='scubad',
+            description='Run scuba invocations forwarded by the scuba command, '
+                        'until stopped (by SIGTERM or `scuba-admin daemon stop`)')
+    ap.parse_args(argv)
+
+    path = get_socket_path()
+    if not path:
+        sys.exit('scubad: No runtime directory is available')
+    if is_running():
+        sys.exit('scubad: Already running')
+
+    Server(path).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,661 @@
+# Docker Engine API client
+#
+# Running the docker CLI costs tens of milliseconds (and tens of MB of RSS)
+# before it does any work. When the Docker daemon is reachable over a local
+# UNIX socket, dockerutil talks to its HTTP API directly instead, using this
+# client. The docker CLI is still used when the API can't be: for remote
+# daemons and docker contexts, registries which need credential helpers, and
+# `docker run` command lines using options this client doesn't translate
+# (e.g. --tty, or arbitrary --docker-arg options).
+#
+# NOTE: http.client, socket, json, etc. are imported lazily, so that importing
+# this module is cheap.
+import os
+
+from . import dockerutil
+from . import trace
+from .utils import parse_bool_flag
+
+# Where the Docker daemon listens by default
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+# Setting this environment variable to "cli" disables the API client
+BACKEND_ENV_VAR = 'SCUBA_DOCKER_BACKEND'
+
+# Registry key used by the docker CLI config for Docker Hub
+DOCKER_HUB_REGISTRY = 'https://index.docker.io/v1/'
+
+# Signals forwarded to the container, like `docker run --sig-proxy`
+FORWARDED_SIGNALS = ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT', 'SIGUSR1', 'SIGUSR2')
+
+
+class Unsupported(Exception):
+    '''The API client can't perform an operation; the docker CLI must be used
+
+    This is only raised before anything has been done, so the operation can
+    be safely retried using the CLI.
+    '''
+    pass
+
+
+def _docker_config():
+    '''Load the docker CLI's config.json
+
+    Returns: The config, or an empty dict if it can't be read
+    '''
+    import json
+    config_dir = os.getenv('DOCKER_CONFIG') or os.path.join(os.path.expanduser('~'), '.docker')
+    try:
+        with open(os.path.join(config_dir, 'config.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _socket_path():
+    '''Get the path of the socket the docker CLI would connect to
+
+    Returns: The path, or None if the CLI would connect to something other
+             than a local UNIX socket.
+    '''
+    host = os.getenv('DOCKER_HOST')
+    if host:
+        if host.startswith('unix://'):
+            return host[len('unix://'):]
+        return None
+
+    context = os.getenv('DOCKER_CONTEXT') or _docker_config().get('currentContext')
+    if context not in (None, '', 'default'):
+        return None
+
+    return DEFAULT_SOCKET
+
+def get_client():
+    '''Get an API client for the Docker daemon
+
+    Returns: An APIClient, or None if the docker CLI should be used
+    '''
+    if os.getenv(BACKEND_ENV_VAR) == 'cli':
+        return None
+
+    path = _socket_path()
+    if not path or not os.path.exists(path):
+        return None
+    return APIClient(path)
+
+
+def _split_ref(image):
+    '''Split an image reference into the name and tag (or digest) to pull'''
+    if '@' in image:
+        return image.split('@', 1)
+    name, sep, tag = image.rpartition(':')
+    if sep and not '/' in tag:
+        return name, tag
+    return image, 'latest'
+
+def _registry_auth(image):
+    '''Get the X-Registry-Auth header for pulling an image
+
+    Returns: The header value, or None if no credentials are configured
+
+    Raises Unsupported if the credentials must be obtained from a credential
+    helper.
+    '''
+    import base64
+    import json
+
+    first, sep, _ = image.partition('/')
+    if sep and ('.' in first or ':' in first or first == 'localhost'):
+        registry = first
+    else:
+        registry = DOCKER_HUB_REGISTRY
+
+    config = _docker_config()
+    if config.get('credsStore') or registry in config.get('credHelpers', {}):
+        raise Unsupported('Registry credentials are provided by a helper')
+
+    auth = config.get('auths', {}).get(registry, {}).get('auth')
+    if not auth:
+        return None
+
+    username, _, password = base64.b64decode(auth).decode('utf-8').partition(':')
+    data = json.dumps(dict(username=username, password=password, serveraddress=registry))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def parse_run_args(args):
+    '''Translate a `docker run` command line into a container config
+
+    Only the options which scuba itself generates are understood.
+
+    Returns: A (config, remove, cidfile) tuple, where config is the body
+             for POST /containers/create, remove indicates whether the
+             container should be removed after it exits, and cidfile is the
+             file to write its ID to (or None). Returns None if the command
+             line uses any other options.
+    '''
+    if list(args[:2]) != ['docker', 'run']:
+        return None
+
+    env = []
+    binds = []
+    labels = {}
+    tmpfs = {}
+    host_config = dict(Binds=binds)
+    config = dict(
+        AttachStdin = False,
+        AttachStdout = True,
+        AttachStderr = True,
+        OpenStdin = False,
+        StdinOnce = False,
+        Tty = False,
+        Env = env,
+        Labels = labels,
+        HostConfig = host_config,
+    )
+    remove = False
+    cidfile = None
+
+    it = iter(args[2:])
+    for a in it:
+        if a == '-i':
+            config['AttachStdin'] = config['OpenStdin'] = config['StdinOnce'] = True
+        elif a == '--rm':
+            remove = True
+        elif a.startswith('--env=') and '=' in a[len('--env='):]:
+            env.append(a[len('--env='):])
+        elif a.startswith('--volume='):
+            binds.append(a[len('--volume='):])
+        elif a.startswith('--label='):
+            k, _, v = a[len('--label='):].partition('=')
+            labels[k] = v
+        elif a.startswith('--cidfile='):
+            cidfile = a[len('--cidfile='):]
+        elif a.startswith('--tmpfs='):
+            path, _, opts = a[len('--tmpfs='):].partition(':')
+            tmpfs[path] = opts
+            host_config['Tmpfs'] = tmpfs
+        elif a.startswith('--read-only'):
+            try:
+                read_only = parse_bool_flag(a, '--read-only')
+            except ValueError:
+                return None
+            if read_only is None:
+                return None
+            host_config['ReadonlyRootfs'] = read_only
+        elif a == '-w':
+            config['WorkingDir'] = next(it, '')
+        elif a.startswith('--entrypoint='):
+            config['Entrypoint'] = [a[len('--entrypoint='):]]
+        elif a.startswith('-'):
+            return None
+        else:
+            config['Image'] = a
+            config['Cmd'] = list(it)
+            return config, remove, cidfile
+
+    # No image
+    return None
+
+
+class APIClient(object):
+    '''A client for the Docker Engine API, over a UNIX socket'''
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def _connect(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise Unsupported('Failed to connect to {}: {}'.format(self.socket_path, e.strerror))
+        return sock
+
+    def _request(self, method, path, params=None, body=None, headers=None, data=None):
+        '''Make a request to the API
+
+        The request body is either body (encoded as JSON), or data (bytes, or
+        a binary file which is sent in chunks).
+
+        Returns: The http.client.HTTPResponse
+
+        Raises DockerError if the request fails (with a status other than 404),
+        or Unsupported if the daemon can't be connected to.
+        '''
+        import http.client
+        import json
+        from urllib.parse import urlencode, quote
+
+        url = quote(path, safe='/:@')
+        if params:
+            url += '?' + urlencode(params)
+
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = data
+
+        conn = http.client.HTTPConnection('localhost')
+        conn.sock = self._connect()
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise dockerutil.DockerError('Docker API request failed: {}'.format(e))
+
+        if resp.status >= 400 and resp.status != 404:
+            raise dockerutil.DockerError('Docker API request failed: {}'.format(_error_message(resp)))
+        return resp
+
+    def _json(self, method, path, **kw):
+        '''Make a request to the API, and return the decoded JSON response'''
+        import json
+        resp = self._request(method, path, **kw)
+        if resp.status == 404:
+            raise dockerutil.DockerError('Docker API request failed: {}'.format(_error_message(resp)))
+        data = resp.read()
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def info(self):
+        '''Get system-wide information, like `docker info`'''
+        with trace.span('docker info', cat='docker-api'):
+            return self._json('GET', '/info')
+
+    def inspect_image(self, image):
+        '''Inspect an image, like `docker inspect --type image`
+
+        Raises NoSuchImageError if the image does not exist.
+        '''
+        import json
+        with trace.span('docker inspect', cat='docker-api'):
+            resp = self._request('GET', '/images/{}/json'.format(image))
+            if resp.status == 404:
+                resp.read()
+                raise dockerutil.NoSuchImageError(image)
+            return json.loads(resp.read().decode('utf-8'))
+
+    def pull_image(self, image, out):
+        '''Pull an image, like `docker pull`, writing progress to out'''
+        import json
+        name, tag = _split_ref(image)
+        headers = {}
+        auth = _registry_auth(image)
+        if auth:
+            headers['X-Registry-Auth'] = auth
+
+        with trace.span('docker pull', cat='docker-api'):
+            resp = self._request('POST', '/images/create',
+                    params=dict(fromImage=name, tag=tag), headers=headers)
+            if resp.status == 404:
+                raise dockerutil.DockerError('Failed to pull image "{}": {}'.format(
+                    image, _error_message(resp)))
+
+            for line in resp:
+                if not line.strip():
+                    continue
+                msg = json.loads(line.decode('utf-8'))
+                if 'error' in msg:
+                    raise dockerutil.DockerError('Failed to pull image "{}": {}'.format(
+                        image, msg['error']))
+
+                # Progress bars are not shown
+                if msg.get('progressDetail') or not msg.get('status'):
+                    continue
+                if msg.get('id'):
+                    print('{}: {}'.format(msg['id'], msg['status']), file=out)
+                else:
+                    print(msg['status'], file=out)
+
+    def save_images(self, images):
+        '''Save images, like `docker save`
+
+        Returns: A binary file from which the tar archive is read
+        '''
+        with trace.span('docker save', cat='docker-api'):
+            resp = self._request('GET', '/images/get', params=[('names', i) for i in images])
+        if resp.status == 404:
+            raise dockerutil.DockerError('Failed to save images: {}'.format(_error_message(resp)))
+        return resp
+
+    def load_images(self, fileobj):
+        '''Load images from a tar archive, like `docker load`'''
+        import json
+        with trace.span('docker load', cat='docker-api'):
+            resp = self._request('POST', '/images/load', params=dict(quiet='1'),
+                    data=fileobj, headers={'Content-Type': 'application/x-tar'})
+            if resp.status == 404:
+                raise dockerutil.DockerError('Failed to load images: {}'.format(
+                    _error_message(resp)))
+            for line in resp:
+                if not line.strip():
+                    continue
+                msg = json.loads(line.decode('utf-8'))
+                if 'error' in msg:
+                    raise dockerutil.DockerError('Failed to load images: {}'.format(msg['error']))
+
+    def tag_image(self, image, ref):
+        '''Tag an image, like `docker tag`'''
+        repo, tag = _split_ref(ref)
+        resp = self._request('POST', '/images/{}/tag'.format(image),
+                params=dict(repo=repo, tag=tag))
+        resp.read()
+        if resp.status == 404:
+            raise dockerutil.NoSuchImageError(image)
+
+    def remove_image(self, image):
+        '''Remove an image (or one of its tags), like `docker rmi`'''
+        with trace.span('docker rmi', cat='docker-api'):
+            resp = self._request('DELETE', '/images/{}'.format(image))
+        resp.read()
+        if resp.status == 404:
+            raise dockerutil.NoSuchImageError(image)
+
+    def list_containers(self, all=False, filters=None):
+        '''List containers, like `docker ps`
+
+        Args:
+            all: Whether to include containers which aren't running
+            filters: A dict of filter names to lists of values
+        '''
+        import json
+        params = dict(all=int(all))
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self._json('GET', '/containers/json', params=params)
+
+    def inspect_container(self, cid):
+        '''Inspect a container
+
+        Returns: The container details, or None if it doesn't exist
+        '''
+        import json
+        resp = self._request('GET', '/containers/{}/json'.format(cid))
+        data = resp.read()
+        if resp.status == 404:
+            return None
+        return json.loads(data.decode('utf-8'))
+
+    def remove_container(self, cid, force=False):
+        '''Remove a container and its volumes, like `docker rm -v`
+
+        A running container is only removed (killing it) if force is True.
+        '''
+        with trace.span('docker rm', cat='docker-api'):
+            resp = self._request('DELETE', '/containers/{}'.format(cid),
+                    params=dict(v=1, force=int(force)))
+        resp.read()
+        if resp.status >= 400:
+            raise dockerutil.DockerError('Failed to remove container {}: {}'.format(
+                cid, _error_message(resp)))
+
+    def get_archive(self, cid, path):
+        '''Get a file (or directory) from a container, like `docker cp CID:PATH -`
+
+        Returns: A tar archive of it (bytes), or None if it doesn't exist
+        '''
+        with trace.span('docker cp', cat='docker-api'):
+            resp = self._request('GET', '/containers/{}/archive'.format(cid),
+                    params=dict(path=path))
+            data = resp.read()
+        if resp.status == 404:
+            return None
+        return data
+
+    def list_images(self):
+        '''List images, like `docker images`
+
+        Returns: A list of image dicts, each with RepoTags
+        '''
+        with trace.span('docker images', cat='docker-api'):
+            return self._json('GET', '/images/json')
+
+    def create(self, args):
+        '''Create a container, like `docker create`
+
+        The image must exist.
+
+        Args:
+            args: The `docker run` command line (see parse_run_args)
+
+        Returns: The ID of the container
+
+        Raises Unsupported if the command line can't be translated.
+        '''
+        spec = parse_run_args(args)
+        if not spec:
+            raise Unsupported('Unsupported docker run options')
+        config, _, cidfile = spec
+
+        with trace.span('docker create', cat='docker-api'):
+            cid = self._json('POST', '/containers/create', body=config)['Id']
+        if cidfile:
+            with open(cidfile, 'w') as f:
+                f.write(cid)
+        return cid
+
+    def run(self, args, stdin, stdout, stderr, cid=None):
+        '''Run a container, like `docker run`
+
+        Args:
+            args: The `docker run` command line (see parse_run_args)
+            cid: The ID of a container created from args (see create), which
+                 is started rather than creating one
+
+        Returns: The container's exit status
+
+        Raises Unsupported if the command line can't be translated.
+        '''
+        spec = parse_run_args(args)
+        if not spec:
+            raise Unsupported('Unsupported docker run options')
+        config, remove, cidfile = spec
+
+        # Output is written directly to the file descriptors
+        try:
+            stdin_fd = stdin.fileno() if config['AttachStdin'] else None
+            output_fds = {1: stdout.fileno(), 2: stderr.fileno()}
+        except (AttributeError, ValueError):
+            raise Unsupported('Standard streams have no file descriptors')
+        stdout.flush()
+        stderr.flush()
+
+        with trace.span('docker run', cat='docker-api'):
+            if not cid:
+                cid = self._create_container(config, stderr)
+                if cidfile:
+                    with open(cidfile, 'w') as f:
+                        f.write(cid)
+            try:
+                sock, data = self._attach(cid, config['AttachStdin'])
+                try:
+                    self._json('POST', '/containers/{}/start'.format(cid))
+                    with _SignalForwarder(self, cid):
+                        _pump(sock, data, stdin_fd, output_fds)
+                finally:
+                    sock.close()
+
+                return self._json('POST', '/containers/{}/wait'.format(cid))['StatusCode']
+            except Unsupported as e:
+                # The container may have run; it must not be run again by the CLI
+                raise dockerutil.DockerError(str(e))
+            finally:
+                if remove:
+                    self._remove_container(cid)
+
+    def _create_container(self, config, stderr):
+        '''Create a container, pulling its image if it doesn't exist'''
+        import json
+        resp = self._request('POST', '/containers/create', body=config)
+        if resp.status != 404:
+            return json.loads(resp.read().decode('utf-8'))['Id']
+        resp.read()
+
+        # Like `docker run`, pull the image if it doesn't exist, reporting
+        # progress on stderr (which may be a binary file). Pulls are
+        # coordinated with other processes (see docker_pull_missing).
+        image = config['Image']
+        with dockerutil.pull_lock(image):
+            resp = self._request('POST', '/containers/create', body=config)
+            if resp.status != 404:
+                return json.loads(resp.read().decode('utf-8'))['Id']
+            resp.read()
+
+            stderr.flush()
+            with open(stderr.fileno(), 'w', closefd=False) as out:
+                print('Unable to find image \'{}\' locally'.format(image), file=out)
+                self.pull_image(image, out)
+
+        return self._json('POST', '/containers/create', body=config)['Id']
+
+    def _remove_container(self, cid):
+        try:
+            self._request('DELETE', '/containers/{}'.format(cid),
+                    params=dict(v=1, force=1)).read()
+        except (dockerutil.DockerError, Unsupported):
+            pass
+
+    def _attach(self, cid, with_stdin):
+        '''Attach to a container's streams
+
+        The connection is "hijacked" from HTTP, so this is done by hand.
+
+        Returns: The socket, and any stream data already received
+        '''
+        from urllib.parse import urlencode
+        params = dict(stream=1, stdout=1, stderr=1, stdin=int(with_stdin))
+        request = ('POST /containers/{}/attach?{} HTTP/1.1\r\n'
+                   'Host: localhost\r\n'
+                   'Connection: Upgrade\r\n'
+                   'Upgrade: tcp\r\n'
+                   'Content-Length: 0\r\n'
+                   '\r\n').format(cid, urlencode(params))
+
+        sock = self._connect()
+        try:
+            sock.sendall(request.encode('ascii'))
+            data = b''
+            while not b'\r\n\r\n' in data:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise dockerutil.DockerError('Failed to attach to container: connection closed')
+                data += chunk
+        except OSError as e:
+            sock.close()
+            raise dockerutil.DockerError('Failed to attach to container: {}'.format(e))
+
+        header, data = data.split(b'\r\n\r\n', 1)
+        status = header.split(b' ', 2)[1]
+        if status not in (b'101', b'200'):
+            sock.close()
+            raise dockerutil.DockerError('Failed to attach to container: {}'.format(
+                header.split(b'\r\n', 1)[0].decode('ascii', 'replace')))
+        return sock, data
+
+    def kill(self, cid, signame):
+        '''Send a signal to a container'''
+        self._request('POST', '/containers/{}/kill'.format(cid),
+                params=dict(signal=signame)).read()
+
+
+def _error_message(resp):
+    '''Get the error message from an API error response'''
+    import json
+    data = resp.read()
+    try:
+        return json.loads(data.decode('utf-8'))['message']
+    except (ValueError, KeyError, TypeError):
+        return '{} {}'.format(resp.status, resp.reason)
+
+
+def _pump(sock, data, stdin_fd, output_fds):
+    '''Copy stdin to an attached container, and its output to stdout/stderr
+
+    Args:
+        sock: The attached socket
+        data: Data already received from the socket
+        stdin_fd: The file descriptor to copy to the container's stdin, or None
+        output_fds: The file descriptors to copy the container's stdout (1)
+                    and stderr (2) to
+
+    Returns when the container's output ends (i.e. it exits).
+    '''
+    import socket
+    import threading
+
+    if stdin_fd is not None:
+        def copy_stdin(fd=stdin_fd):
+            try:
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    sock.sendall(chunk)
+                # Close the container's stdin
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                # The container exited
+                pass
+
+        # This thread is not joined, as it may be blocked reading stdin (e.g.
+        # a terminal) after the container has exited.
+        threading.Thread(target=copy_stdin, daemon=True).start()
+
+    def read(n):
+        nonlocal data
+        while len(data) < n:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return None
+            data += chunk
+        result, data = data[:n], data[n:]
+        return result
+
+    # Output is multiplexed in frames, each with an 8-byte header
+    while True:
+        header = read(8)
+        if header is None:
+            break
+        payload = read(int.from_bytes(header[4:8], 'big'))
+        if payload is None:
+            break
+
+        fd = output_fds.get(header[0])
+        while fd is not None and payload:
+            payload = payload[os.write(fd, payload):]
+
+
+class _SignalForwarder(object):
+    '''Forwards signals received by scuba to a container, like the docker CLI'''
+
+    def __init__(self, client, cid):
+        self.client = client
+        self.cid = cid
+        self.saved = {}
+
+    def _handler(self, signum, frame):
+        import signal
+        try:
+            self.client.kill(self.cid, signal.Signals(signum).name)
+        except (dockerutil.DockerError, Unsupported):
+            pass
+
+    def __enter__(self):
+        import signal
+        import threading
+        if threading.current_thread() is not threading.main_thread():
+            return self
+        for name in FORWARDED_SIGNALS:
+            signum = getattr(signal, name)
+            self.saved[signum] = signal.signal(signum, self._handler)
+        return self
+
+    def __exit__(self, *exc_info):
+        import signal
+        for signum, handler in self.saved.items():
+            signal.signal(signum, handler)
+        self.saved = {}
@@ -1,6 +1,16 @@
-import subprocess
 import errno
-import json
+from contextlib import contextmanager
+import os
+import sys
+
+from . import trace
+
+# NOTE: subprocess and json are imported lazily, as they are relatively
+# expensive to import, and not every scuba invocation needs to run docker.
+#
+# When the Docker daemon is reachable over a local socket, its API is used
+# (see dockerapi), rather than running the docker CLI. dockerapi is also
+# imported lazily, as it imports this module.
 
 class DockerError(Exception):
     pass
@@ -27,11 +37,79 @@ def __wrap_docker_exec(func):
             raise
     return wrapper
 
-call = __wrap_docker_exec(subprocess.call)
+@trace.traced('dockerutil.call')
+def call(*args, **kwargs):
+    '''Call docker (via subprocess.call) and raise DockerExecuteError on ENOENT'''
+    import subprocess
+    return __wrap_docker_exec(subprocess.call)(*args, **kwargs)
+
+
+def exec_run(args):
+    '''Replace this process with docker, given its command line
+
+    Only returns (by raising DockerExecuteError) if docker can't be executed.
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    __wrap_docker_exec(os.execvp)(args[0], args)
+
+
+def run(args, stdin, stdout, stderr, cid=None):
+    '''Run a container, given a `docker run` command line
+
+    Args:
+        cid: The ID of a container created from args (see docker_create),
+             which is started rather than creating one
+
+    Returns: The container's exit status
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.run(args, stdin, stdout, stderr, cid=cid)
+        except dockerapi.Unsupported:
+            pass
+
+    if not cid:
+        return call(args=args, stdin=stdin, stdout=stdout, stderr=stderr)
+
+    start_args = ['docker', 'start', '--attach']
+    if '-i' in args:
+        start_args.append('--interactive')
+    rc = call(args=start_args + [cid], stdin=stdin, stdout=stdout, stderr=stderr)
+    if '--rm' in args:
+        # (Unless it was created by the docker CLI, which removes it itself)
+        try:
+            docker_rm(cid)
+        except DockerError:
+            pass
+    return rc
+
+def docker_create(args):
+    '''Create a container, given a `docker run` command line
+
+    The image must exist.
+
+    Returns: The ID of the container
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.create(args)
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('create', *args[2:], capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to create container: {}'.format(cp.stderr.strip()))
+    return cp.stdout.strip()
 
 
 def _run_docker(*args, capture=False):
     '''Run docker and raise DockerExecuteError on ENOENT'''
+    import subprocess
     args = ['docker'] + list(args)
     kw = dict(
             universal_newlines=True,    # TODO: Use 'text' in Python 3.7+
@@ -42,7 +120,73 @@ def _run_docker(*args, capture=False):
                 stderr=subprocess.PIPE,
                 )
 
-    return __wrap_docker_exec(subprocess.run)(args, **kw)
+    with trace.span('docker ' + args[1], cat='docker', argv=args[1:]):
+        return __wrap_docker_exec(subprocess.run)(args, **kw)
+
+
+def read_image_files(image, paths):
+    '''Read files from an image, without running it
+
+    Symbolic links are followed.
+
+    Returns: A dict of the content (bytes) of each file, by path, which is None
+             for files which don't exist in the image
+    '''
+    from . import dockerapi
+
+    # (The command is never run)
+    cid = docker_create(['docker', 'run', '--entrypoint=', image, 'true'])
+    try:
+        client = dockerapi.get_client()
+        return {path: _read_container_file(client, cid, path) for path in paths}
+    finally:
+        docker_rm(cid)
+
+# Maximum number of symbolic links followed by _read_container_file
+MAX_SYMLINKS = 8
+
+def _read_container_file(client, cid, path):
+    import io
+    import posixpath
+    import tarfile
+
+    for _ in range(MAX_SYMLINKS):
+        data = _get_archive(client, cid, path)
+        if data is None:
+            return None
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            member = tar.next()
+            if member is None:
+                return None
+            if member.issym():
+                path = posixpath.normpath(posixpath.join(posixpath.dirname(path),
+                        member.linkname))
+                continue
+            if not member.isfile():
+                return None
+            return tar.extractfile(member).read()
+    raise DockerError('Too many levels of symbolic links: {}'.format(path))
+
+def _get_archive(client, cid, path):
+    '''Get a tar archive of a file in a container, or None if it doesn't exist'''
+    from . import dockerapi
+    if client:
+        try:
+            return client.get_archive(cid, path)
+        except dockerapi.Unsupported:
+            pass
+
+    import subprocess
+    args = ['docker', 'cp', '{}:{}'.format(cid, path), '-']
+    with trace.span('docker cp', cat='docker', argv=args[1:]):
+        cp = __wrap_docker_exec(subprocess.run)(args,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if cp.returncode != 0:
+        stderr = cp.stderr.decode('utf-8', 'replace').strip()
+        if 'No such container:path' in stderr or 'Could not find the file' in stderr:
+            return None
+        raise DockerError('Failed to copy {} from container: {}'.format(path, stderr))
+    return cp.stdout
 
 
 def docker_inspect(image):
@@ -50,6 +194,14 @@ def docker_inspect(image):
 
     Returns: Parsed JSON data
     '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.inspect_image(image)
+        except dockerapi.Unsupported:
+            pass
+
     cp = _run_docker('inspect', '--type', 'image', image, capture=True)
 
     if not cp.returncode == 0:
@@ -57,14 +209,143 @@ def docker_inspect(image):
             raise NoSuchImageError(image)
         raise DockerError('Failed to inspect image: {}'.format(cp.stderr.strip()))
 
+    import json
     return json.loads(cp.stdout)[0]
 
-def docker_pull(image):
-    '''Pulls an image'''
-    # If this fails, the default docker stdout/stderr looks good to the user.
-    cp = _run_docker('pull', image)
+def uses_containerd_store():
+    '''Determine whether the Docker daemon keeps its images in containerd'''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            status = client.info().get('DriverStatus')
+        except dockerapi.Unsupported:
+            client = None
+
+    if not client:
+        cp = _run_docker('info', '--format', '{{json .DriverStatus}}', capture=True)
+        if cp.returncode != 0:
+            raise DockerError('Failed to get docker info: {}'.format(cp.stderr.strip()))
+        import json
+        try:
+            status = json.loads(cp.stdout)
+        except ValueError:
+            raise DockerError('Failed to get docker info: Invalid output')
+
+    return any('io.containerd.snapshotter' in str(value)
+               for pair in status or () for value in pair)
+
+def docker_inspect_many(images):
+    '''Inspects several docker images at once
+
+    Returns: A dict of the parsed JSON data of each image, by name, or None
+             for images which do not exist
+    '''
+    images = list(dict.fromkeys(images))
+    if not images:
+        return {}
+
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            result = {}
+            for image in images:
+                try:
+                    result[image] = client.inspect_image(image)
+                except NoSuchImageError:
+                    result[image] = None
+            return result
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('inspect', '--type', 'image', *images, capture=True)
+
+    # docker inspects the images which exist, and reports the others
+    missing = set()
+    marker = 'no such image: '
+    for line in cp.stderr.splitlines():
+        pos = line.lower().find(marker)
+        if pos < 0:
+            continue
+        name = line[pos + len(marker):].strip()
+        if not name in images:
+            raise DockerError('Failed to inspect images: {}'.format(line.strip()))
+        missing.add(name)
+
+    if cp.returncode != 0 and not missing:
+        raise DockerError('Failed to inspect images: {}'.format(cp.stderr.strip()))
+
+    import json
+    found = [i for i in images if not i in missing]
+    infos = json.loads(cp.stdout) if found else []
+    if len(infos) != len(found):
+        raise DockerError('Failed to inspect images: Expected {} results, got {}'.format(
+            len(found), len(infos)))
+
+    result = dict.fromkeys(missing)
+    result.update(zip(found, infos))
+    return result
+
+def docker_pull(image, out=None):
+    '''Pulls an image
+
+    Args:
+        image: The image to pull
+        out: A text file to which progress is written. If not given, it is
+             shown on stdout.
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.pull_image(image, out or sys.stdout)
+        except dockerapi.Unsupported:
+            pass
+
+    if out is None:
+        # If this fails, the default docker stdout/stderr looks good to the user.
+        cp = _run_docker('pull', image)
+        if cp.returncode != 0:
+            raise DockerError('Failed to pull image "{}"'.format(image))
+        return
+
+    cp = _run_docker('pull', image, capture=True)
+    out.write(cp.stdout)
     if cp.returncode != 0:
-        raise DockerError('Failed to pull image "{}"'.format(image))
+        raise DockerError('Failed to pull image "{}": {}'.format(image, cp.stderr.strip()))
+
+def pull_lock(image):
+    '''Get a lock which serializes pulls of an image between processes'''
+    import hashlib
+    from .runtime import FileLock
+    key = '{}\0{}'.format(os.getenv('DOCKER_HOST', ''), image)
+    return FileLock(
+            'pull-{}.lock'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()),
+            wait_msg='Waiting for another process to pull "{}"'.format(image))
+
+def docker_pull_missing(image, out=None):
+    '''Pulls an image which doesn't exist
+
+    Many scuba processes (e.g. from `make -j`) may try to pull the same image
+    at once. Only one of them pulls it; the others wait for it, and then use
+    the image it pulled.
+
+    Args:
+        image: The image to pull
+        out: A text file to which progress is written (see docker_pull)
+
+    Returns: The parsed JSON data of the image
+    '''
+    with pull_lock(image):
+        try:
+            # Another process may have pulled it while we waited
+            return docker_inspect(image)
+        except NoSuchImageError:
+            pass
+
+        docker_pull(image, out)
+        return docker_inspect(image)
 
 def docker_inspect_or_pull(image):
     '''Inspects a docker image, pulling it if it doesn't exist'''
@@ -72,8 +353,183 @@ def docker_inspect_or_pull(image):
         return docker_inspect(image)
     except NoSuchImageError:
         # If it doesn't exist yet, try to pull it now (#79)
-        docker_pull(image)
-        return docker_inspect(image)
+        return docker_pull_missing(image)
+
+
+
+@contextmanager
+def docker_save(images):
+    '''Saves images to a tar archive, like `docker save`
+
+    Layers shared between the images are only included once.
+
+    Yields: A binary file from which the archive is read
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            resp = client.save_images(images)
+        except dockerapi.Unsupported:
+            pass
+        else:
+            with resp:
+                yield resp
+            return
+
+    import subprocess
+    args = ['docker', 'save'] + list(images)
+    with trace.span('docker save', cat='docker', argv=args[1:]):
+        with __wrap_docker_exec(subprocess.Popen)(args,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+            yield p.stdout
+            p.stdout.close()
+            stderr = p.stderr.read().decode('utf-8', 'replace')
+    if p.returncode != 0:
+        raise DockerError('Failed to save images: {}'.format(stderr.strip()))
+
+def docker_load(fileobj):
+    '''Loads images from a tar archive, like `docker load`
+
+    Args:
+        fileobj: A binary file from which the archive is read. For the docker
+                 CLI, it must be a real file (or pipe).
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.load_images(fileobj)
+        except dockerapi.Unsupported:
+            pass
+
+    import subprocess
+    args = ['docker', 'load', '--quiet']
+    with trace.span('docker load', cat='docker', argv=args[1:]):
+        cp = __wrap_docker_exec(subprocess.run)(args, stdin=fileobj,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if cp.returncode != 0:
+        raise DockerError('Failed to load images: {}'.format(
+            cp.stderr.decode('utf-8', 'replace').strip()))
+
+def docker_tag(image, ref):
+    '''Tags an image (e.g. by ID) with a reference, like `docker tag`'''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.tag_image(image, ref)
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('tag', image, ref, capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to tag image "{}": {}'.format(image, cp.stderr.strip()))
+
+
+def docker_rmi(image):
+    '''Removes an image (or one of its tags), like `docker rmi`'''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.remove_image(image)
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('rmi', image, capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to remove image "{}": {}'.format(image, cp.stderr.strip()))
+
+def get_running_image_ids():
+    '''Get the IDs of the images used by running containers
+
+    Returns: A set of image IDs
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return {c['ImageID'] for c in client.list_containers()}
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('ps', '--quiet', '--no-trunc', capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to list containers: {}'.format(cp.stderr.strip()))
+    containers = cp.stdout.split()
+    if not containers:
+        return set()
+
+    cp = _run_docker('inspect', '--type', 'container', '--format', '{{.Image}}',
+            *containers, capture=True)
+    # Containers which exited in the meantime are missing from the output
+    return set(cp.stdout.split())
+
+
+def docker_rm(cid, force=False):
+    '''Removes a container and its volumes, like `docker rm -v`
+
+    A running container is only removed (killing it) if force is True.
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return client.remove_container(cid, force=force)
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('rm', '--volumes', *(['--force'] if force else []), cid, capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to remove container {}: {}'.format(cid, cp.stderr.strip()))
+
+def is_container_running(cid):
+    '''Determine whether a container exists, and is running'''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            info = client.inspect_container(cid)
+            return bool(info and info['State']['Running'])
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('inspect', '--type', 'container', '--format', '{{.State.Running}}',
+            cid, capture=True)
+    return cp.returncode == 0 and cp.stdout.strip() == 'true'
+
+def run_detached(args):
+    '''Start a container in the background, given a `docker run --detach` command line
+
+    Returns: The ID of the container
+    '''
+    cp = _run_docker(*args[1:], capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to start container: {}'.format(cp.stderr.strip()))
+    return cp.stdout.strip()
+
+def get_stopped_containers(label):
+    '''Get the IDs of the containers with a label which have exited
+
+    Returns: A list of container IDs
+    '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return [c['Id'] for c in client.list_containers(all=True,
+                    filters=dict(label=[label], status=['exited', 'dead']))]
+        except dockerapi.Unsupported:
+            pass
+
+    cp = _run_docker('ps', '--all', '--quiet', '--no-trunc',
+            '--filter', 'label=' + label,
+            '--filter', 'status=exited', '--filter', 'status=dead',
+            capture=True)
+    if cp.returncode != 0:
+        raise DockerError('Failed to list containers: {}'.format(cp.stderr.strip()))
+    return cp.stdout.split()
 
 
 def get_images():
@@ -81,6 +537,14 @@ def get_images():
 
     Returns: List of image names
     '''
+    from . import dockerapi
+    client = dockerapi.get_client()
+    if client:
+        try:
+            return _image_names(client.list_images())
+        except dockerapi.Unsupported:
+            pass
+
     cp = _run_docker('images',
         # This format ouputs the same thing as '__docker_images --repo --tag'
         '--format', (
@@ -98,21 +562,29 @@ def get_images():
     return cp.stdout.splitlines()
 
 
+def _image_names(images):
+    '''Get image names from the API's image list, like get_images()'''
+    names = []
+    for info in images:
+        for repotag in info.get('RepoTags') or []:
+            repo, _, tag = repotag.rpartition(':')
+            if repo == '<none>':
+                continue
+            names.append(repo)
+            if tag != '<none>':
+                names.append(repotag)
+    return names
+
+
 def get_image_command(image):
-    '''Gets the default command for an image'''
-    info = docker_inspect_or_pull(image)
-    try:
-        return info['Config']['Cmd']
-    except KeyError as ke:
-        raise DockerError('Failed to inspect image: JSON result missing key {}'.format(ke))
+    '''Gets the default command for an image (see imagecache)'''
+    from . import imagecache
+    return imagecache.get_image_command(image)
 
 def get_image_entrypoint(image):
-    '''Gets the image entrypoint'''
-    info = docker_inspect_or_pull(image)
-    try:
-        return info['Config']['Entrypoint']
-    except KeyError as ke:
-        raise DockerError('Failed to inspect image: JSON result missing key {}'.format(ke))
+    '''Gets the image entrypoint (see imagecache)'''
+    from . import imagecache
+    return imagecache.get_image_entrypoint(image)
 
 
 def make_vol_opt(hostdir, contdir, options=None):
@@ -0,0 +1,236 @@
+# Cache of docker image metadata
+#
+# Running `docker inspect` takes 50-150 ms, and a single scuba invocation may
+# need several pieces of an image's metadata (its entrypoint, default command,
+# and ID). The relevant parts of the metadata are kept in memory, so that an
+# image is inspected at most once per process, and on disk, so that they can
+# be reused by later invocations as long as the image is unchanged.
+#
+# Whether an image is unchanged is determined from dockerd's image repository
+# database, if it is readable (e.g. by root). It is not used if dockerd keeps
+# its images in containerd instead, as the database is then never updated.
+# Otherwise, inspecting an image through the Engine API is cheap, so the cached
+# metadata is only used (for a short time) when the docker CLI is used.
+import os
+import time
+
+from . import cache
+from . import dockerutil
+
+IMAGES_CACHE = 'images.json'
+
+# Maximum number of images kept in the cache
+IMAGES_CACHE_MAX_ENTRIES = 1000
+
+# Maximum age (in seconds) of cached metadata, when the image store can't be
+# used and the docker CLI is used
+IMAGES_CACHE_TTL = 10
+
+# Where dockerd keeps its image repository database
+DOCKER_IMAGE_DB = '/var/lib/docker/image'
+
+# Whether dockerd uses the containerd image store, with the stamp of the
+# daemon's socket (which is re-created when it restarts)
+STORE_TYPE_CACHE = 'image-store.json'
+
+# Image metadata inspected by this process, by (host, image)
+_inspected = {}
+
+
+def image_store_stamp():
+    '''Get a stamp used to detect changes to the Docker image store
+
+    Returns: A list of stamps of the repository databases for each storage
+             driver, or None if they can not be read (e.g. because the user
+             doesn't have permission, or Docker is remote), or are not used
+             (with the containerd image store).
+    '''
+    if 'DOCKER_HOST' in os.environ:
+        return None
+
+    try:
+        drivers = sorted(os.listdir(DOCKER_IMAGE_DB))
+    except OSError:
+        return None
+
+    stamps = [cache.file_stamp(os.path.join(DOCKER_IMAGE_DB, d, 'repositories.json'))
+              for d in drivers]
+    if not any(stamps):
+        return None
+    if _uses_containerd_store():
+        return None
+    return stamps
+
+def _uses_containerd_store():
+    '''Determine whether the local Docker daemon uses the containerd image store
+
+    The answer is cached until the daemon restarts.
+    '''
+    from . import dockerapi
+    socket_stamp = cache.file_stamp(dockerapi.DEFAULT_SOCKET)
+    entry = cache.load(STORE_TYPE_CACHE)
+    if entry and socket_stamp and entry['socket_stamp'] == socket_stamp:
+        return entry['containerd']
+
+    try:
+        containerd = dockerutil.uses_containerd_store()
+    except dockerutil.DockerError:
+        return True     # Unknown; don't trust the image store
+
+    cache.store(STORE_TYPE_CACHE, dict(socket_stamp=socket_stamp, containerd=containerd))
+    return containerd
+
+
+def _familiar_ref(image):
+    '''Normalize an image reference to the form used by the image store
+
+    e.g. docker.io/library/busybox => busybox:latest
+    '''
+    for prefix in ('docker.io/library/', 'docker.io/'):
+        if image.startswith(prefix):
+            image = image[len(prefix):]
+            break
+
+    name = image.rsplit('/', 1)[-1]
+    if not ':' in name and not '@' in name:
+        image += ':latest'
+    return image
+
+def _image_store_lookup(image):
+    '''Look up the ID of an image in the Docker image store
+
+    Returns: The image ID, or None if it can not be determined
+    '''
+    import json
+    ref = _familiar_ref(image)
+
+    try:
+        drivers = sorted(os.listdir(DOCKER_IMAGE_DB))
+    except OSError:
+        return None
+
+    for d in drivers:
+        try:
+            with open(os.path.join(DOCKER_IMAGE_DB, d, 'repositories.json')) as f:
+                repos = json.load(f)['Repositories']
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+
+        for refs in repos.values():
+            image_id = refs.get(ref)
+            if image_id:
+                return image_id
+    return None
+
+
+def _is_digest_ref(image):
+    # Images referenced by digest are immutable
+    return '@' in image
+
+
+def _load_cached(index, host, image):
+    '''Load the cached metadata of an image, if it is still valid
+
+    Cached metadata is valid if it was obtained for an image referenced by
+    digest, or if the image store (which must be usable) is unchanged or
+    still maps the reference to the same image ID. Without the image store,
+    it is valid for IMAGES_CACHE_TTL seconds, only if the docker CLI is used.
+    '''
+    entry = index.get(host, {}).get(image)
+    if not entry:
+        return None
+
+    info = entry['info']
+    if _is_digest_ref(image):
+        return info
+
+    stamp = image_store_stamp()
+    if stamp is None or entry['store_stamp'] is None:
+        from . import dockerapi
+        if dockerapi.get_client():
+            return None
+        if 0 <= time.time() - entry.get('time', 0) < IMAGES_CACHE_TTL:
+            return info
+        return None
+    if stamp == entry['store_stamp']:
+        return info
+
+    if _image_store_lookup(image) != info['Id']:
+        return None
+
+    # Still valid; avoid looking it up again until the image store changes
+    entry['store_stamp'] = stamp
+    cache.store(IMAGES_CACHE, index)
+    return info
+
+
+def _extract(info):
+    '''Extract the parts of interest from docker_inspect() output'''
+    try:
+        return dict(
+            Id = info['Id'],
+            RepoDigests = info.get('RepoDigests') or [],
+            Entrypoint = info['Config']['Entrypoint'],
+            Cmd = info['Config']['Cmd'],
+        )
+    except KeyError as ke:
+        raise dockerutil.DockerError('Failed to inspect image: JSON result missing key {}'.format(ke))
+
+
+def get_image_info(image, pull=True):
+    '''Get the metadata of an image
+
+    Args:
+        image: The image reference
+        pull: Whether to pull the image if it doesn't exist
+
+    Returns: A dict with the image's Id, RepoDigests, Entrypoint, and Cmd
+
+    Raises NoSuchImageError if the image does not exist (and pull is False).
+    '''
+    host = os.getenv('DOCKER_HOST', '')
+    key = (host, image)
+    info = _inspected.get(key)
+    if info:
+        return info
+
+    index = cache.load(IMAGES_CACHE) or {}
+    info = _load_cached(index, host, image)
+    if info:
+        _inspected[key] = info
+        return info
+
+    # Stamp the image store before inspecting, so that a change in between is
+    # noticed next time.
+    stamp = image_store_stamp()
+    if pull:
+        info = dockerutil.docker_inspect_or_pull(image)
+    else:
+        info = dockerutil.docker_inspect(image)
+    info = _inspected[key] = _extract(info)
+
+    # The image store is only trusted if it actually describes the image
+    if stamp is not None and _image_store_lookup(image) != info['Id']:
+        stamp = None
+
+    if sum(len(v) for v in index.values()) >= IMAGES_CACHE_MAX_ENTRIES:
+        index = {}
+    index.setdefault(host, {})[image] = dict(store_stamp=stamp, time=time.time(), info=info)
+    cache.store(IMAGES_CACHE, index)
+    return info
+
+
+def get_image_command(image):
+    '''Gets the default command for an image'''
+    return get_image_info(image)['Cmd']
+
+def get_image_entrypoint(image):
+    '''Gets the image entrypoint'''
+    return get_image_info(image)['Entrypoint']
+
+def get_image_id(image):
+    '''Gets the ID of an image
+
+    Raises NoSuchImageError if the image does not exist.
+    '''
+    return get_image_info(image, pull=False)['Id']
@@ -0,0 +1,130 @@
+# Pinning of the images used by a config to digests (`scuba-admin lock`)
+#
+# The pins are written to .scuba.lock, next to .scuba.yml, and applied by
+# ScubaConfig.process_command, so that every host runs the same content
+# without resolving tags.
+#
+# `docker load` doesn't restore the repository digests of images, so pinned
+# images loaded from a bundle (see bundle) are tagged with a local tag derived
+# from their digest instead (see local_tag), which is run in their place.
+import os
+import sys
+
+from .config import LOCK_FILE_VERSION
+from . import dockerutil
+from . import imagecache
+
+
+class UnresolvableImageError(dockerutil.DockerError):
+    pass
+
+
+def _repository(image):
+    '''Get the repository of an image reference, as used in RepoDigests
+
+    e.g. docker.io/library/gcc:9 => gcc
+    '''
+    ref = imagecache._familiar_ref(image)
+    name, sep, tag = ref.rpartition(':')
+    if sep and not '/' in tag:
+        return name
+    return ref
+
+
+def resolve_image(image, update=False):
+    '''Resolve an image reference to a digest reference
+
+    The image is pulled if it doesn't exist locally.
+
+    Args:
+        image: The image reference (e.g. gcc:9)
+        update: Pull the image first, to resolve its current version in the
+                registry rather than the local one
+
+    Returns: The digest reference (e.g. gcc@sha256:...)
+
+    Raises UnresolvableImageError if the image has no digest in its
+    repository (e.g. it was built locally).
+    '''
+    if '@' in image:
+        return image    # Already pinned
+
+    if update:
+        with dockerutil.pull_lock(image):
+            dockerutil.docker_pull(image, sys.stderr)
+        info = dockerutil.docker_inspect(image)
+    else:
+        info = dockerutil.docker_inspect_or_pull(image)
+
+    repo = _repository(image)
+    for digest_ref in info.get('RepoDigests') or []:
+        if digest_ref.split('@', 1)[0] == repo:
+            return digest_ref
+
+    raise UnresolvableImageError('Image "{}" has no digest in repository {} '
+            '(was it built locally?)'.format(image, repo))
+
+
+def local_tag(digest_ref):
+    '''Get the local tag of a pinned image loaded from a bundle
+
+    e.g. gcc@sha256:1234 => gcc:sha256-1234
+    '''
+    name, _, digest = digest_ref.partition('@')
+    return '{}:{}'.format(name, digest.replace(':', '-'))
+
+def local_ref(image):
+    '''Get the reference by which to run an image
+
+    A digest reference which doesn't exist locally is replaced by its local
+    tag (see local_tag), if that exists, so that it isn't pulled again.
+
+    Returns: The reference to run
+    '''
+    if not '@' in image:
+        return image
+
+    for ref in (image, local_tag(image)):
+        try:
+            imagecache.get_image_id(ref)
+            return ref
+        except dockerutil.NoSuchImageError:
+            pass
+    return image
+
+
+def lock_images(images, locked=None, update=False):
+    '''Determine the digest references of images
+
+    Args:
+        images: The image references to pin
+        locked: Existing pins (e.g. from .scuba.lock), which are kept unless
+                updating
+        update: Resolve all images from the registry again (see resolve_image)
+
+    Returns: A dict of image references to digest references
+    '''
+    locked = locked or {}
+    result = {}
+    for image in images:
+        if not update and image in locked:
+            result[image] = locked[image]
+        else:
+            result[image] = resolve_image(image, update)
+    return result
+
+
+def write_lock_file(path, images):
+    '''Write a .scuba.lock file
+
+    The file is replaced atomically, as concurrent scuba processes may be
+    reading it.
+    '''
+    import json
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(version=LOCK_FILE_VERSION, images=images), f,
+                indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp_path, path)
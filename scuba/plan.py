@@ -0,0 +1,264 @@
+# Cache of resolved scuba invocations ("plans")
+#
+# Builds often run the same scuba command thousands of times with the same
+# config, image, and user. A plan records the final `docker run` command line
+# and the generated scubadir files for such an invocation, along with
+# everything they were derived from, so that a repeated invocation can skip
+# loading the config, resolving aliases, and inspecting the image.
+import os
+import sys
+
+from .utils import get_umask, make_scubadir
+from .version import __version__
+from . import cache
+from . import dockerutil
+from . import imagecache
+from . import pull
+from .config import PullPolicy
+
+# Version of the format of cached plans
+PLAN_CACHE_VERSION = 3
+
+# The directory of the scuba package, whose modules plans are keyed on
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Environment variables which influence how the config is located and the
+# container is run, in addition to those passed into the container
+TRACKED_ENV = (
+    'DOCKER_HOST',
+    'SCUBA_CONFIG',
+    'SCUBA_DISCOVERY_ACROSS_FILESYSTEM',
+    'SCUBA_ROOT',
+)
+
+
+def is_usable(scuba_args):
+    '''Determine whether the plan cache can be used for an invocation
+
+    Dry runs and verbose runs always go the long way, as they describe it.
+    '''
+    return cache.is_enabled() and not scuba_args.dry_run and not scuba_args.verbose
+
+def _code_stamp():
+    '''Get a digest of the stamps of scuba's modules
+
+    This changes with the code, even where the version doesn't (e.g. in a
+    source checkout).
+    '''
+    import hashlib
+    import json
+    try:
+        names = sorted(n for n in os.listdir(PACKAGE_DIR) if n.endswith('.py'))
+    except OSError:
+        names = []
+    stamps = [[n, cache.file_stamp(os.path.join(PACKAGE_DIR, n))] for n in names]
+    return hashlib.sha1(json.dumps(stamps).encode('utf-8')).hexdigest()
+
+def make_key(scuba_args):
+    '''Make the key identifying an invocation of scuba
+
+    This covers everything about the invocation which is known up-front;
+    everything discovered while resolving it is validated by Plan.load().
+    '''
+    return dict(
+        version = __version__,
+        code = _code_stamp(),
+        cwd = os.getcwd(),
+        uid = os.getuid(),
+        gid = os.getgid(),
+        umask = get_umask(),
+        tty = sys.stdout.isatty() and sys.stdin.isatty(),
+        # (Copies, as ScubaDive modifies these)
+        command = list(scuba_args.command),
+        docker_args = list(scuba_args.docker_args),
+        env_vars = dict(scuba_args.env_vars),
+        root = scuba_args.root,
+        image = scuba_args.image,
+        entrypoint = scuba_args.entrypoint,
+        shell = scuba_args.shell,
+        async_rm = scuba_args.async_rm,
+        mount_userdb = scuba_args.mount_userdb,
+    )
+
+def get_plan_id(key):
+    '''Get the ID of the plan for an invocation, by its key'''
+    import hashlib
+    import json
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _cache_name(key):
+    return 'plans/{}.json'.format(get_plan_id(key))
+
+
+class Plan(object):
+    '''A cached, fully-resolved invocation of scuba'''
+
+    def __init__(self, entry):
+        self._entry = entry
+        self._scubadir = None
+
+    @classmethod
+    def load(cls, key):
+        '''Load the plan for an invocation, if it is still valid
+
+        A plan is valid if the config files, scubainit, and relevant
+        environment variables are unchanged, and (only if the command line
+        depends on the image's metadata) the image ID is unchanged.
+
+        The pull policy of the image is applied first (as it would be without
+        the plan), so a newly-pulled image is taken into account.
+
+        Returns: A Plan, or None
+
+        Raises DockerError if the pull policy can't be satisfied.
+        '''
+        entry = cache.load(_cache_name(key))
+        if not entry or entry.get('version') != PLAN_CACHE_VERSION:
+            return None
+        if entry['key'] != key:
+            return None
+
+        scubainit_path, scubainit_stamp = entry['scubainit']
+        if cache.file_stamp(scubainit_path) != scubainit_stamp:
+            return None
+
+        for name, val in entry['env'].items():
+            if os.environ.get(name) != val:
+                return None
+
+        for dep, stamp in entry['deps']:
+            if not cache.content_unchanged(dep, stamp):
+                return None
+
+        pull.ensure_image(entry['image'], PullPolicy(*entry['pull']))
+
+        if entry['image_id']:
+            try:
+                if imagecache.get_image_id(entry['image']) != entry['image_id']:
+                    return None
+            except dockerutil.DockerError:
+                return None
+
+        return cls(entry)
+
+    @classmethod
+    def load_by_id(cls, plan_id):
+        '''Load a plan by its ID (see get_plan_id), if it is still valid'''
+        entry = cache.load('plans/{}.json'.format(plan_id))
+        if not entry or entry.get('version') != PLAN_CACHE_VERSION:
+            return None
+        return cls.load(entry['key'])
+
+    @staticmethod
+    def store(key, dive, run_args):
+        '''Store the plan for an invocation, from a prepared ScubaDive'''
+        deps = dive.config.dependencies
+        if deps is None:
+            return  # Not loaded from a config file
+
+        image_id = None
+        if dive.uses_image_metadata:
+            try:
+                image_id = imagecache.get_image_id(dive.context.image)
+            except dockerutil.DockerError:
+                return
+
+        env_names = set(dive.env_vars).union(TRACKED_ENV)
+
+        cache.store(_cache_name(key), dict(
+            version = PLAN_CACHE_VERSION,
+            key = key,
+            scubainit = [dive.scubainit_path, cache.file_stamp(dive.scubainit_path)],
+            env = {name: os.environ.get(name) for name in env_names},
+            deps = deps,
+            image = dive.context.image,
+            pull = list(dive.context.pull_policy),
+            image_id = image_id,
+            scubadir = dive.scubadir_hostpath,
+            files = _snapshot_scubadir(dive.scubadir_hostpath, dive.scubadir_copies),
+            args = run_args,
+        ))
+
+    @property
+    def image(self):
+        '''The image which is run'''
+        return self._entry['image']
+
+    @property
+    def image_id(self):
+        '''The ID of the image which is run, if it was checked by load()'''
+        return self._entry['image_id']
+
+    @property
+    def id(self):
+        return get_plan_id(self._entry['key'])
+
+    @property
+    def fingerprint(self):
+        '''A digest of everything this plan runs, which changes with it'''
+        import hashlib
+        import json
+        return hashlib.sha1(json.dumps(self._entry, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def materialize(self, scubadir=None):
+        '''Create the scubadir for this plan
+
+        Args:
+            scubadir: An existing, empty directory to use as the scubadir,
+                      which is not removed by cleanup_tempfiles()
+
+        Returns: The docker command line
+        '''
+        import base64
+        import shutil
+
+        if scubadir:
+            path = scubadir
+        else:
+            path = self._scubadir = make_scubadir()
+
+        for f in self._entry['files']:
+            fpath = os.path.join(path, f['name'])
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            if 'source' in f:
+                shutil.copy2(f['source'], fpath)
+            else:
+                with open(fpath, 'wb') as fobj:
+                    fobj.write(base64.b64decode(f['content']))
+                os.chmod(fpath, f['mode'])
+
+        old = self._entry['scubadir']
+        return [a.replace(old, path) for a in self._entry['args']]
+
+    def cleanup_tempfiles(self):
+        import shutil
+        if self._scubadir:
+            shutil.rmtree(self._scubadir)
+            self._scubadir = None
+
+
+def _snapshot_scubadir(path, copies):
+    '''Record the content of the generated files in a scubadir
+
+    Files which were copied into the scubadir (e.g. scubainit) are recorded
+    by their source path instead. The content is recorded as base64, as the
+    files needn't be UTF-8 (e.g. user database files from the image).
+    '''
+    import base64
+
+    files = []
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            fullpath = os.path.join(dirpath, fn)
+            name = os.path.relpath(fullpath, path)
+
+            source = copies.get(name)
+            if source:
+                files.append(dict(name=name, source=source))
+                continue
+
+            with open(fullpath, 'rb') as f:
+                content = base64.b64encode(f.read()).decode('ascii')
+            mode = os.stat(fullpath).st_mode & 0o7777
+            files.append(dict(name=name, mode=mode, content=content))
+    return files
@@ -0,0 +1,300 @@
+# Pool of containers created in advance (SCUBA_POOL_SIZE)
+#
+# Creating a container is a significant part of the time it takes to run a
+# short command. With a pool, whenever a cached plan (see plan) is run and
+# its pool isn't full, a detached process (python -m scuba.pool PLAN_ID)
+# creates containers for that plan, up to SCUBA_POOL_SIZE of them, with
+# `docker create`. The next invocation of the same plan claims one of them,
+# and only has to start it and attach to it. Every command still runs in a
+# new container.
+#
+# Pooled containers are recorded in the runtime directory
+# (pool/<plan ID>/<container ID>.json), next to their scubadirs. Entries are
+# discarded once the plan (e.g. the config) or the image they were created
+# from has changed. The invocations which find (or don't find) a pooled
+# container are counted, and reported by `scuba-admin pool`.
+import os
+import sys
+
+from . import dockerutil
+from . import imagecache
+from . import runtime
+
+# Setting this environment variable to a positive number enables the pool
+ENV_VAR = 'SCUBA_POOL_SIZE'
+
+# Names of the files counting hits and misses (one byte each)
+HITS_NAME = 'hits'
+MISSES_NAME = 'misses'
+
+
+class PooledContainer(object):
+    '''A container claimed from the pool'''
+    def __init__(self, record):
+        self.container = record['container']
+        self.scubadir = record['scubadir']
+        self.args = record['args']
+
+    def cleanup_tempfiles(self):
+        import shutil
+        shutil.rmtree(self.scubadir, ignore_errors=True)
+
+
+def get_pool_size():
+    '''Get the number of containers to keep per plan (0 if the pool is disabled)'''
+    try:
+        return max(0, int(os.getenv(ENV_VAR) or 0))
+    except ValueError:
+        return 0
+
+def _pool_dir():
+    path = runtime.get_runtime_dir()
+    if not path:
+        return None
+    return os.path.join(path, 'pool')
+
+
+def _count(name):
+    '''Count a hit or miss'''
+    path = _pool_dir()
+    if not path:
+        return
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        with open(os.path.join(path, name), 'ab') as f:
+            f.write(b'.')
+    except OSError:
+        pass
+
+def record_miss():
+    '''Count an invocation which could have used a pooled container'''
+    _count(MISSES_NAME)
+
+def get_stats():
+    '''Get the number of hits and misses counted'''
+    result = []
+    for name in (HITS_NAME, MISSES_NAME):
+        try:
+            result.append(os.stat(os.path.join(_pool_dir(), name)).st_size)
+        except (OSError, TypeError):
+            result.append(0)
+    return tuple(result)
+
+
+def _read_record(path):
+    import json
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _discard(record):
+    '''Remove a pooled container, and its scubadir'''
+    import shutil
+    try:
+        dockerutil.docker_rm(record['container'], force=True)
+    except dockerutil.DockerError:
+        pass
+    shutil.rmtree(record['scubadir'], ignore_errors=True)
+
+def _claim_path(plan_dir, name):
+    '''Claim a record to discard it, so no other process can use it'''
+    path = os.path.join(plan_dir, name)
+    try:
+        os.unlink(path)
+    except OSError:
+        return False
+    return True
+
+def _is_current(record, plan):
+    if record.get('plan') != plan.fingerprint:
+        return False
+    try:
+        return imagecache.get_image_id(plan.image) == record.get('image_id')
+    except dockerutil.DockerError:
+        return False
+
+
+def claim(plan):
+    '''Claim a pooled container for a plan, counting a hit or miss
+
+    Stale containers found along the way are removed.
+
+    Returns: A PooledContainer, or None
+    '''
+    path = _pool_dir()
+    if not path:
+        return None
+
+    plan_dir = os.path.join(path, plan.id)
+    try:
+        names = sorted(os.listdir(plan_dir))
+    except OSError:
+        names = []
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+
+        # Renaming the record claims it; only one process can succeed
+        path = os.path.join(plan_dir, name)
+        claimed = '{}.{}'.format(path, os.getpid())
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        record = _read_record(claimed)
+        os.unlink(claimed)
+        if not record:
+            continue
+
+        if not _is_current(record, plan):
+            _discard(record)
+            continue
+
+        _count(HITS_NAME)
+        return PooledContainer(record)
+
+    record_miss()
+    return None
+
+
+def needs_fill(plan_id):
+    '''Check whether the pool for a plan has fewer than SCUBA_POOL_SIZE containers'''
+    path = _pool_dir()
+    if not path:
+        return False
+    try:
+        names = os.listdir(os.path.join(path, plan_id))
+    except OSError:
+        names = []
+    return sum(1 for n in names if n.endswith('.json')) < get_pool_size()
+
+def fill_later(plan_id):
+    '''Fill the pool for a plan, in a detached process'''
+    import subprocess
+
+    # The process must import the same scuba package as this one
+    env = dict(os.environ)
+    pkg_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (pkg_parent, env.get('PYTHONPATH')) if p)
+
+    try:
+        subprocess.Popen([sys.executable, '-m', 'scuba.pool', plan_id],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, env=env, close_fds=True,
+                start_new_session=True)
+    except OSError:
+        pass
+
+def fill(plan_id):
+    '''Create containers for a plan, until the pool has SCUBA_POOL_SIZE of them
+
+    Stale containers are removed first.
+
+    Returns: The number of containers created
+    '''
+    import json
+    import shutil
+    import tempfile
+    from .plan import Plan
+
+    size = get_pool_size()
+    if not size or not _pool_dir():
+        return 0
+
+    with runtime.FileLock('pool-{}.lock'.format(plan_id)):
+        plan = Plan.load_by_id(plan_id)
+        if not plan:
+            return 0
+
+        plan_dir = os.path.join(_pool_dir(), plan_id)
+        os.makedirs(plan_dir, mode=0o700, exist_ok=True)
+
+        pooled = 0
+        for name in os.listdir(plan_dir):
+            if name.endswith('.json'):
+                record = _read_record(os.path.join(plan_dir, name))
+                if record and _is_current(record, plan):
+                    pooled += 1
+                elif record and _claim_path(plan_dir, name):
+                    _discard(record)
+
+        image_id = imagecache.get_image_id(plan.image)
+        created = 0
+        while pooled + created < size:
+            scubadir = tempfile.mkdtemp(prefix='scubadir-', dir=plan_dir)
+            args = plan.materialize(scubadir)
+            try:
+                cid = dockerutil.docker_create(args)
+            except dockerutil.DockerError:
+                shutil.rmtree(scubadir, ignore_errors=True)
+                raise
+
+            record = dict(
+                container = cid,
+                plan = plan.fingerprint,
+                image_id = image_id,
+                scubadir = scubadir,
+                args = args,
+            )
+            path = os.path.join(plan_dir, cid + '.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(record, f)
+            os.replace(path + '.tmp', path)
+            created += 1
+
+    return created
+
+def get_pooled_count():
+    '''Get the number of containers in the pool, for all plans'''
+    path = _pool_dir()
+    count = 0
+    try:
+        plan_dirs = [os.path.join(path, n) for n in os.listdir(path)]
+    except (OSError, TypeError):
+        return 0
+    for plan_dir in plan_dirs:
+        if os.path.isdir(plan_dir):
+            count += sum(1 for n in os.listdir(plan_dir) if n.endswith('.json'))
+    return count
+
+def clear(stats=True):
+    '''Remove all pooled containers (and optionally, the hit/miss counts)
+
+    Returns: The number of containers removed
+    '''
+    path = _pool_dir()
+    removed = 0
+    try:
+        names = os.listdir(path)
+    except (OSError, TypeError):
+        return 0
+
+    for name in names:
+        plan_dir = os.path.join(path, name)
+        if not os.path.isdir(plan_dir):
+            continue
+        for rname in os.listdir(plan_dir):
+            if not rname.endswith('.json'):
+                continue
+            record = _read_record(os.path.join(plan_dir, rname))
+            if record and _claim_path(plan_dir, rname):
+                _discard(record)
+                removed += 1
+
+    if stats:
+        for name in (HITS_NAME, MISSES_NAME):
+            try:
+                os.unlink(os.path.join(path, name))
+            except OSError:
+                pass
+    return removed
+
+
+if __name__ == '__main__':
+    try:
+        fill(sys.argv[1])
+    except (dockerutil.DockerError, OSError):
+        sys.exit(1)
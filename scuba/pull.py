@@ -0,0 +1,210 @@
+# Pulling of images: prefetching the images used by a config (`scuba-admin pull`),
+# and applying the pull policy of an image before it is run.
+#
+# Otherwise, images are only pulled when they're first used, one at a time.
+import os
+import sys
+import time
+
+from . import cache
+from .config import ConfigError
+from . import dockerutil
+from . import trace
+
+# Default number of images pulled concurrently
+DEFAULT_JOBS = 4
+
+
+def config_images(config):
+    '''Get the images referenced by a config
+
+    This includes the top-level image and those of all aliases.
+
+    Returns: A list of image names, without duplicates
+    '''
+    images = []
+    try:
+        images.append(config.image)
+    except ConfigError:
+        pass    # Only the aliases specify images
+    for alias in config.aliases.values():
+        if alias.image and not alias.image in images:
+            images.append(alias.image)
+    return images
+
+
+def missing_images(images):
+    '''Determine which images do not exist locally
+
+    All images are inspected at once.
+    '''
+    infos = dockerutil.docker_inspect_many(images)
+    return [i for i in images if infos[i] is None]
+
+
+class PullProgress(object):
+    '''Shows the combined progress of concurrent pulls
+
+    Each line of output is prefixed with the image it relates to.
+    '''
+    def __init__(self, total, out=None):
+        self.total = total
+        self.done = 0
+        self.out = out or sys.stdout
+        import threading
+        self._lock = threading.Lock()
+
+    def message(self, image, msg):
+        with self._lock:
+            print('{}: {}'.format(image, msg), file=self.out)
+            self.out.flush()
+
+    def finished(self, image, msg):
+        with self._lock:
+            self.done += 1
+            print('[{}/{}] {}: {}'.format(self.done, self.total, image, msg), file=self.out)
+            self.out.flush()
+
+    def writer(self, image):
+        '''Get a text file which reports progress for an image'''
+        return _ProgressWriter(self, image)
+
+
+class _ProgressWriter(object):
+    '''A write-only text file, reporting each line as progress for an image'''
+
+    def __init__(self, progress, image):
+        self.progress = progress
+        self.image = image
+        self._buf = ''
+
+    def write(self, data):
+        self._buf += data
+        *lines, self._buf = self._buf.split('\n')
+        for line in lines:
+            line = line.strip()
+            if line:
+                self.progress.message(self.image, line)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def pull_images(images, jobs=DEFAULT_JOBS, out=None):
+    '''Pull images concurrently
+
+    Args:
+        images: The images to pull
+        jobs: The maximum number of images pulled at once
+        out: Where progress is written (default: stdout)
+
+    Returns: A dict of the errors (DockerError) of images which failed to pull
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    progress = PullProgress(len(images), out)
+    errors = {}
+
+    def pull(image):
+        progress.message(image, 'Pulling')
+        start = time.time()
+        try:
+            dockerutil.docker_pull_missing(image, progress.writer(image))
+        except dockerutil.DockerError as e:
+            errors[image] = e
+            progress.finished(image, 'Failed: {}'.format(e))
+        else:
+            progress.finished(image, 'Done ({:.1f}s)'.format(time.time() - start))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # Consume the results to propagate any unexpected exceptions
+        list(executor.map(pull, images))
+
+    return errors
+
+
+################################################################################
+# Pull policies
+#
+# The last time each image was checked for a newer version (i.e. pulled) is
+# recorded in the cache, one file per image so that concurrent processes
+# checking different images don't lose each other's updates.
+
+def _check_cache_name(image):
+    import hashlib
+    key = '{}\0{}'.format(os.getenv('DOCKER_HOST', ''), image)
+    return 'pulls/{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def last_checked(image):
+    '''Get the time an image was last checked for a newer version
+
+    Returns: The time (as from time.time()), or None if it is not known
+    '''
+    entry = cache.load(_check_cache_name(image))
+    if not entry or entry.get('image') != image:
+        return None
+    return entry.get('checked')
+
+def _record_check(image, checked):
+    cache.store(_check_cache_name(image), dict(image=image, checked=checked))
+
+
+def refresh_image(image, ttl=None):
+    '''Pulls an image, unless it was recently checked for a newer version
+
+    Concurrent processes refreshing the same image wait for each other, and
+    only the first of them pulls it: a check which completed after a process
+    started waiting is as good as its own.
+
+    Args:
+        image: The image to pull
+        ttl: The number of seconds for which a previous check remains fresh,
+             or None to always pull
+    '''
+    start = time.time()
+    if ttl is not None:
+        checked = last_checked(image)
+        if checked is not None and 0 <= start - checked < ttl:
+            return
+
+    with dockerutil.pull_lock(image):
+        checked = last_checked(image)
+        if checked is not None:
+            if checked >= start:
+                return
+            if ttl is not None and 0 <= start - checked < ttl:
+                return
+
+        # Progress goes to stderr, like that of an implicit pull by docker run,
+        # so it doesn't mix with the output of the command.
+        with trace.span('pull', image=image):
+            dockerutil.docker_pull(image, sys.stderr)
+        _record_check(image, time.time())
+
+
+def ensure_image(image, policy):
+    '''Applies the pull policy of an image, before it is run
+
+    Args:
+        image: The image which is about to be run
+        policy: A config.PullPolicy
+
+    Raises DockerError if the image can't be pulled, or if it doesn't exist and
+    the policy is 'never'.
+    '''
+    if policy.mode == 'missing' or (policy.mode != 'never' and '@' in image):
+        # docker run pulls it if needed; an image referenced by digest
+        # never changes, so it needn't be checked for a newer version
+        return
+
+    if policy.mode == 'never':
+        from .imagecache import get_image_id
+        try:
+            get_image_id(image)
+        except dockerutil.NoSuchImageError:
+            raise dockerutil.DockerError('Image "{}" does not exist locally, '
+                    'and its pull policy is "never"'.format(image))
+        return
+
+    refresh_image(image, policy.ttl if policy.mode == 'ttl' else None)
@@ -0,0 +1,93 @@
+# Asynchronous removal of containers (`--async-rm`)
+#
+# `docker run --rm` doesn't return until the container (and its writable
+# layer) has been removed, which can take seconds after a build writes a lot
+# into the container. With --async-rm, the container is instead labelled with
+# REAP_LABEL, and its ID is written to a file; once its exit status is known,
+# scuba leaves removing it to a detached process (python -m scuba.reap), and
+# returns immediately. Any containers left behind (e.g. if that process is
+# killed) are removed by `scuba-admin gc`.
+import os
+import sys
+
+from . import dockerutil
+
+# Label of the containers to be removed asynchronously
+REAP_LABEL = 'scuba.reap'
+
+# Name of the container ID file, in the scubadir
+CIDFILE_NAME = 'container.id'
+
+
+def run_options(cidfile):
+    '''Get the `docker run` options for a container to be removed asynchronously'''
+    return ['--label={}=1'.format(REAP_LABEL), '--cidfile={}'.format(cidfile)]
+
+def get_cidfile(run_args):
+    '''Get the container ID file of a `docker run` command line
+
+    Returns: The path, or None if the container is not to be removed
+             asynchronously
+    '''
+    if not run_options('')[0] in run_args:
+        return None
+    for a in run_args:
+        if a.startswith('--cidfile='):
+            return a[len('--cidfile='):]
+    return None
+
+
+def reap_later(cidfile):
+    '''Remove the container whose ID is in cidfile, in a detached process
+
+    Nothing is done if the file doesn't exist (i.e. the container wasn't
+    created).
+    '''
+    import subprocess
+
+    try:
+        with open(cidfile, 'r') as f:
+            cid = f.read().strip()
+    except FileNotFoundError:
+        return
+    if not cid:
+        return
+
+    # The reaper must import the same scuba package as this process
+    env = dict(os.environ)
+    pkg_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (pkg_parent, env.get('PYTHONPATH')) if p)
+
+    try:
+        subprocess.Popen([sys.executable, '-m', 'scuba.reap', cid],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, env=env, close_fds=True,
+                start_new_session=True)
+    except OSError:
+        reap_containers([cid])
+
+
+def reap_containers(cids):
+    '''Remove containers, ignoring any which can't be removed
+
+    Returns: The IDs of the containers removed
+    '''
+    removed = []
+    for cid in cids:
+        try:
+            dockerutil.docker_rm(cid)
+        except dockerutil.DockerError:
+            continue
+        removed.append(cid)
+    return removed
+
+def reap_stopped():
+    '''Remove all of the stopped containers left to be removed asynchronously
+
+    Returns: The IDs of the containers removed
+    '''
+    return reap_containers(dockerutil.get_stopped_containers(REAP_LABEL))
+
+
+if __name__ == '__main__':
+    reap_containers(sys.argv[1:])
@@ -0,0 +1,89 @@
+# Runtime state shared between concurrent scuba processes
+#
+# Unlike the caches (see cache), this state (e.g. lock files) only needs to
+# live as long as the processes using it, so it is kept in a per-user runtime
+# directory.
+import os
+import stat
+import sys
+
+from . import trace
+
+
+def get_runtime_dir():
+    '''Get the directory for state shared between scuba processes
+
+    This is $SCUBA_RUNTIME_DIR if set, otherwise $XDG_RUNTIME_DIR/scuba (or
+    /tmp/scuba-$UID if XDG_RUNTIME_DIR is not set). It is created if needed.
+
+    Returns: The path, or None if it can't be used (e.g. it is owned by
+             another user)
+    '''
+    path = os.getenv('SCUBA_RUNTIME_DIR')
+    if not path:
+        base = os.getenv('XDG_RUNTIME_DIR')
+        if base:
+            path = os.path.join(base, 'scuba')
+        else:
+            path = os.path.join(os.getenv('TMPDIR') or '/tmp', 'scuba-{}'.format(os.getuid()))
+
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError:
+        return None
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        return None
+    return path
+
+
+class FileLock(object):
+    '''An exclusive lock, held across processes, using a lock file
+
+    The lock file is created in the runtime directory, and never removed (as
+    that would race with other processes locking it). If it can't be
+    created, locking does nothing.
+    '''
+    def __init__(self, name, wait_msg=None):
+        '''
+        Args:
+            name: The name of the lock file
+            wait_msg: A message shown on stderr if the lock is held by
+                      another process
+        '''
+        self.name = name
+        self.wait_msg = wait_msg
+        self._fd = None
+
+    def acquire(self):
+        import fcntl
+
+        runtime_dir = get_runtime_dir()
+        if not runtime_dir:
+            return
+        try:
+            self._fd = os.open(os.path.join(runtime_dir, self.name),
+                    os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        except OSError:
+            return
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if self.wait_msg:
+                print('scuba: ' + self.wait_msg, file=sys.stderr)
+            with trace.span('lock wait', lock=self.name):
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
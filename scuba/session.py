@@ -0,0 +1,310 @@
+# Persistent containers in which commands are run with `docker exec`
+# (`scuba-admin session`)
+#
+# Every invocation normally creates a new container, in which scubainit sets
+# up the user and runs the hooks. A session is a container which is started
+# once (by `scuba-admin session start`), set up by scubainit, and then waits for
+# commands. An invocation which would create an identical container (the same
+# image, mounts, docker options, user, and hooks; see session_key) instead
+# runs its command in the session, using `docker exec`, as the same user, and
+# in its own working directory.
+#
+# Sessions are recorded in the runtime directory (sessions/<key>.json), next
+# to the scubadir mounted into their container (sessions/<key>). A session
+# stops itself once no command has run in it for its idle timeout: the script
+# it runs (SESSION_SCRIPT) treats it as busy while there are command scripts
+# in its commands/ directory, and resets the timer whenever the `used` marker
+# is created.
+import os
+import sys
+import time
+
+from . import dockerutil
+from . import runtime
+
+# Default time after which an unused session stops
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+# How often (in seconds) a session checks whether it is being used
+IDLE_CHECK_INTERVAL = 5
+
+# The script run by the session container, in its scubadir
+SESSION_SCRIPT_NAME = 'session.sh'
+SESSION_SCRIPT = '''\
+# Auto-generated from scuba
+# Wait until no command has been run for $1 seconds, checking every $2
+dir=$(dirname "$0")
+: > "$dir/ready"
+idle=0
+while [ "$idle" -lt "$1" ]; do
+    sleep "$2"
+    if [ -e "$dir/used" ] || [ -n "$(ls -A "$dir/commands")" ]; then
+        rm -f "$dir/used"
+        idle=0
+    else
+        idle=$((idle + $2))
+    fi
+done
+'''
+
+# scubainit variables which don't change what it sets up
+_UNTRACKED_INIT_VARS = ('SCUBAINIT_UMASK', 'SCUBAINIT_VERBOSE')
+
+
+class SessionError(Exception):
+    pass
+
+
+class Session(object):
+    '''A session, as recorded in the runtime directory'''
+    def __init__(self, key, record):
+        self.key = key
+        self.container = record['container']
+        self.image = record['image']
+        self.directory = record['directory']
+        self.started = record['started']
+        self.idle_timeout = record['idle_timeout']
+
+    @property
+    def id(self):
+        return self.container[:12]
+
+    @property
+    def path(self):
+        '''The host path of the session's scubadir'''
+        return os.path.join(_sessions_dir(), self.key)
+
+    @property
+    def last_used(self):
+        try:
+            return os.stat(_record_path(self.key)).st_mtime
+        except OSError:
+            return self.started
+
+    def touch(self):
+        '''Record that the session is being used'''
+        for path in (_record_path(self.key), os.path.join(self.path, 'used')):
+            try:
+                with open(path, 'a'):
+                    os.utime(path)
+            except OSError:
+                pass
+
+
+def _sessions_dir():
+    path = runtime.get_runtime_dir()
+    if not path:
+        return None
+    return os.path.join(path, 'sessions')
+
+def _record_path(key):
+    return os.path.join(_sessions_dir(), key + '.json')
+
+
+def session_key(dive):
+    '''Get the key identifying the sessions in which a ScubaDive can run
+
+    This covers everything which determines how its container is set up: the
+    image, mounts (except the scubadir, and files in it), docker options,
+    what scubainit is told to set up, and the hooks.
+    '''
+    import hashlib
+    import json
+
+    scubadir = dive.scubadir_hostpath
+    key = dict(
+        image = dive.context.image,
+        volumes = [list(v) for v in dive.volumes
+                   if v[0] != scubadir and not v[0].startswith(scubadir + os.sep)],
+        options = [o for o in dive.options
+                   if o != '--tty' and not o.startswith('--entrypoint=')],
+        init = {k: str(v) for k, v in dive.env_vars.items()
+                if k.startswith('SCUBAINIT_') and not k in _UNTRACKED_INIT_VARS},
+        hooks = dive.config.hooks,
+        host = os.getenv('DOCKER_HOST', ''),
+    )
+    data = json.dumps(key, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()[:20]
+
+
+def have_sessions():
+    '''Determine (cheaply) whether there may be any sessions'''
+    path = _sessions_dir()
+    try:
+        return path is not None and any(n.endswith('.json') for n in os.listdir(path))
+    except OSError:
+        return False
+
+def list_sessions():
+    '''Get the recorded sessions, forgetting those whose container has stopped
+
+    Returns: A list of Sessions
+    '''
+    result = []
+    if not have_sessions():
+        return result
+    for name in sorted(os.listdir(_sessions_dir())):
+        if name.endswith('.json'):
+            session = _load(name[:-len('.json')])
+            if session:
+                result.append(session)
+    return result
+
+def _load(key, check=True):
+    import json
+    try:
+        with open(_record_path(key), 'r') as f:
+            session = Session(key, json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if check and not dockerutil.is_container_running(session.container):
+        _forget(session.key)
+        return None
+    return session
+
+def _forget(key):
+    import shutil
+    try:
+        os.unlink(_record_path(key))
+    except OSError:
+        pass
+    shutil.rmtree(os.path.join(_sessions_dir(), key), ignore_errors=True)
+
+
+def find_session(dive):
+    '''Find a running session in which a ScubaDive can run
+
+    Returns: The Session, or None
+    '''
+    if not _sessions_dir():
+        return None
+    return _load(session_key(dive))
+
+
+def start_session(dive, idle_timeout):
+    '''Start a session for a prepared ScubaDive
+
+    The dive must be detached, and run SESSION_SCRIPT (see session_command).
+    Returns once scubainit has finished setting up the container.
+
+    Returns: The Session
+    '''
+    import json
+    import shutil
+
+    sessions_dir = _sessions_dir()
+    if not sessions_dir:
+        raise SessionError('No runtime directory is available for sessions')
+
+    key = session_key(dive)
+    existing = _load(key)
+    if existing:
+        raise SessionError('Session {} is already running for {}'.format(
+            existing.id, existing.image))
+
+    # The session keeps its own copy of the scubadir, as the dive's is
+    # removed when this process exits.
+    path = os.path.join(sessions_dir, key)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(sessions_dir, mode=0o700, exist_ok=True)
+    shutil.copytree(dive.scubadir_hostpath, path)
+    os.mkdir(os.path.join(path, 'commands'))
+    with open(os.path.join(path, SESSION_SCRIPT_NAME), 'w') as f:
+        f.write(SESSION_SCRIPT)
+
+    run_args = [a.replace(dive.scubadir_hostpath, path) for a in dive.get_docker_cmdline()]
+    cid = None
+    try:
+        cid = dockerutil.run_detached(run_args)
+        _wait_ready(cid, os.path.join(path, 'ready'))
+    except BaseException:
+        if cid:
+            try:
+                dockerutil.docker_rm(cid, force=True)
+            except dockerutil.DockerError:
+                pass
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+    record = dict(
+        container = cid,
+        image = dive.context.image,
+        directory = dive.env_vars.get('SCUBA_ROOT'),
+        started = time.time(),
+        idle_timeout = idle_timeout,
+    )
+    tmp_path = '{}.{}.tmp'.format(_record_path(key), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, _record_path(key))
+    return Session(key, record)
+
+def session_command(shell, idle_timeout):
+    '''Get the user command for the ScubaDive which starts a session'''
+    return [shell, '/.scuba/' + SESSION_SCRIPT_NAME,
+            str(int(idle_timeout)), str(IDLE_CHECK_INTERVAL)]
+
+def _wait_ready(cid, ready_path, interval=0.05):
+    '''Wait until the session script has started (i.e. scubainit is done)'''
+    checks = 0
+    while not os.path.exists(ready_path):
+        # (The container is checked less often, as that is a docker request)
+        if checks % 20 == 0 and not dockerutil.is_container_running(cid):
+            raise SessionError('The session container exited while starting; '
+                    'run scuba without a session to find out why')
+        checks += 1
+        time.sleep(interval)
+
+
+def stop_session(session):
+    '''Stop a session, and remove its container'''
+    try:
+        dockerutil.docker_rm(session.container, force=True)
+    except dockerutil.DockerError:
+        pass    # It has already stopped
+    _forget(session.key)
+
+
+def exec_command(session, dive):
+    '''Run the command of a prepared ScubaDive in a session
+
+    Returns: The exit status of the command
+    '''
+    import shutil
+
+    # The command script is copied into the session, where it also marks the
+    # session as busy while it exists.
+    name = 'commands/{}.sh'.format(os.getpid())
+    script = os.path.join(session.path, name)
+    shutil.copy2(os.path.join(dive.scubadir_hostpath, 'command.sh'), script)
+
+    args = ['docker', 'exec', '-i']
+    if '--tty' in dive.options:
+        args.append('--tty')
+
+    env = {k: v for k, v in dive.env_vars.items() if not k.startswith('SCUBAINIT_')}
+    if 'SCUBAINIT_UID' in dive.env_vars:
+        # As set up by scubainit
+        user = dive.env_vars['SCUBAINIT_USER']
+        args.append('--user={}:{}'.format(dive.env_vars['SCUBAINIT_UID'],
+                dive.env_vars['SCUBAINIT_GID']))
+        env.update(USER=user, LOGNAME=user, HOME='/home/' + user)
+    if dive.workdir:
+        args += ['-w', dive.workdir]
+    for k, v in env.items():
+        args.append('--env={}={}'.format(k, v))
+    args.append(session.container)
+
+    # Run the command like scubainit would: with the umask, and via the
+    # image's entrypoint (if any)
+    shell = dive.context.shell
+    args += [shell, '-c', 'umask {} && exec "$@"'.format(dive.env_vars['SCUBAINIT_UMASK']), shell]
+    args += dive.docker_cmd[:-1] + ['/.scuba/' + name]
+
+    session.touch()
+    try:
+        return dockerutil.call(args, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+    finally:
+        os.unlink(script)
+        session.touch()
@@ -0,0 +1,126 @@
+# Tracing of scuba invocations
+#
+# Records spans for the phases of an invocation (argument parsing, config
+# loading, running docker, ...) in the Chrome trace event format, which can be
+# viewed with chrome://tracing or https://ui.perfetto.dev.
+#
+# Traces are written using the JSON Array Format, whose closing bracket is
+# optional. This allows any number of scuba processes (e.g. every invocation
+# in a CI run) to append their events to the same trace file.
+import functools
+import os
+import time
+from _thread import get_ident
+
+# Environment variable specifying the trace file (see also --trace)
+ENV_VAR = 'SCUBA_TRACE'
+
+# Recorded events, or None if tracing is not active
+_events = None
+
+# Wall-clock time (in microseconds) and perf_counter time at start()
+_origin = None
+
+# CPU time consumed by the process before start(), i.e. by interpreter startup
+# and imports
+_startup_cpu = None
+
+
+def start():
+    '''Start recording spans'''
+    global _events, _origin, _startup_cpu
+    _events = []
+    _origin = (time.time() * 1e6, time.perf_counter())
+    _startup_cpu = time.process_time() * 1e6
+
+def is_active():
+    return _events is not None
+
+def _now():
+    '''Get the current trace timestamp (in microseconds)
+
+    Timestamps are based on the wall clock, so that traces from different
+    processes line up, but are measured using perf_counter.
+    '''
+    return _origin[0] + (time.perf_counter() - _origin[1]) * 1e6
+
+
+class span(object):
+    '''A context manager which records a span
+
+    Nothing is recorded if tracing is not active.
+    '''
+    def __init__(self, name, cat='scuba', **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self._start = None
+
+    def __enter__(self):
+        if _events is not None:
+            self._start = _now()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _events is None or self._start is None:
+            return
+        event = dict(
+            name = self.name,
+            cat = self.cat,
+            ph = 'X',
+            ts = self._start,
+            dur = _now() - self._start,
+            pid = os.getpid(),
+            tid = get_ident(),
+        )
+        if self.args:
+            event['args'] = self.args
+        _events.append(event)
+
+
+def traced(name):
+    '''Decorator which records a span for each call of a function'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def finish(path):
+    '''Stop recording, and append the recorded events to a trace file
+
+    If path is None, the recorded events are discarded.
+    '''
+    global _events
+    events, _events = _events, None
+    if not path or events is None:
+        return
+
+    import json
+    pid = os.getpid()
+    tid = get_ident()
+    events[:0] = [
+        dict(name='process_name', ph='M', pid=pid, tid=tid, args=dict(name='scuba')),
+        # Approximated by CPU time, as the wall-clock time is not available
+        dict(name='startup', cat='python', ph='X', pid=pid, tid=tid,
+             ts=_origin[0] - _startup_cpu, dur=_startup_cpu),
+    ]
+    data = ''.join(json.dumps(e, sort_keys=True) + ',\n' for e in events)
+
+    # Append all events with a single write, so that those from concurrent
+    # processes are not interleaved. A new trace file is started with the
+    # opening bracket; the lock ensures only the first writer adds it.
+    import fcntl
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.fstat(fd).st_size == 0:
+            data = '[\n' + data
+        os.write(fd, data.encode('utf-8'))
+    finally:
+        os.close(fd)
@@ -0,0 +1,142 @@
+# Tracking of the images used by scuba, and their garbage collection
+# (`scuba-admin gc`)
+#
+# Each image which scuba runs is recorded by a file in the cache, named by
+# the image ID, whose mtime is the time the image was last used. Recording a
+# use only needs to touch that file, so it is cheap enough to do on every
+# invocation. Images which scuba has never run are never collected.
+import os
+import time
+
+from . import cache
+from . import dockerutil
+
+
+def _usage_dir():
+    import hashlib
+    host = hashlib.sha1(os.getenv('DOCKER_HOST', '').encode('utf-8')).hexdigest()
+    return cache.get_cache_path(os.path.join('usage', host[:16]))
+
+def _usage_path(image_id):
+    return os.path.join(_usage_dir(), image_id.replace(':', '-'))
+
+
+def record_use(image_id, ref):
+    '''Record that an image is being used
+
+    Args:
+        image_id: The ID of the image
+        ref: The reference by which it is used (e.g. gcc:9)
+    '''
+    if not cache.is_enabled():
+        return
+
+    path = _usage_path(image_id)
+    try:
+        os.utime(path)
+        return
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(ref + '\n')
+    except OSError:
+        pass
+
+def record_image(image):
+    '''Record that an image is being used, by reference
+
+    Returns: Whether it was recorded; it is not if the image doesn't exist
+             (yet), or if caching is disabled
+    '''
+    if not cache.is_enabled():
+        return False
+
+    from .imagecache import get_image_id
+    try:
+        image_id = get_image_id(image)
+    except dockerutil.DockerError:
+        return False
+
+    record_use(image_id, image)
+    return True
+
+
+def get_usage():
+    '''Get the recorded uses of images
+
+    Returns: A dict of image IDs to (last_used, ref) tuples
+    '''
+    result = {}
+    path = _usage_dir()
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return result
+
+    for name in names:
+        try:
+            st = os.stat(os.path.join(path, name))
+            with open(os.path.join(path, name), 'r') as f:
+                ref = f.read().strip()
+        except OSError:
+            continue
+        result[name.replace('-', ':', 1)] = (st.st_mtime, ref)
+    return result
+
+def forget(image_id):
+    '''Forget the recorded use of an image (e.g. once it has been removed)'''
+    try:
+        os.unlink(_usage_path(image_id))
+    except OSError:
+        pass
+
+
+def select_images(usage, sizes, protected=(), max_size=None, max_age=None, now=None):
+    '''Select the images to remove, least recently used first
+
+    Images are selected while they were last used longer ago than max_age,
+    or while the total size of the used images exceeds max_size.
+
+    Args:
+        usage: The recorded uses of images (see get_usage)
+        sizes: The sizes of the images which exist, by ID
+        protected: The IDs of images which must not be removed
+        max_size: The maximum total size of the images
+        max_age: The maximum time since an image was last used, in seconds
+        now: The current time
+
+    Returns: A list of image IDs
+    '''
+    if now is None:
+        now = time.time()
+
+    total = sum(sizes[i] for i in usage if i in sizes)
+    candidates = sorted((last_used, i) for i, (last_used, _) in usage.items()
+            if i in sizes and not i in protected)
+
+    selected = []
+    for last_used, image_id in candidates:
+        too_old = max_age is not None and now - last_used > max_age
+        too_big = max_size is not None and total > max_size
+        if not (too_old or too_big):
+            # The remaining images are newer, and the total only shrinks
+            break
+        selected.append(image_id)
+        total -= sizes[image_id]
+    return selected
+
+
+def remove_image(info):
+    '''Remove an image by removing all of its tags (or by its ID, if untagged)
+
+    An image used by a container is not removed.
+    '''
+    refs = info.get('RepoTags') or [info['Id']]
+    for ref in refs:
+        dockerutil.docker_rmi(ref)
+    forget(info['Id'])
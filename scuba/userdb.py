@@ -0,0 +1,162 @@
+# User database files generated on the host (--mount-userdb)
+#
+# Normally, scubainit adds the scuba user and group to the /etc/passwd,
+# /etc/group, and /etc/shadow files of every container it runs in. Instead,
+# scuba can generate those files on the host, in the scubadir, and bind-mount
+# them over the image's. The container's root filesystem is then never
+# modified by scubainit, so it can be mounted read-only (--read-only).
+#
+# The image's original files are read once per image (by creating, but not
+# starting, a container), and cached on disk by image ID. The user and group
+# names of the host user are also cached, as looking them up can be slow
+# (e.g. with SSSD or LDAP).
+import os
+import sys
+import time
+
+from . import cache
+from . import dockerutil
+from . import imagecache
+
+ETC_PASSWD = '/etc/passwd'
+ETC_GROUP = '/etc/group'
+ETC_SHADOW = '/etc/shadow'
+
+USERDB_FILES = (ETC_PASSWD, ETC_GROUP, ETC_SHADOW)
+
+# Modes of the generated files, by path
+USERDB_MODES = {
+    ETC_PASSWD: 0o644,
+    ETC_GROUP:  0o644,
+    ETC_SHADOW: 0o600,
+}
+
+# Same as scubainit
+INVALID_PASSWORD = 'x'
+USER_SHELL = '/bin/sh'
+
+NAMES_CACHE = 'names.json'
+
+# How long user and group names are cached for (seconds)
+NAMES_CACHE_TTL = 24 * 60 * 60
+
+
+class UserDBError(Exception):
+    pass
+
+
+def get_names(uid, gid):
+    '''Get the names of a user and group, by their IDs
+
+    Returns: A tuple of (user name, group name)
+
+    Raises KeyError if either does not exist.
+    '''
+    key = '{}:{}'.format(uid, gid)
+    now = time.time()
+
+    names = cache.load(NAMES_CACHE) or {}
+    entry = names.get(key)
+    if entry and 0 <= now - entry[2] < NAMES_CACHE_TTL:
+        return entry[0], entry[1]
+
+    from pwd import getpwuid
+    from grp import getgrgid
+    user = getpwuid(uid).pw_name
+    group = getgrgid(gid).gr_name
+
+    names[key] = [user, group, now]
+    cache.store(NAMES_CACHE, names)
+    return user, group
+
+
+def _image_cache_name(image_id):
+    return 'userdb/{}.json'.format(image_id.replace(':', '-'))
+
+def get_image_files(image):
+    '''Get the original user database files of an image
+
+    Returns: A dict of the content (str) of each of USERDB_FILES, by path,
+             which is None for files which don't exist in the image
+
+    Raises DockerError if the image can not be read.
+    '''
+    image_id = imagecache.get_image_id(image)
+    name = _image_cache_name(image_id)
+
+    files = cache.load(name)
+    if files is not None:
+        return files
+
+    files = {}
+    for path, content in dockerutil.read_image_files(image, USERDB_FILES).items():
+        if content is not None:
+            content = content.decode('utf-8', 'surrogateescape')
+        files[path] = content
+
+    cache.store(name, files)
+    return files
+
+
+def _warn(fmt, *args):
+    print('scuba: ' + fmt.format(*args), file=sys.stderr)
+
+def _append_line(content, line):
+    if content and not content.endswith('\n'):
+        content += '\n'
+    return (content or '') + line + '\n'
+
+def _add_entry(path, content, entry, id_index, what):
+    '''Add an entry to the content of a passwd or group file
+
+    Conflicting entries are handled the same as by scubainit.
+    '''
+    fields = entry.split(':')
+    name, entry_id = fields[0], fields[id_index]
+
+    for line in (content or '').splitlines():
+        f = line.split(':')
+        if len(f) <= id_index:
+            continue
+
+        name_matches = (f[0] == name)
+        id_matches = (f[id_index] == entry_id)
+
+        if name_matches:
+            if id_matches:
+                # Identical name+id exists; surprising, but no problem
+                return content
+            raise UserDBError('{} "{}" already exists with different {}id in {}'.format(
+                what.capitalize(), name, what[0], path))
+
+        if id_matches:
+            _warn('Warning: {}ID {} already exists in {}', what[0].upper(), entry_id, path)
+
+    return _append_line(content, entry)
+
+def add_user(files, uid, gid, user, group, home):
+    '''Add a user and group to the content of user database files
+
+    Args:
+        files: A dict of the content of each of USERDB_FILES (see
+               get_image_files), which is not modified
+
+    Returns: A new dict of the content of each file
+
+    Raises UserDBError if the user or group conflicts with an existing one.
+    '''
+    result = dict(files)
+
+    result[ETC_GROUP] = _add_entry(ETC_GROUP, files.get(ETC_GROUP),
+            ':'.join((group, INVALID_PASSWORD, str(gid), '')), 2, 'group')
+
+    result[ETC_PASSWD] = _add_entry(ETC_PASSWD, files.get(ETC_PASSWD),
+            ':'.join((user, INVALID_PASSWORD, str(uid), str(gid), user, home, USER_SHELL)),
+            2, 'user')
+
+    shadow = files.get(ETC_SHADOW)
+    if not any(line.split(':')[0] == user for line in (shadow or '').splitlines()):
+        shadow = _append_line(shadow, ':'.join([user, INVALID_PASSWORD] + [''] * 7))
+    result[ETC_SHADOW] = shadow
+
+    return result
@@ -1,5 +1,6 @@
 import errno
 import os
+import re
 from shlex import quote as shell_quote
 
 
@@ -38,6 +39,13 @@ def format_cmdline(args, maxwidth=80):
     return ' \\\n'.join(lines())
 
 
+def get_umask():
+    # Same logic as bash/builtins/umask.def
+    val = os.umask(0o22)
+    os.umask(val)
+    return val
+
+
 def parse_env_var(s):
     """Parse an environment variable string
 
@@ -57,6 +65,157 @@ def parse_env_var(s):
     return (k, os.getenv(k, ''))
 
 
+_DURATION_UNITS = dict(s=1, m=60, h=60*60, d=24*60*60)
+
+def parse_duration(s):
+    '''Parse a duration like "90", "90s", "30m", "12h", or "1d"
+
+    Returns the number of seconds; raises ValueError if s is invalid.
+    '''
+    m = re.fullmatch(r'(\d+)([smhd]?)', s.strip())
+    if not m:
+        raise ValueError('Invalid duration: {!r}'.format(s))
+    return int(m.group(1)) * _DURATION_UNITS[m.group(2) or 's']
+
+
+_SIZE_UNITS = dict(k=1024, m=1024**2, g=1024**3, t=1024**4)
+
+def parse_size(s):
+    '''Parse a size like "4096", "512M", or "20G" (binary units)
+
+    Returns the number of bytes; raises ValueError if s is invalid.
+    '''
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([kmgt]?)i?b?', s.strip().lower())
+    if not m:
+        raise ValueError('Invalid size: {!r}'.format(s))
+    return int(float(m.group(1)) * _SIZE_UNITS.get(m.group(2), 1))
+
+
+# The values of boolean flags understood by docker (as by Go's ParseBool)
+_BOOL_VALUES = {
+    '1': True, 't': True, 'T': True, 'true': True, 'TRUE': True, 'True': True,
+    '0': False, 'f': False, 'F': False, 'false': False, 'FALSE': False, 'False': False,
+}
+
+def parse_bool_flag(arg, flag):
+    '''Parse a boolean docker option, like "--read-only" or "--read-only=false"
+
+    Returns the value of the flag, or None if arg is another option; raises
+    ValueError if the value is invalid.
+    '''
+    if arg == flag:
+        return True
+    name, sep, value = arg.partition('=')
+    if name != flag or not sep:
+        return None
+    try:
+        return _BOOL_VALUES[value]
+    except KeyError:
+        raise ValueError('Invalid value for {}: {!r}'.format(flag, value))
+
+
+def format_size(n):
+    '''Format a number of bytes for humans, e.g. "1.5 GiB"'''
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TiB'
+    return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(n)
+
+
+# Scubadirs are named by the PID of the process which created them, so that
+# those left behind (e.g. by --exec, which leaves nothing to remove them) can
+# be found and removed.
+_SCUBADIR_PREFIX = 'scubadir-'
+
+def make_scubadir():
+    '''Make a temporary directory to be bind-mounted into the container
+
+    Returns: Its path
+    '''
+    import tempfile
+    return tempfile.mkdtemp(prefix='{}{}-'.format(_SCUBADIR_PREFIX, os.getpid()))
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def sweep_scubadirs():
+    '''Remove the scubadirs of this user whose processes no longer exist
+
+    Returns: The number of scubadirs removed
+    '''
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.gettempdir()
+    try:
+        names = os.listdir(tmpdir)
+    except OSError:
+        return 0
+
+    uid = os.getuid()
+    removed = 0
+    for name in names:
+        if not name.startswith(_SCUBADIR_PREFIX):
+            continue
+        try:
+            pid = int(name[len(_SCUBADIR_PREFIX):].split('-', 1)[0])
+        except ValueError:
+            continue
+        path = os.path.join(tmpdir, name)
+        try:
+            if os.lstat(path).st_uid != uid:
+                continue
+        except OSError:
+            continue
+        if pid == os.getpid() or _pid_exists(pid):
+            continue
+
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+class BackgroundCall(object):
+    '''Calls a function in a background thread
+
+    The result (or exception) of the call is obtained with result().
+    '''
+    def __init__(self, func, *args, **kwargs):
+        import threading
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._result = None
+        self._exc = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except BaseException as e:
+            self._exc = e
+
+    def result(self):
+        '''Wait for the call to finish, and return its result
+
+        If it raised an exception, it is raised here instead.
+        '''
+        self._thread.join()
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+
 def flatten_list(x):
     if not isinstance(x, list):
         raise ValueError("argument is not a list")
@@ -16,6 +16,10 @@ BASE_VERSION = '2.6.0'
 # with the abbreviated commit hash
 git_archive_rev = "$Format:%h$"
 
+# Name of the module generated by setup.py (build_py / sdist) which holds
+# the version determined at build time
+GENERATED_MODULE = '_version.py'
+
 def git_describe():
     from subprocess import check_call, check_output
 
@@ -31,23 +35,44 @@ def git_describe():
 
     return tag, commits, rev
 
+def get_generated_version():
+    '''Get the version recorded at build time
+
+    Returns: The version string, or None if this is not a built package
+    '''
+    try:
+        from ._version import version
+    except ImportError:
+        return None
+    return version
+
 def get_version():
+    '''Determine the full version of scuba
+
+    This may run git or import pkg_resources, which is slow; it should only
+    be called at build time, or when the user explicitly asks for the version.
+    '''
 
     # Git repo
     # If a local git repository is present, use `git describe` to provide a rich version
     gitdir = normpath(join(PROJPATH, '.git'))
     if exists(gitdir):
-        tag, commits, rev = git_describe()
-
-        # Ensure the base version matches the Git tag
-        if tag != BASE_VERSION:
-            raise Exception('Git revision different from base version')
+        from subprocess import CalledProcessError
+        try:
+            tag, commits, rev = git_describe()
+        except (OSError, CalledProcessError):
+            # e.g. git is not installed, or there are no tags (shallow clone)
+            sys.stderr.write('WARNING: Failed to get version from git\n')
+        else:
+            # Ensure the base version matches the Git tag
+            if tag != BASE_VERSION:
+                raise Exception('Git revision different from base version')
 
-        # No local version if we're on a tag
-        if commits == 0 and not rev.endswith('dirty'):
-            return BASE_VERSION
+            # No local version if we're on a tag
+            if commits == 0 and not rev.endswith('dirty'):
+                return BASE_VERSION
 
-        return '{}+{}-{}'.format(BASE_VERSION, commits, rev)
+            return '{}+{}-{}'.format(BASE_VERSION, commits, rev)
 
 
     # Git archive
@@ -56,6 +81,14 @@ def get_version():
         return '{}+g{}'.format(BASE_VERSION, git_archive_rev)
 
 
+    # Generated module
+    # If we were built by setup.py (including from an sdist), the version was
+    # recorded then.
+    version = get_generated_version()
+    if version:
+        return version
+
+
     # Package resource
     # Otherwise, we're either installed (e.g. via pip), or running from
     # an 'sdist' source distribution, and have a local PKG_INFO file.
@@ -71,7 +104,10 @@ def get_version():
     return BASE_VERSION
 
 
-__version__ = get_version()
+# Importing this module must be cheap, as it happens on every scuba invocation
+# (#71). Only an installed package knows its full version without running git;
+# when running from a source checkout, get_version() must be called explicitly.
+__version__ = get_generated_version() or BASE_VERSION
 
 if __name__ == '__main__':
-    print(__version__)
+    print(get_version())
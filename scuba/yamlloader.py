@@ -0,0 +1,189 @@
+import os
+import re
+import shlex
+import yaml
+
+from . import cache
+
+class LoadContext(object):
+    '''State shared by all of the loaders involved in loading a document
+
+    External documents referenced via !from_yaml are cached here, so each is
+    only read once, regardless of how deeply nested the references are.
+    '''
+    def __init__(self, deps=None):
+        '''
+        Arguments:
+            deps:   Optional dict in which to record a content stamp
+                    (see cache.content_stamp) of each external YAML
+                    document loaded via !from_yaml, by absolute path.
+        '''
+        self.deps = deps
+        self._documents = {}
+
+    def get_document(self, path, loader_cls):
+        '''Get the ExternalDocument at a path, loading it if necessary'''
+        abspath = os.path.abspath(path)
+        doc = self._documents.get(abspath)
+        if doc is None:
+            # Stamp the file before reading it: if it changes in between,
+            # the stamp will be stale, rather than the cached content.
+            if self.deps is not None:
+                self.deps[abspath] = cache.content_stamp(abspath)
+
+            with open(path, 'r') as f:
+                doc = ExternalDocument(loader_cls(f, context=self))
+            self._documents[abspath] = doc
+        return doc
+
+    def dispose(self):
+        for doc in self._documents.values():
+            doc.loader.dispose()
+        self._documents.clear()
+
+
+class ExternalDocument(object):
+    '''An external YAML document referenced via !from_yaml
+
+    The document is composed into a graph of nodes when it is loaded, but only
+    the nodes which are actually referenced are constructed into Python
+    objects. Mappings are indexed by key as they are traversed.
+    '''
+    def __init__(self, loader):
+        self.loader = loader
+        self.root = loader.get_single_node()
+        self._indexes = {}
+
+    def _get_index(self, node):
+        '''Get a dict of a mapping node's value nodes, by string key
+
+        Returns: The index, or None if the node can't be indexed
+        '''
+        if not isinstance(node, yaml.MappingNode) or node.tag != 'tag:yaml.org,2002:map':
+            return None
+
+        index = self._indexes.get(id(node))
+        if index is None:
+            index = {}
+            for key_node, value_node in node.value:
+                if key_node.tag == 'tag:yaml.org,2002:merge':
+                    return None     # Let the constructor handle merge keys
+                if key_node.tag == 'tag:yaml.org,2002:str':
+                    index[key_node.value] = value_node  # Last one wins
+            self._indexes[id(node)] = index
+        return index
+
+    def get(self, keys):
+        '''Get the value at a sequence of nested keys
+
+        Raises KeyError if the key is not found.
+        '''
+        if self.root is None:
+            raise KeyError(keys[0])
+
+        node = self.root
+        for i, k in enumerate(keys):
+            index = self._get_index(node)
+            if index is None:
+                break
+            node = index[k]
+        else:
+            return self.loader.construct_object(node, deep=True)
+
+        # This node can't be indexed (e.g. it has a tag); construct it, and
+        # look up the remaining keys in the result.
+        cur = self.loader.construct_object(node, deep=True)
+        for k in keys[i:]:
+            cur = cur[k]
+        return cur
+
+
+# http://stackoverflow.com/a/9577670
+class LoaderMixin(object):
+    '''Adds scuba's extensions to a yaml safe loader class'''
+
+    def __init__(self, stream, context=None):
+        '''
+        Arguments:
+            stream:     The file object to load
+            context:    The LoadContext shared with other loaders
+        '''
+        self._root = os.path.split(stream.name)[0]
+        self._context = context or LoadContext()
+        super(LoaderMixin, self).__init__(stream)
+
+    def from_yaml(self, node):
+        '''
+        Implementes a !from_yaml constructor with the following syntax:
+            !from_yaml filename key
+
+        Arguments:
+            filename:   Filename of external YAML document from which to load,
+                        relative to the current YAML file.
+            key:        Key from external YAML document to return,
+                        using a dot-separated syntax for nested keys.
+
+        Examples:
+            !from_yaml external.yml pop
+            !from_yaml external.yml foo.bar.pop
+            !from_yaml "another file.yml" "foo bar.snap crackle.pop"
+        '''
+
+        # Load the content from the node, as a scalar
+        content = self.construct_scalar(node)
+
+        # Split on unquoted spaces
+        try:
+            parts = shlex.split(content)
+        except UnicodeEncodeError:
+            raise yaml.YAMLError('Non-ASCII arguments to !from_yaml are unsupported')
+
+        if len(parts) != 2:
+            raise yaml.YAMLError('Two arguments expected to !from_yaml')
+        filename, key = parts
+
+        # path is relative to the current YAML document
+        path = os.path.join(self._root, filename)
+
+        # Load the other YAML document
+        doc = self._context.get_document(path, self.__class__)
+
+        # Retrieve the key
+        # Use a negative look-behind to split the key on non-escaped '.' characters,
+        # and be sure to replace any escaped '.' characters with *just* the '.'
+        keys = [k.replace('\\.', '.') for k in re.split(r'(?<!\\)\.', key)]
+        try:
+            return doc.get(keys)
+        except KeyError:
+            raise yaml.YAMLError('Key "{}" not found in {}'.format(key, filename))
+
+
+class PyLoader(LoaderMixin, yaml.SafeLoader):
+    '''scuba's loader, using the pure-Python yaml parser'''
+
+PyLoader.add_constructor('!from_yaml', PyLoader.from_yaml)
+
+
+# Use libyaml's parser, which is much faster, if PyYAML was built with it
+try:
+    from yaml import CSafeLoader
+except ImportError:
+    CLoader = None
+    Loader = PyLoader
+else:
+    class CLoader(LoaderMixin, CSafeLoader):
+        '''scuba's loader, using libyaml's parser'''
+
+    CLoader.add_constructor('!from_yaml', CLoader.from_yaml)
+    Loader = CLoader
+
+
+def load(stream, loader_cls=None, deps=None):
+    '''Load a single YAML document, like yaml.load(), recording dependencies'''
+    context = LoadContext(deps)
+    loader = (loader_cls or Loader)(stream, context=context)
+    try:
+        return loader.get_single_data()
+    finally:
+        loader.dispose()
+        context.dispose()
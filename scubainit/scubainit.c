@@ -37,8 +37,10 @@
 #define SCUBAINIT_HOOK_USER "SCUBAINIT_HOOK_USER"
 #define SCUBAINIT_HOOK_ROOT "SCUBAINIT_HOOK_ROOT"
 #define SCUBAINIT_VERBOSE   "SCUBAINIT_VERBOSE"
+#define SCUBAINIT_USERDB_MOUNTED "SCUBAINIT_USERDB_MOUNTED"
 
 static bool m_verbose = false;
+static bool m_userdb_mounted = false;
 
 #define NO_VALUE    -1
 #define HAS_VALUE(x)    ((x) != NO_VALUE)
@@ -614,6 +616,16 @@ process_envvars(void)
         m_verbose = true;
     }
 
+    /**
+     * SCUBAINIT_USERDB_MOUNTED indicates that scuba has already added the
+     * user and group to /etc/passwd, /etc/group, and /etc/shadow (which are
+     * bind-mounted, and possibly read-only).
+     */
+    if (getenv(SCUBAINIT_USERDB_MOUNTED)) {
+        unsetenv(SCUBAINIT_USERDB_MOUNTED);
+        m_userdb_mounted = true;
+    }
+
     /* Hook scripts */
     m_user_hook = getenv_str_unset(SCUBAINIT_HOOK_USER);
     m_root_hook = getenv_str_unset(SCUBAINIT_HOOK_ROOT);
@@ -653,13 +665,18 @@ main(int argc, char **argv)
             goto fail;
 
         /* Add scuba user and group */
-        if (add_group(ETC_GROUP, m_group, m_gid) != 0)
-            goto fail;
-        if (add_user(ETC_PASSWD, m_user, m_uid, m_gid,
-                    m_full_name, home) != 0)
-            goto fail;
-        if (add_shadow(ETC_SHADOW, m_user) != 0)
-            goto fail;
+        if (m_userdb_mounted) {
+            verbose("User and group already added by scuba\n");
+        }
+        else {
+            if (add_group(ETC_GROUP, m_group, m_gid) != 0)
+                goto fail;
+            if (add_user(ETC_PASSWD, m_user, m_uid, m_gid,
+                        m_full_name, home) != 0)
+                goto fail;
+            if (add_shadow(ETC_SHADOW, m_user) != 0)
+                goto fail;
+        }
     }
 
     /* Call pre-su hook */
@@ -1,6 +1,7 @@
 import scuba.version
 from setuptools import setup, Command
 from distutils.command.build import build
+from setuptools.command.build_py import build_py
 from setuptools.command.sdist import sdist 
 from subprocess import check_call
 import os
@@ -24,6 +25,20 @@ class build_hook(build):
         self.run_command('build_scubainit')
         build.run(self)
 
+class build_py_hook(build_py):
+    def run(self):
+        build_py.run(self)
+        if not self.dry_run:
+            write_version_module(self.distribution, self.build_lib)
+
+
+class sdist_hook(sdist):
+    def make_release_tree(self, base_dir, files):
+        sdist.make_release_tree(self, base_dir, files)
+        if not self.dry_run:
+            write_version_module(self.distribution, base_dir)
+
+
 def read_project_file(path):
     proj_dir = os.path.dirname(__file__)
     path = os.path.join(proj_dir, path)
@@ -41,7 +56,59 @@ def get_version():
         return '{}.{}'.format(scuba.version.BASE_VERSION, build_num)
 
     # Otherwise, use the auto-versioning
-    return scuba.version.__version__
+    return scuba.version.get_version()
+
+def write_version_module(dist, base_dir):
+    '''Record the version in a generated module
+
+    This lets scuba know its version at runtime without running git or
+    importing pkg_resources (#71).
+    '''
+    path = os.path.join(base_dir, 'scuba', scuba.version.GENERATED_MODULE)
+    if os.path.exists(path):
+        os.unlink(path)     # Don't write through a hard link (sdist)
+    with open(path, 'w') as f:
+        f.write('# Generated by setup.py. Do not edit.\n')
+        f.write('version = {!r}\n'.format(dist.get_version()))
+
+################################################################################
+# Console script
+
+# The default console script written by setuptools for non-wheel installs
+# looks up the entry point via pkg_resources, which dramatically increases
+# scuba's startup time (#71). Instead, emit a script which imports the entry
+# point directly, as pip does when installing a wheel.
+# This is adapted from https://github.com/ninjaaron/fast-entry_point
+
+SCRIPT_TEMPLATE = '''\
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {attr}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw?|\\.exe)?$', '', sys.argv[0])
+    sys.exit({attr}())
+'''
+
+def get_script_args(cls, dist, header=None):
+    if header is None:
+        header = cls.get_header()
+    for name, ep in dist.get_entry_map().get('console_scripts', {}).items():
+        script_text = SCRIPT_TEMPLATE.format(
+                module = ep.module_name,
+                attr = ep.attrs[0],
+                )
+        for res in cls._get_script_args('console', name, header, script_text):
+            yield res
+
+try:
+    from setuptools.command.easy_install import ScriptWriter
+except ImportError:
+    pass
+else:
+    ScriptWriter.get_args = classmethod(get_script_args)
 
 ################################################################################
 
@@ -77,7 +144,9 @@ setup(
     zip_safe = False,   # http://stackoverflow.com/q/24642788/119527
     entry_points = {
         'console_scripts': [
-            'scuba = scuba.__main__:main',
+            'scuba = scuba.client:main',
+            'scuba-admin = scuba.__main__:admin_main',
+            'scubad = scuba.daemon:main',
         ]
     },
     install_requires = [
@@ -94,5 +163,7 @@ setup(
     cmdclass = {
         'build_scubainit':  build_scubainit,
         'build':            build_hook,
+        'build_py':         build_py_hook,
+        'sdist':            sdist_hook,
     },
 )
@@ -0,0 +1,436 @@
+'''A fake Docker daemon, for testing and benchmarking the Engine API client
+
+It serves the subset of the Docker Engine API used by scuba.dockerapi, over a
+UNIX socket. Containers aren't really run; instead, a run handler is called
+with the container config and its stdin, and returns its output and exit
+status.
+'''
+import http.server
+import io
+import json
+import os
+import socketserver
+import tarfile
+import threading
+import time
+import uuid
+from urllib.parse import urlparse, parse_qs
+
+
+def _normalize(name):
+    '''Add the default tag to an image name if it has none'''
+    last = name.rsplit('/', 1)[-1]
+    if not ':' in last and not '@' in last:
+        name += ':latest'
+    return name
+
+
+def make_image(name, entrypoint=None, cmd=None, size=1024):
+    '''Make the inspect data for an image'''
+    image_id = 'sha256:' + uuid.uuid4().hex * 2
+    return dict(
+        Id = image_id,
+        RepoTags = [_normalize(name)],
+        RepoDigests = [name.split(':')[0] + '@sha256:' + uuid.uuid4().hex * 2],
+        Config = dict(Entrypoint=entrypoint, Cmd=cmd),
+        Size = size,
+    )
+
+
+def echo_handler(config, stdin):
+    '''The default run handler: echo stdin to stdout'''
+    return stdin, b'', 0
+
+
+class Container(object):
+    def __init__(self, config):
+        self.id = uuid.uuid4().hex * 2
+        self.config = config
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.exit_code = None
+        self.signals = []
+
+    @property
+    def running(self):
+        return self.started.is_set() and not self.exited.is_set()
+
+    @property
+    def status(self):
+        if self.exited.is_set():
+            return 'exited'
+        return 'running' if self.started.is_set() else 'created'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    @property
+    def daemon(self):
+        return self.server.daemon
+
+    def _send(self, status, body=None, content_type='application/json'):
+        data = b''
+        if body is not None:
+            data = json.dumps(body).encode('utf-8') if content_type == 'application/json' else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+        self.close_connection = True
+
+    def _error(self, status, message):
+        self._send(status, dict(message=message))
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _raw_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        data = b''
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return data
+            data += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        self.daemon.requests.append((self.command, url.path))
+
+        route = None
+        if parts == ['_ping']:
+            route = self._ping
+        elif parts == ['info']:
+            route = self._info
+        elif parts[0] == 'images':
+            if parts == ['images', 'json']:
+                route = self._list_images
+            elif parts == ['images', 'create']:
+                route = self._pull
+            elif parts == ['images', 'get']:
+                route = lambda params: self._save(parse_qs(url.query)['names'])
+            elif parts == ['images', 'load']:
+                route = self._load
+            elif parts[-1] == 'tag':
+                route = lambda params: self._tag(params, '/'.join(parts[1:-1]))
+            elif self.command == 'DELETE':
+                route = lambda params: self._remove_image(params, '/'.join(parts[1:]))
+            elif parts[-1] == 'json':
+                route = lambda params: self._inspect_image(params, '/'.join(parts[1:-1]))
+        elif parts[0] == 'containers':
+            if parts == ['containers', 'json']:
+                route = self._list_containers
+            elif parts == ['containers', 'create']:
+                route = self._create
+            elif len(parts) == 2 and self.command == 'DELETE':
+                route = lambda params: self._delete(params, parts[1])
+            elif len(parts) == 3:
+                route = getattr(self, '_container_' + parts[2], None)
+                if route:
+                    route = lambda params, f=route: f(params, parts[1])
+
+        if not route:
+            return self._error(404, 'page not found')
+        route(params)
+
+    do_GET = do_POST = do_DELETE = _dispatch
+
+    def _ping(self, params):
+        self._send(200, b'OK', 'text/plain')
+
+    def _info(self, params):
+        self._send(200, dict(Driver='overlay2', DriverStatus=self.daemon.driver_status))
+
+    def _list_images(self, params):
+        self._send(200, list(self.daemon.images.values()))
+
+    def _inspect_image(self, params, name):
+        time.sleep(self.daemon.inspect_delay)
+        info = self.daemon.find_image(name)
+        if not info:
+            return self._error(404, 'No such image: {}'.format(name))
+        self._send(200, info)
+
+    def _pull(self, params):
+        name = params['fromImage'] + ':' + params.get('tag', 'latest')
+        self.daemon.auth_headers.append(self.headers.get('X-Registry-Auth'))
+        info = self.daemon.registry.get(name)
+        if not info:
+            return self._error(404, 'pull access denied for {}'.format(params['fromImage']))
+
+        time.sleep(self.daemon.pull_delay)
+        self.daemon.images[name] = info
+        messages = [
+            dict(status='Pulling from ' + params['fromImage'], id=params.get('tag', 'latest')),
+            dict(status='Downloading', progressDetail=dict(current=1, total=2), id='0123abcd'),
+            dict(status='Pull complete', progressDetail={}, id='0123abcd'),
+            dict(status='Digest: ' + info['RepoDigests'][0].split('@')[1]),
+            dict(status='Status: Downloaded newer image for ' + name),
+        ]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for msg in messages:
+            self.wfile.write(json.dumps(msg).encode('utf-8') + b'\r\n')
+        self.close_connection = True
+
+    def _save(self, names):
+        # A (much simplified) `docker save` archive: manifest.json, and the
+        # inspect data of each image as its config
+        manifest = []
+        configs = {}
+        for name in names:
+            info = self.daemon.find_image(name)
+            if not info:
+                return self._error(404, 'No such image: {}'.format(name))
+            config_name = info['Id'][len('sha256:'):] + '.json'
+            configs[config_name] = json.dumps(info).encode('utf-8')
+            # Images saved by digest are untagged
+            tags = [] if '@' in name else [_normalize(name)]
+            manifest.append(dict(Config=config_name, RepoTags=tags))
+        configs['manifest.json'] = json.dumps(manifest).encode('utf-8')
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for name, data in configs.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self._send(200, buf.getvalue(), 'application/x-tar')
+
+    def _load(self, params):
+        try:
+            with tarfile.open(fileobj=io.BytesIO(self._raw_body())) as tar:
+                manifest = json.load(tar.extractfile('manifest.json'))
+                for entry in manifest:
+                    # docker load doesn't restore repository digests
+                    info = json.load(tar.extractfile(entry['Config']))
+                    info['RepoDigests'] = []
+                    if not entry['RepoTags']:
+                        self.daemon.images.setdefault(info['Id'], info)
+                    for tag in entry['RepoTags']:
+                        # A replaced image remains, untagged
+                        old = self.daemon.images.get(tag)
+                        if old and old['Id'] != info['Id']:
+                            self.daemon.images[old['Id']] = old
+                        self.daemon.images[tag] = info
+        except (tarfile.TarError, KeyError) as e:
+            return self._error(500, 'invalid archive: {}'.format(e))
+        self.daemon.loads += 1
+        self._send(200, dict(stream='Loaded image'))
+
+    def _tag(self, params, name):
+        info = self.daemon.find_image(name)
+        if not info:
+            return self._error(404, 'No such image: {}'.format(name))
+        self.daemon.images[params['repo'] + ':' + params['tag']] = info
+        self._send(201)
+
+    def _remove_image(self, params, name):
+        info = self.daemon.find_image(name)
+        if not info:
+            return self._error(404, 'No such image: {}'.format(name))
+
+        keys = [k for k, v in self.daemon.images.items() if v is info]
+        if _normalize(name) in keys:
+            keys = [_normalize(name)]    # Untag
+        if len(keys) == len([v for v in self.daemon.images.values() if v is info]):
+            for c in self.daemon.containers.values():
+                if self.daemon.find_image(c.config['Image']) is info:
+                    return self._error(409, 'image is being used by container {}'.format(c.id))
+        for k in keys:
+            del self.daemon.images[k]
+        self._send(200, [dict(Untagged=k) for k in keys])
+
+    def _list_containers(self, params):
+        filters = json.loads(params.get('filters', '{}'))
+        def matches(c):
+            if params.get('all') != '1' and not c.running:
+                return False
+            labels = c.config.get('Labels') or {}
+            if not all(l in labels for l in filters.get('label', [])):
+                return False
+            return c.status in filters.get('status', [c.status])
+
+        self._send(200, [dict(Id=c.id, Image=c.config['Image'],
+                              ImageID=self.daemon.find_image(c.config['Image'])['Id'],
+                              Labels=c.config.get('Labels') or {}, State=c.status)
+                         for c in self.daemon.containers.values() if matches(c)])
+
+    def _create(self, params):
+        config = self._body()
+        if not self.daemon.find_image(config['Image']):
+            return self._error(404, 'No such image: {}'.format(config['Image']))
+        container = Container(config)
+        self.daemon.containers[container.id] = container
+        self._send(201, dict(Id=container.id, Warnings=[]))
+
+    def _get_container(self, cid):
+        container = self.daemon.containers.get(cid)
+        if not container:
+            self._error(404, 'No such container: {}'.format(cid))
+        return container
+
+    def _delete(self, params, cid):
+        container = self._get_container(cid)
+        if container:
+            if container.running and params.get('force') != '1':
+                return self._error(409, 'cannot remove a running container')
+            del self.daemon.containers[cid]
+            self.daemon.removed.append(cid)
+            self._send(204)
+
+    def _container_json(self, params, cid):
+        container = self._get_container(cid)
+        if container:
+            self._send(200, dict(Id=container.id, Config=container.config,
+                                 State=dict(Status=container.status, Running=container.running)))
+
+    def _container_start(self, params, cid):
+        container = self._get_container(cid)
+        if container:
+            container.started.set()
+            self._send(204)
+
+    def _container_wait(self, params, cid):
+        container = self._get_container(cid)
+        if container:
+            container.exited.wait()
+            self._send(200, dict(StatusCode=container.exit_code))
+
+    def _container_kill(self, params, cid):
+        container = self._get_container(cid)
+        if container:
+            container.signals.append(params.get('signal', 'SIGKILL'))
+            self._send(204)
+
+    def _container_attach(self, params, cid):
+        container = self._get_container(cid)
+        if not container:
+            return
+
+        # Hijack the connection
+        self.wfile.write(b'HTTP/1.1 101 UPGRADED\r\n'
+                         b'Content-Type: application/vnd.docker.raw-stream\r\n'
+                         b'Connection: Upgrade\r\n'
+                         b'Upgrade: tcp\r\n'
+                         b'\r\n')
+        self.close_connection = True
+
+        container.started.wait()
+        stdin = b''
+        if params.get('stdin') == '1':
+            stdin = self.rfile.read()
+
+        stdout, stderr, container.exit_code = self.daemon.run_handler(container, stdin)
+        for stream, data in ((1, stdout), (2, stderr)):
+            if data:
+                header = bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big')
+                self.wfile.write(header + data)
+        container.exited.set()
+
+    def _container_archive(self, params, cid):
+        container = self._get_container(cid)
+        if not container:
+            return
+        image = self.daemon.find_image(container.config['Image'])
+        path = params.get('path', '')
+        content = self.daemon.image_files.get(image['Id'], {}).get(path)
+        if content is None:
+            return self._error(404, 'Could not find the file {} in container {}'.format(path, cid))
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            info = tarfile.TarInfo(os.path.basename(path))
+            if isinstance(content, tuple):
+                info.type = tarfile.SYMTYPE
+                info.linkname = content[1]
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        self._send(200, buf.getvalue(), 'application/x-tar')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class FakeDockerDaemon(object):
+    '''A fake Docker daemon listening on a UNIX socket
+
+    Attributes:
+        images: Local images, by name (with tag)
+        registry: Images which can be pulled, by name (with tag)
+        image_files: Files which can be read from containers, by image ID, then
+                     by path; either their content (bytes), or ('link', target)
+                     for symbolic links
+        containers: Containers which have not been removed, by ID
+        removed: IDs of removed containers
+        requests: (method, path) of each request made
+        driver_status: The DriverStatus reported by `docker info`
+        auth_headers: X-Registry-Auth header of each pull request
+        run_handler: Called as run_handler(container, stdin) when a container
+                     runs; returns (stdout, stderr, exit_code)
+        pull_delay: How long (in seconds) pulling an image takes
+        inspect_delay: How long (in seconds) inspecting an image takes
+        loads: The number of archives loaded
+    '''
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.images = {}
+        self.registry = {}
+        self.image_files = {}
+        self.containers = {}
+        self.removed = []
+        self.requests = []
+        self.driver_status = [['Backing Filesystem', 'extfs']]
+        self.auth_headers = []
+        self.pull_delay = 0
+        self.inspect_delay = 0
+        self.loads = 0
+        self.run_handler = lambda container, stdin: echo_handler(container.config, stdin)
+        self._server = None
+
+    def find_image(self, name):
+        info = self.images.get(_normalize(name))
+        if info:
+            return info
+        for info in self.images.values():
+            if name in (info['Id'], info['Id'][len('sha256:'):]) or name in info['RepoDigests']:
+                return info
+        return None
+
+    def start(self):
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.daemon = self
+        threading.Thread(target=self._server.serve_forever, args=(0.01,), daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        os.unlink(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
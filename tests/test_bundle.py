@@ -0,0 +1,175 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import gzip
+import json
+import os
+import tarfile
+from tempfile import TemporaryFile
+
+import scuba.bundle as uut
+import scuba.dockerutil
+import scuba.imagecache
+import scuba.lockfile
+import scuba.__main__ as main
+from .fakedockerd import FakeDockerDaemon, make_image
+
+
+CONFIG = '''\
+image: busybox
+aliases:
+  a:
+    image: debian:buster
+    script: make
+'''
+
+class TestBundle(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write(CONFIG)
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+        self.busybox = self.daemon.images['busybox:latest'] = make_image('busybox')
+        self.debian = self.daemon.registry['debian:buster'] = make_image('debian:buster')
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        scuba.imagecache._inspected.clear()
+        super().tearDown()
+
+    def _run_admin(self, args, exp_retval=0):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                main.admin_main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def test_save(self):
+        '''scuba-admin bundle save writes all images, with an index first'''
+        output = self._run_admin(['bundle', 'save', '-o', 'b.tgz'])
+        assert_in('Saved 2 image(s) to b.tgz', output)
+
+        with tarfile.open('b.tgz', 'r:gz') as tar:
+            names = tar.getnames()
+            index = json.load(tar.extractfile(uut.INDEX_NAME))
+        assert_equal(names[0], uut.INDEX_NAME)
+        assert_in('manifest.json', names)
+        assert_equal(index, dict(version=2, images={
+            'busybox': self.busybox['Id'],
+            'debian:buster': self.debian['Id'],
+        }, digests={}))
+        assert_false([n for n in os.listdir('.') if n.endswith('.tmp')])
+
+    def test_load(self):
+        '''scuba-admin bundle load loads missing images'''
+        self._run_admin(['bundle', 'save'])
+        self.daemon.images.clear()
+
+        output = self._run_admin(['bundle', 'load'])
+        assert_in('Loaded 2 image(s) from scuba-bundle.tar.gz; 0 already existed', output)
+        assert_equal(self.daemon.images['busybox:latest']['Id'], self.busybox['Id'])
+        assert_equal(self.daemon.images['debian:buster']['Id'], self.debian['Id'])
+
+    def test_load_locked(self):
+        '''Images pinned by .scuba.lock are run from the bundle, without pulling'''
+        digest = self.busybox['RepoDigests'][0]
+        with open('.scuba.lock', 'w') as f:
+            json.dump(dict(version=1, images={'busybox': digest}), f)
+
+        self._run_admin(['bundle', 'save'])
+        with tarfile.open('scuba-bundle.tar.gz', 'r:gz') as tar:
+            index = json.load(tar.extractfile(uut.INDEX_NAME))
+        assert_equal(index['digests'], {'busybox': digest})
+
+        self.daemon.images.clear()
+        self.daemon.registry.clear()
+        self._run_admin(['bundle', 'load'])
+        del self.daemon.requests[:]
+
+        local_tag = scuba.lockfile.local_tag(digest)
+        assert_equal(self.daemon.images[local_tag]['Id'], self.busybox['Id'])
+        assert_equal(scuba.lockfile.local_ref(digest), local_tag)
+
+        # ... nor pulled
+        output = self._run_admin(['pull'])
+        assert_in('0 of 2 image(s) need to be pulled', output)
+
+        # A pinned image which was loaded already exists
+        output = self._run_admin(['bundle', 'load'])
+        assert_in('Loaded 0 image(s)', output)
+        assert_equal(self.daemon.loads, 1)
+        assert_not_in(('POST', '/images/create'), self.daemon.requests)
+
+    def test_local_ref(self):
+        '''Digest references which exist are used as-is'''
+        digest = self.busybox['RepoDigests'][0]
+        assert_equal(scuba.lockfile.local_ref(digest), digest)
+        assert_equal(scuba.lockfile.local_ref('busybox'), 'busybox')
+        assert_equal(scuba.lockfile.local_ref('nope@sha256:' + '0' * 64), 'nope@sha256:' + '0' * 64)
+
+    def test_load_all_present(self):
+        '''scuba-admin bundle load doesn't load anything if all images exist'''
+        self._run_admin(['bundle', 'save'])
+        output = self._run_admin(['bundle', 'load'])
+        assert_in('Loaded 0 image(s)', output)
+        assert_equal(self.daemon.loads, 0)
+
+    def test_load_keeps_present(self):
+        '''scuba-admin bundle load keeps existing images which differ from the bundle'''
+        self._run_admin(['bundle', 'save'])
+        del self.daemon.images['debian:buster']
+        newer = self.daemon.images['busybox:latest'] = make_image('busybox')
+
+        self._run_admin(['bundle', 'load'])
+        assert_equal(self.daemon.loads, 1)
+        assert_equal(self.daemon.images['debian:buster']['Id'], self.debian['Id'])
+        assert_equal(self.daemon.images['busybox:latest'], newer)
+
+    def test_not_a_bundle(self):
+        '''scuba-admin bundle load fails for something other than a bundle'''
+        with gzip.open('scuba-bundle.tar.gz', 'wb') as f:
+            f.write(b'garbage')
+        output = self._run_admin(['bundle', 'load'], 128)
+        assert_in('scuba:', output)
+
+    def test_bad_index_closed(self):
+        '''The bundle is closed if its index can't be read'''
+        with tarfile.open('scuba-bundle.tar.gz', 'w:gz') as tar:
+            tar.add('.scuba.yml', arcname=uut.INDEX_NAME)
+
+        opened = []
+        real_open = tarfile.open
+        def open_tar(*args, **kwargs):
+            opened.append(real_open(*args, **kwargs))
+            return opened[-1]
+
+        with mock.patch('tarfile.open', open_tar):
+            assert_raises(uut.BundleError, uut.load_bundle, 'scuba-bundle.tar.gz')
+        assert_true(opened[0].closed)
+
+    def test_missing_bundle(self):
+        '''scuba-admin bundle load fails if the bundle doesn't exist'''
+        output = self._run_admin(['bundle', 'load', '-i', 'nope.tgz'], 128)
+        assert_in('nope.tgz', output)
+
+    @mock.patch.dict('os.environ', SCUBA_DOCKER_BACKEND='cli')
+    def test_load_cli_error(self):
+        '''docker_load raises DockerError if docker load fails'''
+        cp = mock.Mock(returncode=1, stderr=b'invalid tar header\n')
+        with mock.patch('subprocess.run', return_value=cp) as run_mock:
+            with TemporaryFile() as f:
+                assert_raises(scuba.dockerutil.DockerError, scuba.dockerutil.docker_load, f)
+        assert_equal(run_mock.call_args[0][0], ['docker', 'load', '--quiet'])
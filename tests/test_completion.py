@@ -0,0 +1,122 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+import time
+
+import scuba.completion as uut
+
+
+class TestCompletion(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+
+        # Docker host image store is not readable
+        self.store_patch = mock.patch('scuba.imagecache.DOCKER_IMAGE_DB',
+                os.path.join(self.path, 'nonexistent'))
+        self.store_patch.start()
+
+    def tearDown(self):
+        self.store_patch.stop()
+        super().tearDown()
+
+    def _write_config(self, *aliases):
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+            f.write('aliases:\n')
+            for a in aliases:
+                f.write('  {}: echo {}\n'.format(a, a))
+
+    ######################################################################
+    # Aliases
+
+    def test_list_aliases(self):
+        '''list_aliases returns sorted alias names'''
+        self._write_config('foo', 'bar')
+        assert_seq_equal(uut.list_aliases(), ['bar', 'foo'])
+
+    def test_list_aliases_cached(self):
+        '''list_aliases doesn't load the config when the cache is warm'''
+        self._write_config('foo', 'bar')
+        uut.list_aliases()
+
+        with mock.patch('scuba.completion.load_config') as load_mock:
+            result = uut.list_aliases()
+
+        assert_false(load_mock.called)
+        assert_seq_equal(result, ['bar', 'foo'])
+
+    def test_list_aliases_invalidated(self):
+        '''list_aliases reloads the config when it changes'''
+        self._write_config('foo')
+        uut.list_aliases()
+
+        self._write_config('foo', 'snap')
+        assert_seq_equal(uut.list_aliases(), ['foo', 'snap'])
+
+    def test_list_aliases_included_changed(self):
+        '''list_aliases reloads the config when an included file changes'''
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+            f.write('aliases: !from_yaml aliases.yml aliases\n')
+        with open('aliases.yml', 'w') as f:
+            f.write('aliases:\n  foo: echo foo\n')
+        assert_seq_equal(uut.list_aliases(), ['foo'])
+
+        with open('aliases.yml', 'w') as f:
+            f.write('aliases:\n  foo: echo foo\n  snap: echo snap\n')
+        assert_seq_equal(uut.list_aliases(), ['foo', 'snap'])
+
+    def test_list_aliases_from_subdir(self):
+        '''list_aliases finds the config in a parent directory'''
+        self._write_config('foo')
+        os.mkdir('subdir')
+        os.chdir('subdir')
+        assert_seq_equal(uut.list_aliases(), ['foo'])
+
+    def test_list_aliases_no_cache(self):
+        '''list_aliases works with caching disabled'''
+        self._write_config('foo')
+        with mock.patch.dict('os.environ', SCUBA_NO_CACHE='1'):
+            assert_seq_equal(uut.list_aliases(), ['foo'])
+        assert_equal(os.listdir(self.cache_dir), [])
+
+    ######################################################################
+    # Images
+
+    def test_list_images_cached(self):
+        '''list_images doesn't run docker when the cache is warm'''
+        with mock.patch('scuba.dockerutil.get_images', return_value=['a', 'b']) as gi:
+            assert_seq_equal(uut.list_images(), ['a', 'b'])
+            assert_seq_equal(uut.list_images(), ['a', 'b'])
+        assert_equal(gi.call_count, 1)
+
+    def test_list_images_ttl(self):
+        '''list_images runs docker again after the TTL expires'''
+        with mock.patch('scuba.dockerutil.get_images', return_value=['a']) as gi:
+            uut.list_images()
+            with mock.patch('time.time', return_value=time.time() + uut.IMAGES_TTL + 1):
+                uut.list_images()
+        assert_equal(gi.call_count, 2)
+
+    def test_list_images_store_changed(self):
+        '''list_images runs docker again when the image store changes'''
+        store = os.path.join(self.path, 'image')
+        repos = os.path.join(store, 'overlay2', 'repositories.json')
+        os.makedirs(os.path.dirname(repos))
+        with open(repos, 'w') as f:
+            f.write('{}')
+
+        with mock.patch('scuba.imagecache.DOCKER_IMAGE_DB', store), \
+             mock.patch('scuba.dockerutil.uses_containerd_store', return_value=False), \
+             mock.patch('scuba.dockerutil.get_images', return_value=['a']) as gi:
+            uut.list_images()
+            uut.list_images()
+            assert_equal(gi.call_count, 1)
+
+            with open(repos, 'w') as f:
+                f.write('{"Repositories": {}}')
+            uut.list_images()
+            assert_equal(gi.call_count, 2)
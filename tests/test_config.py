@@ -2,13 +2,17 @@
 from nose.tools import *
 from .utils import *
 from unittest import TestCase
+from unittest import mock
 
 import logging
 import os
+import sys
 from os.path import join
 from shutil import rmtree
 import shlex
+import subprocess
 
+import scuba
 import scuba.config
 
 
@@ -104,6 +108,95 @@ class TestConfig(TmpDirTestCase):
         with self.assertRaises(scuba.config.ConfigError):
             scuba.config.find_config()
 
+    def _make_subdirs(self):
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+
+        os.makedirs(join('foo', 'bar'))
+        os.chdir(join('foo', 'bar'))
+
+    def test_find_config_scuba_root(self):
+        '''find_config uses SCUBA_ROOT without searching'''
+        self._make_subdirs()
+
+        with mock.patch.dict('os.environ', SCUBA_ROOT=self.path), \
+             mock.patch('scuba.config._walk_config_dir') as walk_mock:
+            path, rel, config = scuba.config.find_config()
+
+        assert_false(walk_mock.called)
+        assert_paths_equal(path, self.path)
+        assert_paths_equal(rel, join('foo', 'bar'))
+        assert_equal(config.image, 'busybox')
+
+    def test_find_config_scuba_config(self):
+        '''find_config uses SCUBA_CONFIG, which can have any name'''
+        os.mkdir('ci')
+        with open(join('ci', 'scuba-ci.yml'), 'w') as f:
+            f.write('image: debian\n')
+
+        os.chdir('ci')
+        with mock.patch.dict('os.environ', SCUBA_CONFIG='scuba-ci.yml'):
+            path, rel, config = scuba.config.find_config()
+
+        assert_paths_equal(path, join(self.path, 'ci'))
+        assert_equal(rel, '')
+        assert_equal(config.image, 'debian')
+
+    def test_find_config_scuba_root_missing(self):
+        '''find_config raises ConfigNotFoundError if SCUBA_ROOT has no config'''
+        with mock.patch.dict('os.environ', SCUBA_ROOT=self.path):
+            with self.assertRaises(scuba.config.ConfigNotFoundError):
+                scuba.config.find_config()
+
+    def test_find_config_scuba_root_outside(self):
+        '''find_config raises ConfigError if cwd is not beneath SCUBA_ROOT'''
+        os.mkdir('root')
+        with open(join('root', '.scuba.yml'), 'w') as f:
+            f.write('image: busybox\n')
+
+        with mock.patch.dict('os.environ', SCUBA_ROOT=join(self.path, 'root')):
+            with self.assertRaises(scuba.config.ConfigError):
+                scuba.config.find_config()
+
+    def test_find_config_cached(self):
+        '''find_config doesn't search again from the same directory'''
+        self.enable_cache()
+        self._make_subdirs()
+        scuba.config.find_config()
+
+        with mock.patch('scuba.config._walk_config_dir') as walk_mock:
+            path, rel, _ = scuba.config.find_config()
+
+        assert_false(walk_mock.called)
+        assert_paths_equal(path, self.path)
+        assert_paths_equal(rel, join('foo', 'bar'))
+
+    def test_find_config_cache_invalidated(self):
+        '''find_config searches again if the found config changed'''
+        self.enable_cache()
+        self._make_subdirs()
+        scuba.config.find_config()
+
+        # Move the config down a level
+        os.rename(join(self.path, '.scuba.yml'), join(self.path, 'foo', '.scuba.yml'))
+
+        path, rel, _ = scuba.config.find_config()
+        assert_paths_equal(path, join(self.path, 'foo'))
+        assert_paths_equal(rel, 'bar')
+
+    def test_find_config_cache_cross_fs(self):
+        '''find_config searches again if SCUBA_DISCOVERY_ACROSS_FILESYSTEM changes'''
+        self.enable_cache()
+        self._make_subdirs()
+        scuba.config.find_config()
+
+        real_walk = scuba.config._walk_config_dir
+        with mock.patch.dict('os.environ', SCUBA_DISCOVERY_ACROSS_FILESYSTEM='1'), \
+             mock.patch('scuba.config._walk_config_dir', side_effect=real_walk) as walk_mock:
+            scuba.config.find_config()
+
+        assert_true(walk_mock.called)
+
     ######################################################################
     # Load config
 
@@ -340,6 +433,44 @@ class TestConfig(TmpDirTestCase):
         assert_equal(len(result.script), 1)
         assert_equal(shlex.split(result.script[0]), ['banana', 'arg1', 'arg2'])
 
+    def test_process_command_aliases_lazy(self):
+        '''process_command only builds the alias which is used'''
+        cfg = scuba.config.ScubaConfig(
+                image = 'na',
+                aliases = dict(
+                    apple = 'banana',
+                    broken = dict(image='no script'),
+                    ),
+                )
+        with mock.patch('scuba.config.ScubaAlias.from_dict',
+                side_effect=scuba.config.ScubaAlias.from_dict) as from_dict:
+            result = cfg.process_command(['apple'])
+
+        from_dict.assert_called_once_with('apple', 'banana')
+        assert_equal(shlex.split(result.script[0]), ['banana'])
+
+    def test_aliases_validated_on_access(self):
+        '''An invalid alias raises ConfigError when it is used'''
+        cfg = scuba.config.ScubaConfig(
+                image = 'na',
+                aliases = dict(broken = dict(image='no script')),
+                )
+        assert_seq_equal(cfg.aliases, ['broken'])
+        with self.assertRaises(scuba.config.ConfigError):
+            cfg.process_command(['broken'])
+
+    def test_validate(self):
+        '''validate checks every alias'''
+        cfg = scuba.config.ScubaConfig(
+                image = 'na',
+                aliases = dict(
+                    apple = 'banana',
+                    broken = dict(image='no script'),
+                    ),
+                )
+        with self.assertRaises(scuba.config.ConfigError):
+            cfg.validate()
+
     def test_process_command_aliases_used_withargs(self):
         '''process_command handles aliases with args'''
         cfg = scuba.config.ScubaConfig(
@@ -731,3 +862,268 @@ class TestConfig(TmpDirTestCase):
 
         config = scuba.config.load_config('.scuba.yml')
         self.assertEqual(config.aliases['testalias'].entrypoint, 'use_this_ep')
+
+
+    ############################################################################
+    # Pull policy
+
+    def test_pull_default(self):
+        '''The pull policy defaults to missing'''
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: na\n')
+
+        config = scuba.config.load_config('.scuba.yml')
+        self.assertEqual(config.pull_policy, ('missing', None))
+
+    def test_pull_modes(self):
+        '''The pull policy can be set'''
+        for value, expected in (
+                ('never', ('never', None)),
+                ('always', ('always', None)),
+                ('ttl=90', ('ttl', 90)),
+                ('ttl=30m', ('ttl', 30*60)),
+                ('ttl=1d', ('ttl', 24*60*60)),
+                ):
+            with open('.scuba.yml', 'w') as f:
+                f.write('image: na\n')
+                f.write('pull: "{}"\n'.format(value))
+
+            config = scuba.config.load_config('.scuba.yml')
+            self.assertEqual(config.pull_policy, expected)
+
+    def test_pull_invalid(self):
+        '''An invalid pull policy raises ConfigError'''
+        for value in ('sometimes', 'ttl=', 'ttl=5y', 'true'):
+            with open('.scuba.yml', 'w') as f:
+                f.write('image: na\n')
+                f.write('pull: {}\n'.format(value))
+
+            self._test_invalid_config()
+
+    def test_alias_pull(self):
+        '''An alias can override the pull policy'''
+        with open('.scuba.yml', 'w') as f:
+            f.write(r'''
+                image: na
+                pull: never
+                aliases:
+                  fresh:
+                    pull: ttl=1h
+                    script: make
+                  plain: make
+                ''')
+
+        config = scuba.config.load_config('.scuba.yml')
+        self.assertEqual(config.process_command(['fresh']).pull_policy, ('ttl', 60*60))
+        self.assertEqual(config.process_command(['plain']).pull_policy, ('never', None))
+        self.assertEqual(config.process_command(['ls']).pull_policy, ('never', None))
+
+
+class TestConfigCache(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _load_config(self, exp_parsed):
+        '''Load .scuba.yml, asserting whether or not it was parsed'''
+        real_parse = scuba.config._parse_config
+        with mock.patch('scuba.config._parse_config', side_effect=real_parse) as m:
+            config = scuba.config.load_config('.scuba.yml')
+        assert_equal(m.called, exp_parsed)
+        return config
+
+    def test_cache_hit(self):
+        '''load_config doesn't parse an unchanged config'''
+        self._write('.scuba.yml', 'image: busybox\naliases:\n  foo: bar\n')
+
+        self._load_config(True)
+        config = self._load_config(False)
+        assert_equal(config.image, 'busybox')
+        assert_seq_equal(config.aliases['foo'].script, ['bar'])
+
+    def test_cache_hit_no_yaml_import(self):
+        '''load_config doesn't import yaml for a cached config'''
+        self._write('.scuba.yml', 'image: busybox\n')
+        scuba.config.load_config('.scuba.yml')
+
+        code = 'import sys, scuba.config; ' \
+               'print(scuba.config.load_config(".scuba.yml").image, "yaml" in sys.modules)'
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(scuba.__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], env=env,
+                universal_newlines=True)
+        assert_equal(out.split(), ['busybox', 'False'])
+
+    def test_cache_root_changed(self):
+        '''load_config re-parses a changed config'''
+        self._write('.scuba.yml', 'image: busybox\n')
+        self._load_config(True)
+
+        self._write('.scuba.yml', 'image: debian\n')
+        config = self._load_config(True)
+        assert_equal(config.image, 'debian')
+
+    def test_cache_root_touched(self):
+        '''load_config doesn't re-parse a config whose mtime changed, but not its content'''
+        self._write('.scuba.yml', 'image: busybox\n')
+        self._load_config(True)
+
+        st = os.stat('.scuba.yml')
+        os.utime('.scuba.yml', ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self._load_config(False)
+
+    def test_cache_dependency_changed(self):
+        '''load_config re-parses a config when a !from_yaml file changes'''
+        os.mkdir('sub')
+        self._write('sub/.gitlab.yml', 'image: debian:8.2\n')
+        self._write('sub/.other.yml', 'image: !from_yaml .gitlab.yml image\n')
+        self._write('.scuba.yml', 'image: !from_yaml sub/.other.yml image\n')
+
+        self._load_config(True)
+        self._load_config(False)
+
+        # Change the nested dependency
+        self._write('sub/.gitlab.yml', 'image: debian:10.1\n')
+        config = self._load_config(True)
+        assert_equal(config.image, 'debian:10.1')
+
+    def test_cache_racy_stamp(self):
+        '''load_config doesn't trust the mtime of a recently-modified config'''
+        self._write('.scuba.yml', 'image: busybox\n')
+        self._load_config(True)
+
+        # Change the content, keeping the same size and mtime
+        st = os.stat('.scuba.yml')
+        self._write('.scuba.yml', 'image: busyfox\n')
+        os.utime('.scuba.yml', ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        config = self._load_config(True)
+        assert_equal(config.image, 'busyfox')
+
+    def test_cache_uncacheable_data(self):
+        '''load_config doesn't cache data which can't be represented'''
+        self._write('.scuba.yml', 'image: busybox\nenvironment:\n  WHEN: 2001-12-14\n')
+
+        config = self._load_config(True)
+        assert_equal(config.environment['WHEN'], '2001-12-14')
+        self._load_config(True)
+
+    def test_cache_errors_not_cached(self):
+        '''load_config doesn't cache configs which fail to load'''
+        self._write('.scuba.yml', 'image: !from_yaml .nonexistent.yml image\n')
+        with self.assertRaises(scuba.config.ConfigError):
+            scuba.config.load_config('.scuba.yml')
+
+        self._write('.nonexistent.yml', 'image: busybox\n')
+        config = self._load_config(True)
+        assert_equal(config.image, 'busybox')
+
+
+class TestLoaders(TmpDirTestCase):
+    '''Both the pure-Python and libyaml loaders support !from_yaml'''
+
+    def _test_loader(self, loader_cls):
+        import scuba.yamlloader
+
+        os.mkdir('sub')
+        with open('sub/.gitlab.yml', 'w') as f:
+            f.write('job:\n  image: debian:8.2\n  script: [make]\n')
+        with open('sub/.other.yml', 'w') as f:
+            # Relative to sub/.other.yml, not .scuba.yml
+            f.write('image: !from_yaml .gitlab.yml job.image\n')
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: !from_yaml sub/.other.yml image\n')
+            f.write('aliases:\n')
+            f.write('  job: !from_yaml sub/.gitlab.yml job\n')
+
+        with open('.scuba.yml', 'r') as f:
+            data = scuba.yamlloader.load(f, loader_cls)
+
+        assert_equal(data, dict(
+            image = 'debian:8.2',
+            aliases = dict(job=dict(image='debian:8.2', script=['make'])),
+        ))
+
+    def test_py_loader(self):
+        '''PyLoader supports !from_yaml'''
+        import scuba.yamlloader
+        self._test_loader(scuba.yamlloader.PyLoader)
+
+    def test_c_loader(self):
+        '''CLoader supports !from_yaml'''
+        import scuba.yamlloader
+        if not scuba.yamlloader.CLoader:
+            self.skipTest('PyYAML was built without libyaml')
+        self._test_loader(scuba.yamlloader.CLoader)
+
+
+class TestFromYaml(TmpDirTestCase):
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_nested_documents_loaded_once(self):
+        '''!from_yaml loads each external document once, across nesting levels'''
+        self._write('common.yml', 'a: debian:8.2\nb: echo b\n')
+        self._write('one.yml', 'image: !from_yaml common.yml a\n')
+        self._write('two.yml', 'script: !from_yaml common.yml b\n')
+        self._write('.scuba.yml', '\n'.join([
+            'image: !from_yaml one.yml image',
+            'aliases:',
+            '  two: !from_yaml two.yml script',
+            '  three: !from_yaml common.yml b',
+            '',
+        ]))
+
+        with mock_open() as m:
+            config = scuba.config.load_config('.scuba.yml')
+
+        opened = [c[1][0] for c in m.mock_calls]
+        assert_equal(sorted(opened), ['.scuba.yml', 'common.yml', 'one.yml', 'two.yml'])
+        assert_equal(config.image, 'debian:8.2')
+        assert_seq_equal(config.aliases['two'].script, ['echo b'])
+        assert_seq_equal(config.aliases['three'].script, ['echo b'])
+
+    def test_only_referenced_keys_constructed(self):
+        '''!from_yaml only constructs the referenced part of a document'''
+        # An unknown tag can't be constructed by the safe loader
+        self._write('common.yml', 'image: debian:8.2\nother: !unknown tag\n')
+        self._write('.scuba.yml', 'image: !from_yaml common.yml image\n')
+
+        config = scuba.config.load_config('.scuba.yml')
+        assert_equal(config.image, 'debian:8.2')
+
+    def test_merge_keys(self):
+        '''!from_yaml supports keys from merged mappings'''
+        self._write('common.yml', '\n'.join([
+            'base: &base',
+            '  image: debian:8.2',
+            'job:',
+            '  <<: *base',
+            '  script: make',
+            '',
+        ]))
+        self._write('.scuba.yml', 'image: !from_yaml common.yml job.image\n')
+
+        config = scuba.config.load_config('.scuba.yml')
+        assert_equal(config.image, 'debian:8.2')
+
+    def test_key_beneath_tagged_node(self):
+        '''!from_yaml supports keys beneath another !from_yaml'''
+        self._write('inner.yml', 'job:\n  image: debian:8.2\n')
+        self._write('outer.yml', 'job: !from_yaml inner.yml job\n')
+        self._write('.scuba.yml', 'image: !from_yaml outer.yml job.image\n')
+
+        config = scuba.config.load_config('.scuba.yml')
+        assert_equal(config.image, 'debian:8.2')
+
+    def test_empty_document(self):
+        '''!from_yaml raises ConfigError for a key in an empty document'''
+        self._write('empty.yml', '')
+        self._write('.scuba.yml', 'image: !from_yaml empty.yml image\n')
+
+        with self.assertRaises(scuba.config.ConfigError):
+            scuba.config.load_config('.scuba.yml')
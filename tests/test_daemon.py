@@ -0,0 +1,172 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+import subprocess
+import sys
+
+import scuba.cache
+import scuba.daemon as uut
+
+PKG_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(uut.__file__)))
+
+
+class TestDaemon(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+        self.pid = None
+
+    def tearDown(self):
+        if self.pid:
+            try:
+                uut.stop()
+            except uut.DaemonError:
+                pass
+            self._wait_exit(self.pid)
+        super().tearDown()
+
+    def _wait_exit(self, pid):
+        import time
+        for _ in range(250):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    return
+            except ChildProcessError:
+                return
+            time.sleep(0.02)
+        os.kill(pid, 9)
+        raise AssertionError('scubad did not exit')
+
+    def _start(self):
+        self.pid = uut.start_later()
+
+    def _scuba(self, *args, cwd=None, preexec_fn=None, **env):
+        '''Run the scuba command, returning (exit status, stdout, stderr)'''
+        cp = subprocess.run([sys.executable, '-c', 'from scuba.client import main; main()']
+                + list(args), env=dict(os.environ, PYTHONPATH=PKG_PARENT, **env), cwd=cwd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                preexec_fn=preexec_fn)
+        return cp.returncode, cp.stdout, cp.stderr
+
+    def _scuba_admin(self, *args):
+        '''Run the scuba-admin command, returning (exit status, stdout, stderr)'''
+        cp = subprocess.run([sys.executable, '-c',
+                'from scuba.__main__ import admin_main; admin_main()'] + list(args),
+                env=dict(os.environ, PYTHONPATH=PKG_PARENT),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        return cp.returncode, cp.stdout, cp.stderr
+
+    def _invocations(self):
+        status = uut.get_status()
+        line = [l for l in status.splitlines() if l.startswith('Invocations:')][0]
+        return int(line.split()[1])
+
+    def test_not_running(self):
+        '''Without scubad, scuba runs in its own process'''
+        assert_false(uut.is_running())
+        rc, _, err = self._scuba('--check-config')
+        assert_equal(rc, 0)
+        assert_in('is valid', err)
+
+    def test_forward(self):
+        '''Invocations are run by scubad, in the client's directory and environment'''
+        self._start()
+        os.mkdir('sub')
+        with open('sub/.scuba.yml', 'w') as f:
+            f.write('image: debian\n')
+        with open('sub/other.yml', 'w') as f:
+            f.write('image: [\n')
+
+        rc, _, err = self._scuba('--check-config', cwd='sub')
+        assert_equal(rc, 0)
+        assert_in('sub/.scuba.yml is valid', err)
+
+        rc, _, err = self._scuba('--check-config', SCUBA_CONFIG='sub/other.yml')
+        assert_equal(rc, 128)
+        assert_in('Config error', err)
+        assert_equal(self._invocations(), 2)
+
+    def test_stdout(self):
+        '''Output is written directly to the client's stdout'''
+        self._start()
+        rc, out, _ = self._scuba('--version')
+        assert_equal(rc, 0)
+        assert_startswith(out, 'scuba ')
+        assert_equal(self._invocations(), 1)
+
+    def test_disabled(self):
+        '''SCUBA_NO_DAEMON makes scuba run in its own process'''
+        self._start()
+        rc, _, _ = self._scuba('--version', SCUBA_NO_DAEMON='1')
+        assert_equal(rc, 0)
+        assert_equal(self._invocations(), 0)
+
+    def test_closed_stdin(self):
+        '''scuba runs in its own process if stdin is closed'''
+        self._start()
+        rc, out, _ = self._scuba('--version', preexec_fn=lambda: os.close(0))
+        assert_equal(rc, 0)
+        assert_startswith(out, 'scuba ')
+        assert_equal(self._invocations(), 0)
+
+    def test_inherited_env(self):
+        '''Environment values from the host are those of each client'''
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\nentrypoint: ""\nenvironment:\n  FOO:\n')
+
+        with mock.patch.dict('os.environ', FOO='daemon'):
+            self._start()
+
+        for value in ('first', 'second'):
+            rc, out, err = self._scuba('--dry-run', 'true', FOO=value)
+            assert_equal(rc, 42, err)
+            assert_in('FOO={}'.format(value), out)
+        assert_equal(self._invocations(), 2)
+
+    def test_config_in_memory(self):
+        '''scubad keeps the configs loaded by invocations in memory'''
+        self._start()
+        self._scuba('--check-config')
+        assert_in('In memory: 1 config(s)', uut.get_status())
+
+    def test_stop(self):
+        '''scuba-admin daemon stop makes scubad exit'''
+        self._start()
+        rc, _, err = self._scuba_admin('daemon', 'stop')
+        assert_equal(rc, 0)
+        self._wait_exit(self.pid)
+        assert_false(uut.is_running())
+        assert_raises(uut.DaemonError, uut.get_status)
+
+
+class TestMemoryCache(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+        self.memory = mock.patch('scuba.cache._memory', {})
+        self.memory.start()
+
+    def tearDown(self):
+        self.memory.stop()
+        super().tearDown()
+
+    def test_reused(self):
+        '''Cache files held in memory are not read again while unchanged'''
+        scuba.cache.store('test.json', dict(a=1))
+        data = scuba.cache.load('test.json')
+        data['a'] = 2
+
+        with mock.patch('json.load') as load_mock:
+            assert_equal(scuba.cache.load('test.json'), dict(a=1))
+        assert_false(load_mock.called)
+
+    def test_changed(self):
+        '''Cache files held in memory are read again once they change'''
+        scuba.cache.store('test.json', dict(a=1))
+        scuba.cache.load('test.json')
+        scuba.cache.store('test.json', dict(a=2))
+        assert_equal(scuba.cache.load('test.json'), dict(a=2))
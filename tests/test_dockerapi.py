@@ -0,0 +1,327 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import base64
+import json
+import os
+import signal
+import time
+from tempfile import TemporaryFile
+
+import scuba.dockerapi as uut
+import scuba.dockerutil
+from .fakedockerd import FakeDockerDaemon, make_image
+
+
+class TestGetClient(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.env = mock.patch.dict('os.environ', DOCKER_CONFIG=self.path)
+        self.env.start()
+        for name in ('DOCKER_HOST', 'DOCKER_CONTEXT', uut.BACKEND_ENV_VAR):
+            os.environ.pop(name, None)
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        with open(self.socket, 'w'):
+            pass
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_docker_host(self):
+        '''The client connects to a unix:// DOCKER_HOST'''
+        os.environ['DOCKER_HOST'] = 'unix://' + self.socket
+        assert_equal(uut.get_client().socket_path, self.socket)
+
+    def test_default_socket(self):
+        '''The client connects to the default socket'''
+        with mock.patch('scuba.dockerapi.DEFAULT_SOCKET', self.socket):
+            assert_equal(uut.get_client().socket_path, self.socket)
+
+    def test_missing_socket(self):
+        '''The CLI is used if the socket doesn't exist'''
+        os.environ['DOCKER_HOST'] = 'unix://' + self.socket + '.nope'
+        assert_is_none(uut.get_client())
+
+    def test_remote(self):
+        '''The CLI is used for a remote Docker host'''
+        os.environ['DOCKER_HOST'] = 'tcp://1.2.3.4:2375'
+        assert_is_none(uut.get_client())
+
+    def test_context(self):
+        '''The CLI is used if a docker context is selected'''
+        with mock.patch('scuba.dockerapi.DEFAULT_SOCKET', self.socket):
+            os.environ['DOCKER_CONTEXT'] = 'foo'
+            assert_is_none(uut.get_client())
+
+            del os.environ['DOCKER_CONTEXT']
+            with open('config.json', 'w') as f:
+                json.dump(dict(currentContext='foo'), f)
+            assert_is_none(uut.get_client())
+
+    def test_backend_cli(self):
+        '''The CLI is used if requested'''
+        os.environ['DOCKER_HOST'] = 'unix://' + self.socket
+        os.environ[uut.BACKEND_ENV_VAR] = 'cli'
+        assert_is_none(uut.get_client())
+
+
+class TestParseRunArgs(TmpDirTestCase):
+    def test_parse(self):
+        '''A command line generated by scuba is translated'''
+        config, remove, cidfile = uut.parse_run_args([
+            'docker', 'run', '-i', '--rm',
+            '--env=FOO=bar',
+            '--volume=/a:/a:z',
+            '-w', '/a/b',
+            '--entrypoint=/.scuba/scubainit',
+            'busybox', '/bin/sh', '/.scuba/command.sh',
+        ])
+        assert_true(remove)
+        assert_is_none(cidfile)
+        assert_true(config['OpenStdin'])
+        assert_false(config['Tty'])
+        assert_equal(config['Env'], ['FOO=bar'])
+        assert_equal(config['HostConfig']['Binds'], ['/a:/a:z'])
+        assert_equal(config['WorkingDir'], '/a/b')
+        assert_equal(config['Entrypoint'], ['/.scuba/scubainit'])
+        assert_equal(config['Image'], 'busybox')
+        assert_equal(config['Cmd'], ['/bin/sh', '/.scuba/command.sh'])
+
+    def test_parse_async_rm(self):
+        '''Labels and the container ID file are translated'''
+        config, remove, cidfile = uut.parse_run_args([
+            'docker', 'run', '-i', '--label=scuba.reap=1', '--cidfile=/tmp/cid',
+            'busybox', 'true',
+        ])
+        assert_false(remove)
+        assert_equal(cidfile, '/tmp/cid')
+        assert_equal(config['Labels'], {'scuba.reap': '1'})
+
+    def test_parse_read_only(self):
+        '''A read-only root and tmpfs mounts are translated'''
+        config, _, _ = uut.parse_run_args([
+            'docker', 'run', '-i', '--read-only', '--tmpfs=/home/u:exec,mode=0700',
+            'busybox', 'true',
+        ])
+        assert_true(config['HostConfig']['ReadonlyRootfs'])
+        assert_equal(config['HostConfig']['Tmpfs'], {'/home/u': 'exec,mode=0700'})
+
+    def test_parse_read_only_value(self):
+        '''--read-only can be given a value'''
+        for value, expected in (('true', True), ('false', False)):
+            config, _, _ = uut.parse_run_args([
+                'docker', 'run', '--read-only=' + value, 'busybox', 'true',
+            ])
+            assert_equal(config['HostConfig']['ReadonlyRootfs'], expected)
+        assert_is_none(uut.parse_run_args(['docker', 'run', '--read-only=nope', 'busybox']))
+
+    def test_unsupported(self):
+        '''Command lines with other options are not translated'''
+        for opt in ('--tty', '--privileged', '-p'):
+            assert_is_none(uut.parse_run_args(['docker', 'run', '-i', opt, 'busybox']))
+
+    def test_no_image(self):
+        assert_is_none(uut.parse_run_args(['docker', 'run', '-i']))
+
+
+class TestAPIClient(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop(uut.BACKEND_ENV_VAR, None)
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _run(self, args, stdin=b''):
+        with TemporaryFile() as fin, TemporaryFile() as fout, TemporaryFile() as ferr:
+            fin.write(stdin)
+            fin.seek(0)
+            rc = scuba.dockerutil.run(args, fin, fout, ferr)
+            fout.seek(0)
+            ferr.seek(0)
+            return rc, fout.read(), ferr.read()
+
+    ######################################################################
+    # Images
+
+    def test_inspect(self):
+        '''docker_inspect uses the API'''
+        self.daemon.images['busybox:latest'] = make_image('busybox', cmd=['sh'])
+        with mock.patch('subprocess.run') as run_mock:
+            info = scuba.dockerutil.docker_inspect('busybox')
+        assert_false(run_mock.called)
+        assert_equal(info['Config']['Cmd'], ['sh'])
+
+    def test_inspect_no_such_image(self):
+        '''docker_inspect raises NoSuchImageError'''
+        assert_raises(scuba.dockerutil.NoSuchImageError,
+                scuba.dockerutil.docker_inspect, 'busybox')
+
+    def test_uses_containerd_store(self):
+        '''The containerd image store is detected from the daemon's info'''
+        assert_false(scuba.dockerutil.uses_containerd_store())
+        self.daemon.driver_status = [['driver-type', 'io.containerd.snapshotter.v1']]
+        assert_true(scuba.dockerutil.uses_containerd_store())
+
+    def test_get_images(self):
+        '''get_images returns names like `docker images`'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        self.daemon.images['foo/bar:1.0'] = make_image('foo/bar:1.0')
+        assert_seq_equal(sorted(scuba.dockerutil.get_images()),
+                ['busybox', 'busybox:latest', 'foo/bar', 'foo/bar:1.0'])
+
+    def test_pull(self):
+        '''docker_pull pulls an image, showing progress'''
+        self.daemon.registry['busybox:latest'] = make_image('busybox')
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out):
+            scuba.dockerutil.docker_pull('busybox')
+            out.seek(0)
+            output = out.read()
+
+        assert_in('busybox:latest', self.daemon.images)
+        assert_in('Status: Downloaded newer image for busybox:latest', output)
+        assert_not_in('Downloading', output)
+
+    def test_pull_failure(self):
+        '''docker_pull raises DockerError if the image can't be pulled'''
+        assert_raises(scuba.dockerutil.DockerError, scuba.dockerutil.docker_pull, 'nosuchimage')
+
+    def test_pull_auth(self):
+        '''Credentials from the docker config are sent when pulling'''
+        auth = base64.b64encode(b'user:pass').decode('ascii')
+        with open('config.json', 'w') as f:
+            json.dump(dict(auths={'registry.example.com': dict(auth=auth)}), f)
+        self.daemon.registry['registry.example.com/foo:latest'] = make_image('foo')
+
+        scuba.dockerutil.docker_pull('registry.example.com/foo')
+
+        header = json.loads(base64.urlsafe_b64decode(self.daemon.auth_headers[0]).decode('utf-8'))
+        assert_equal(header, dict(username='user', password='pass',
+                serveraddress='registry.example.com'))
+
+    def test_pull_credential_helper(self):
+        '''The CLI pulls images when a credential helper is configured'''
+        with open('config.json', 'w') as f:
+            json.dump(dict(credsStore='secretservice'), f)
+
+        with mock.patch('subprocess.run', return_value=mock.Mock(returncode=0)) as run_mock:
+            scuba.dockerutil.docker_pull('busybox')
+        assert_equal(run_mock.call_args[0][0], ['docker', 'pull', 'busybox'])
+        assert_equal(self.daemon.requests, [])
+
+    ######################################################################
+    # Containers
+
+    def _run_args(self, *opts):
+        return ['docker', 'run', '-i', '--rm', '--env=FOO=bar', '--volume=/a:/a:z'] \
+                + list(opts) + ['busybox', 'cmd', 'arg']
+
+    def test_run(self):
+        '''A container is run, with stdin, stdout, stderr, and exit status'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+
+        def handler(container, stdin):
+            return b'out:' + stdin, b'err', 3
+        self.daemon.run_handler = handler
+
+        with mock.patch('subprocess.call') as call_mock:
+            rc, out, err = self._run(self._run_args(), stdin=b'hello')
+
+        assert_false(call_mock.called)
+        assert_equal(rc, 3)
+        assert_equal(out, b'out:hello')
+        assert_equal(err, b'err')
+
+        # The container was removed
+        assert_equal(self.daemon.containers, {})
+        assert_equal(len(self.daemon.removed), 1)
+
+    def test_run_large_output(self):
+        '''Output larger than a socket buffer is received intact'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        data = os.urandom(1024 * 1024)
+        self.daemon.run_handler = lambda container, stdin: (data, b'', 0)
+
+        _, out, _ = self._run(self._run_args())
+        assert_equal(out, data)
+
+    def test_run_config(self):
+        '''The container is created with the translated config'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        configs = []
+        def handler(container, stdin):
+            configs.append(container.config)
+            return b'', b'', 0
+        self.daemon.run_handler = handler
+
+        self._run(self._run_args('-w', '/a'))
+        assert_equal(configs[0]['Env'], ['FOO=bar'])
+        assert_equal(configs[0]['HostConfig']['Binds'], ['/a:/a:z'])
+        assert_equal(configs[0]['WorkingDir'], '/a')
+        assert_equal(configs[0]['Cmd'], ['cmd', 'arg'])
+
+    def test_run_pulls_image(self):
+        '''A missing image is pulled, like `docker run`'''
+        self.daemon.registry['busybox:latest'] = make_image('busybox')
+        rc, out, err = self._run(self._run_args(), stdin=b'hi')
+        assert_equal(rc, 0)
+        assert_in(b'Unable to find image', err)
+        assert_equal(out, b'hi')
+
+    def test_run_unsupported_options(self):
+        '''The CLI runs containers with options which can't be translated'''
+        with mock.patch('subprocess.call', return_value=0) as call_mock:
+            rc, _, _ = self._run(self._run_args('--tty'))
+        assert_true(call_mock.called)
+        assert_equal(self.daemon.requests, [])
+
+    def test_run_forwards_signals(self):
+        '''Signals received by scuba are forwarded to the container'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+
+        def handler(container, stdin):
+            os.kill(os.getpid(), signal.SIGTERM)
+            for _ in range(100):
+                if container.signals:
+                    break
+                time.sleep(0.01)
+            return b'', b'', 143
+        self.daemon.run_handler = handler
+
+        rc, _, _ = self._run(self._run_args())
+        assert_equal(rc, 143)
+        assert_equal(len(self.daemon.removed), 1)
+        assert_equal(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    def test_run_via_main(self):
+        '''scuba runs containers using the API'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+            f.write('entrypoint: ""\n')
+
+        # (scuba doesn't support DOCKER_HOST)
+        del os.environ['DOCKER_HOST']
+
+        import scuba.__main__ as main
+        with mock.patch('scuba.dockerapi.DEFAULT_SOCKET', self.socket), \
+             mock.patch('subprocess.call') as call_mock, \
+             TemporaryFile() as fin, TemporaryFile() as fout, \
+             mock.patch('sys.stdin', fin), mock.patch('sys.stdout', fout):
+            try:
+                main.main(['true'])
+            except SystemExit as e:
+                assert_equal(e.code, 0)
+        assert_false(call_mock.called)
+        assert_in(('POST', '/containers/create'), self.daemon.requests)
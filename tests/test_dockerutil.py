@@ -18,6 +18,7 @@ class TestDockerutil(TestCase):
         with self.assertRaises(uut.DockerError):
             uut.get_image_command('nosuchimageZZZZZZZZ')
 
+    @mock.patch.dict('os.environ', SCUBA_DOCKER_BACKEND='cli')
     def test_get_image_no_docker(self):
         '''get_image_command raises an exception if docker is not installed'''
 
@@ -31,6 +32,7 @@ class TestDockerutil(TestCase):
                 uut.get_image_command('n/a')
 
 
+    @mock.patch.dict('os.environ', SCUBA_DOCKER_BACKEND='cli')
     def _test_get_images(self, stdout, returncode=0):
         def mocked_run(*args, **kwargs):
             mock_obj = mock.MagicMock()
@@ -0,0 +1,210 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import json
+import os
+import time
+
+import scuba.imagecache as uut
+import scuba.dockerutil
+
+
+def make_info(image_id, entrypoint=None, cmd=None):
+    return dict(
+        Id = image_id,
+        RepoDigests = ['busybox@sha256:1234'],
+        Config = dict(Entrypoint=entrypoint, Cmd=cmd),
+    )
+
+
+class TestImageCache(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+
+        # Docker host image store, readable by default
+        self.store = os.path.join(self.path, 'image')
+        self.store_patch = mock.patch('scuba.imagecache.DOCKER_IMAGE_DB', self.store)
+        self.store_patch.start()
+
+        self.images = {}
+        self.inspect_patch = mock.patch('scuba.dockerutil.docker_inspect_or_pull',
+                side_effect=self._mocked_inspect)
+        self.inspect = self.inspect_patch.start()
+
+        # The classic image store is used by default
+        self.containerd_patch = mock.patch('scuba.dockerutil.uses_containerd_store',
+                return_value=False)
+        self.containerd = self.containerd_patch.start()
+
+        # The docker CLI is used by default
+        self.client_patch = mock.patch('scuba.dockerapi.get_client', return_value=None)
+        self.client_patch.start()
+
+    def tearDown(self):
+        self.client_patch.stop()
+        self.containerd_patch.stop()
+        self.inspect_patch.stop()
+        self.store_patch.stop()
+        super().tearDown()
+
+    def _mocked_inspect(self, image):
+        return self.images[image]
+
+    def _set_image(self, image, info, ref='busybox:latest'):
+        '''Set an image, as known to both docker and the image store'''
+        self.images[image] = info
+        repos = os.path.join(self.store, 'overlay2', 'repositories.json')
+        os.makedirs(os.path.dirname(repos), exist_ok=True)
+        with open(repos + '.tmp', 'w') as f:
+            json.dump({'Repositories': {'busybox': {ref: info['Id']}}}, f)
+        os.replace(repos + '.tmp', repos)
+
+    def _new_process(self):
+        uut._inspected.clear()
+
+    def test_familiar_ref(self):
+        '''Image references are normalized to the image store form'''
+        for image, ref in (
+                ('busybox', 'busybox:latest'),
+                ('docker.io/library/busybox', 'busybox:latest'),
+                ('docker.io/foo/bar:1.0', 'foo/bar:1.0'),
+                ('localhost:5000/foo', 'localhost:5000/foo:latest'),
+                ('foo@sha256:1234', 'foo@sha256:1234'),
+                ):
+            assert_equal(uut._familiar_ref(image), ref)
+
+    def test_one_inspect_per_process(self):
+        '''An image is inspected at most once per process'''
+        self._set_image('busybox', make_info('sha256:1', ['/ep'], ['sh']))
+
+        assert_equal(uut.get_image_entrypoint('busybox'), ['/ep'])
+        assert_equal(uut.get_image_command('busybox'), ['sh'])
+        assert_equal(uut.get_image_id('busybox'), 'sha256:1')
+        assert_equal(self.inspect.call_count, 1)
+
+    def test_cached(self):
+        '''An unchanged image is not inspected again'''
+        self._set_image('busybox', make_info('sha256:1', ['/ep']))
+        uut.get_image_entrypoint('busybox')
+
+        self._new_process()
+        assert_equal(uut.get_image_entrypoint('busybox'), ['/ep'])
+        assert_equal(self.inspect.call_count, 1)
+
+    def test_store_changed_same_id(self):
+        '''An image is not inspected again if other images change'''
+        self._set_image('busybox', make_info('sha256:1', ['/ep']))
+        uut.get_image_entrypoint('busybox')
+
+        # Rewrite the image store without changing busybox
+        self._set_image('busybox', make_info('sha256:1', ['/ep']))
+        self._new_process()
+        uut.get_image_entrypoint('busybox')
+        assert_equal(self.inspect.call_count, 1)
+
+    def test_image_changed(self):
+        '''An image is inspected again when its ID changes'''
+        self._set_image('busybox', make_info('sha256:1', ['/ep']))
+        uut.get_image_entrypoint('busybox')
+
+        self._set_image('busybox', make_info('sha256:2', ['/new-ep']))
+        self._new_process()
+        assert_equal(uut.get_image_entrypoint('busybox'), ['/new-ep'])
+        assert_equal(self.inspect.call_count, 2)
+
+    def test_store_unreadable_api(self):
+        '''An image is inspected again if the image store can't be read, with the API'''
+        self.images['busybox'] = make_info('sha256:1', ['/ep'])
+        uut.get_image_entrypoint('busybox')
+
+        self._new_process()
+        with mock.patch('scuba.dockerapi.get_client'):
+            uut.get_image_entrypoint('busybox')
+        assert_equal(self.inspect.call_count, 2)
+
+    def test_store_unreadable_cli(self):
+        '''Without the image store, the CLI uses cached metadata for a short time'''
+        self.images['busybox'] = make_info('sha256:1', ['/ep'])
+        uut.get_image_entrypoint('busybox')
+
+        self._new_process()
+        uut.get_image_entrypoint('busybox')
+        assert_equal(self.inspect.call_count, 1)
+
+        self._new_process()
+        later = time.time() + uut.IMAGES_CACHE_TTL + 1
+        with mock.patch('time.time', return_value=later):
+            uut.get_image_entrypoint('busybox')
+        assert_equal(self.inspect.call_count, 2)
+
+    def test_containerd_store(self):
+        '''The image store isn't trusted with the containerd image store'''
+        self.containerd.return_value = True
+        self._set_image('busybox', make_info('sha256:1', ['/ep']))
+        uut.get_image_entrypoint('busybox')
+
+        # The image changes, but the image store is never updated
+        self.images['busybox'] = make_info('sha256:2', ['/new-ep'])
+        self._new_process()
+        with mock.patch('scuba.dockerapi.get_client'):
+            assert_equal(uut.get_image_entrypoint('busybox'), ['/new-ep'])
+
+    def test_containerd_store_cached(self):
+        '''The image store type is determined once per daemon'''
+        sock = os.path.join(self.path, 'docker.sock')
+        with open(sock, 'w'):
+            pass
+        with mock.patch('scuba.dockerapi.DEFAULT_SOCKET', sock):
+            assert_false(uut._uses_containerd_store())
+            assert_false(uut._uses_containerd_store())
+            assert_equal(self.containerd.call_count, 1)
+
+            # The daemon restarts
+            os.unlink(sock)
+            with open(sock, 'w') as f:
+                f.write('x')
+            uut._uses_containerd_store()
+            assert_equal(self.containerd.call_count, 2)
+
+    def test_store_missing_image(self):
+        '''The image store isn't trusted if it doesn't know the image'''
+        self._set_image('busybox', make_info('sha256:1', ['/ep']), ref='other:latest')
+        uut.get_image_entrypoint('busybox')
+
+        self.images['busybox'] = make_info('sha256:2', ['/new-ep'])
+        self._new_process()
+        with mock.patch('scuba.dockerapi.get_client'):
+            assert_equal(uut.get_image_entrypoint('busybox'), ['/new-ep'])
+
+    def test_digest_ref(self):
+        '''An image referenced by digest is never inspected again'''
+        image = 'busybox@sha256:1234'
+        self.images[image] = make_info('sha256:1', ['/ep'])
+        uut.get_image_entrypoint(image)
+
+        self._new_process()
+        assert_equal(uut.get_image_entrypoint(image), ['/ep'])
+        assert_equal(self.inspect.call_count, 1)
+
+    def test_docker_host(self):
+        '''Images are cached separately for each Docker host'''
+        self._set_image('busybox', make_info('sha256:1', ['/ep']))
+        uut.get_image_entrypoint('busybox')
+
+        with mock.patch.dict('os.environ', DOCKER_HOST='tcp://1.2.3.4'):
+            uut.get_image_entrypoint('busybox')
+        assert_equal(self.inspect.call_count, 2)
+
+    def test_get_image_id_no_pull(self):
+        '''get_image_id doesn't pull a missing image'''
+        with mock.patch('scuba.dockerutil.docker_inspect',
+                side_effect=scuba.dockerutil.NoSuchImageError('busybox')):
+            assert_raises(scuba.dockerutil.NoSuchImageError, uut.get_image_id, 'busybox')
+        assert_false(self.inspect.called)
+
+    def test_missing_key(self):
+        '''DockerError is raised if the inspect output is missing a key'''
+        self.images['busybox'] = dict(Id='sha256:1')
+        assert_raises(scuba.dockerutil.DockerError, uut.get_image_entrypoint, 'busybox')
@@ -0,0 +1,98 @@
+from nose.tools import *
+from .utils import *
+from unittest import TestCase
+
+import os
+import sys
+import shutil
+import subprocess
+import unittest
+
+import scuba
+
+# Maximum time (in milliseconds) that `scuba --version` may spend importing
+# modules, beyond what the interpreter imports at startup. Wall-clock time is
+# noisy on a loaded machine, so the default is generous (several times what
+# it takes); it can be overridden by setting IMPORT_BUDGET_ENV.
+IMPORT_BUDGET_MS = 250
+IMPORT_BUDGET_ENV = 'SCUBA_TEST_IMPORT_BUDGET_MS'
+
+# Modules which must not be imported by `scuba --version`
+# (shutil is absent, as argparse imports it to get the terminal size.)
+LAZY_MODULES = (
+    'argcomplete',
+    'http.client',
+    'json',
+    'pkg_resources',
+    'scuba.bundle',
+    'subprocess',
+    'tempfile',
+    'yaml',
+)
+
+
+def parse_importtime(output):
+    '''Parse the output of python -X importtime
+
+    Returns: A list of (name, cumulative_us, depth) tuples
+    '''
+    result = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(cumulative)
+        except ValueError:
+            continue    # Header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        result.append((name.strip(), cumulative, depth))
+    return result
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'python -X importtime requires Python 3.7')
+class TestImportTime(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Run a copy of the package, with a generated version module, as if
+        # it were installed. (From a source checkout, --version runs git.)
+        pkg_path = os.path.dirname(scuba.__file__)
+        shutil.copytree(pkg_path, os.path.join(self.path, 'scuba'),
+                ignore=shutil.ignore_patterns('__pycache__', '_version.py'))
+        with open(os.path.join(self.path, 'scuba', '_version.py'), 'w') as f:
+            f.write('version = {!r}\n'.format(scuba.__version__))
+
+    def _importtime(self, *args):
+        env = dict(os.environ, PYTHONPATH=self.path)
+        env.pop('_ARGCOMPLETE', None)
+        cp = subprocess.run([sys.executable, '-X', 'importtime'] + list(args),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, env=env)
+        assert_equal(cp.returncode, 0, cp.stderr)
+        return parse_importtime(cp.stderr)
+
+    def _scuba_import_time(self):
+        '''Returns: (imported module names, time spent in imports in ms)'''
+        startup = set(name for name, _, _ in self._importtime('-c', 'pass'))
+        startup.add('runpy')
+
+        imports = self._importtime('-m', 'scuba', '--version')
+        names = set(name for name, _, _ in imports)
+        total = sum(cum for name, cum, depth in imports
+                if depth == 0 and not name in startup)
+        return names, total / 1000.0
+
+    def test_version_lazy_modules(self):
+        '''scuba --version does not import expensive modules'''
+        names, _ = self._scuba_import_time()
+        imported = [m for m in LAZY_MODULES if m in names]
+        assert_equal(imported, [])
+
+    def test_version_import_budget(self):
+        '''scuba --version imports within the time budget'''
+        budget = float(os.getenv(IMPORT_BUDGET_ENV) or IMPORT_BUDGET_MS)
+
+        # Take the best of several runs, to reduce noise
+        best = min(self._scuba_import_time()[1] for _ in range(3))
+        assert_less(best, budget)
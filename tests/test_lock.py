@@ -0,0 +1,142 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import json
+import os
+from tempfile import TemporaryFile
+
+import scuba.lockfile as uut
+import scuba.__main__ as main
+from scuba.config import load_config, ConfigError
+from .fakedockerd import FakeDockerDaemon, make_image
+
+
+CONFIG = '''\
+image: busybox
+aliases:
+  a:
+    image: debian:buster
+    script: make
+  c: make
+'''
+
+BUSYBOX_DIGEST = 'busybox@sha256:' + '1' * 64
+DEBIAN_DIGEST = 'debian@sha256:' + '2' * 64
+
+def write_lock(images):
+    with open('.scuba.lock', 'w') as f:
+        json.dump(dict(version=1, images=images), f)
+
+
+class TestLockedConfig(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write(CONFIG)
+
+    def test_no_lock_file(self):
+        '''Images are used as-is without a lock file'''
+        config = load_config('.scuba.yml')
+        assert_equal(config.process_command(['a']).image, 'debian:buster')
+
+    def test_pinned(self):
+        '''process_command uses the pinned digests'''
+        write_lock({'busybox': BUSYBOX_DIGEST, 'debian:buster': DEBIAN_DIGEST})
+        config = load_config('.scuba.yml')
+        assert_equal(config.process_command(['a']).image, DEBIAN_DIGEST)
+        assert_equal(config.process_command(['c']).image, BUSYBOX_DIGEST)
+        assert_equal(config.process_command([]).image, BUSYBOX_DIGEST)
+
+    def test_override_not_pinned(self):
+        '''An image given on the command line is not pinned'''
+        write_lock({'busybox': BUSYBOX_DIGEST})
+        config = load_config('.scuba.yml')
+        assert_equal(config.process_command(['c'], image='busybox').image, 'busybox')
+
+    def test_invalid(self):
+        '''An invalid lock file raises ConfigError'''
+        for content in ('{', '{"version": 99, "images": {}}',
+                '{"version": 1, "images": {"busybox": "busybox:latest"}}'):
+            with open('.scuba.lock', 'w') as f:
+                f.write(content)
+            assert_raises(ConfigError, load_config, '.scuba.yml')
+
+    def test_cached_config(self):
+        '''A change to the lock file invalidates the cached config'''
+        self.enable_cache()
+        load_config('.scuba.yml')
+
+        write_lock({'busybox': BUSYBOX_DIGEST})
+        config = load_config('.scuba.yml')
+        assert_equal(config.locked_images, {'busybox': BUSYBOX_DIGEST})
+        assert_in(os.path.abspath('.scuba.lock'), [d for d, _ in config.dependencies])
+
+
+class TestLockMain(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write(CONFIG)
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+        self.busybox = self.daemon.images['busybox:latest'] = make_image('busybox')
+        self.debian = self.daemon.registry['debian:buster'] = make_image('debian:buster')
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _run_admin(self, args, exp_retval=0):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                main.admin_main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def _read_lock(self):
+        with open('.scuba.lock') as f:
+            return json.load(f)
+
+    def test_lock(self):
+        '''scuba-admin lock pins all images, pulling missing ones'''
+        self._run_admin(['lock'])
+        assert_equal(self._read_lock(), dict(version=1, images={
+            'busybox': self.busybox['RepoDigests'][0],
+            'debian:buster': self.debian['RepoDigests'][0],
+        }))
+        assert_in('debian:buster', self.daemon.images)
+
+    def test_keep_existing(self):
+        '''scuba-admin lock keeps existing pins, unless updating'''
+        write_lock({'busybox': BUSYBOX_DIGEST})
+        self._run_admin(['lock'])
+        assert_equal(self._read_lock()['images']['busybox'], BUSYBOX_DIGEST)
+
+        self.daemon.registry['busybox:latest'] = newer = make_image('busybox')
+        self._run_admin(['lock', '--update'])
+        assert_equal(self._read_lock()['images']['busybox'], newer['RepoDigests'][0])
+
+    def test_locally_built(self):
+        '''scuba-admin lock fails for an image without a repository digest'''
+        self.busybox['RepoDigests'] = []
+        output = self._run_admin(['lock'], 128)
+        assert_in('has no digest', output)
+        assert_false(os.path.exists('.scuba.lock'))
+
+    def test_repository(self):
+        '''Image references are matched to their repository digests'''
+        assert_equal(uut._repository('gcc:9'), 'gcc')
+        assert_equal(uut._repository('docker.io/library/gcc:9'), 'gcc')
+        assert_equal(uut._repository('localhost:5000/tools/gcc'), 'localhost:5000/tools/gcc')
@@ -3,6 +3,7 @@ from .utils import *
 from unittest import TestCase
 from unittest import mock
 
+import errno
 import logging
 import os
 import sys
@@ -15,6 +16,8 @@ from grp import getgrgid
 import scuba.__main__ as main
 import scuba.constants
 import scuba.dockerutil
+import scuba.reap
+import scuba.version
 import scuba
 
 DOCKER_IMAGE = 'debian:8.2'
@@ -160,6 +163,28 @@ class TestMain(TmpDirTestCase):
 
 
 
+    def test_check_config(self):
+        '''Verify scuba --check-config accepts a valid config'''
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: {}\n'.format(DOCKER_IMAGE))
+            f.write('aliases:\n')
+            f.write('  foo: bar\n')
+
+        _, err = self.run_scuba(['--check-config'])
+        assert_true('is valid' in err)
+
+    def test_check_config_invalid_alias(self):
+        '''Verify scuba --check-config rejects an invalid alias'''
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: {}\n'.format(DOCKER_IMAGE))
+            f.write('aliases:\n')
+            f.write('  foo: bar\n')
+            f.write('  broken:\n')
+            f.write('    image: no_script\n')
+
+        # ConfigError -> exit(128)
+        self.run_scuba(['--check-config'], 128)
+
     def test_version(self):
         '''Verify scuba prints its version for -v'''
 
@@ -174,7 +199,7 @@ class TestMain(TmpDirTestCase):
         assert_startswith(check, 'scuba')
 
         ver = check.split()[1]
-        assert_equal(ver, scuba.__version__)
+        assert_equal(ver, scuba.version.get_version())
 
 
     def test_no_docker(self):
@@ -866,3 +891,112 @@ class TestMain(TmpDirTestCase):
                 '''.format(image=DOCKER_IMAGE))
         out, _ = self.run_scuba(['--shell', '/bin/bash', 'shell_check'])
         self.assertTrue("/bin/bash" in out)
+
+
+
+class TestPrepare(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: {}\n'.format(DOCKER_IMAGE))
+        self.threads = []
+
+        # (Set by main())
+        self.verbose = mock.patch('scuba.__main__.g_verbose', False, create=True)
+        self.verbose.start()
+
+    def tearDown(self):
+        self.verbose.stop()
+        super().tearDown()
+
+    def _get_metadata(self, value):
+        def get(image):
+            import threading
+            self.threads.append(threading.current_thread())
+            return value
+        return get
+
+    def _prepare(self, command):
+        dive = main.ScubaDive(command)
+        try:
+            dive.prepare()
+            return dive
+        finally:
+            dive.cleanup_tempfiles()
+
+    def test_metadata_in_background(self):
+        '''The image metadata is fetched in the background'''
+        import threading
+        with mock.patch('scuba.__main__.get_image_command', side_effect=self._get_metadata(['sh'])), \
+             mock.patch('scuba.__main__.get_image_entrypoint', side_effect=self._get_metadata(['/ep'])):
+            dive = self._prepare([])
+
+        assert_equal(dive.docker_cmd[0], '/ep')
+        assert_equal(len(self.threads), 2)
+        assert_not_in(threading.current_thread(), self.threads)
+
+    def test_metadata_error(self):
+        '''Errors fetching the image metadata are raised by prepare()'''
+        with mock.patch('scuba.__main__.get_image_entrypoint',
+                side_effect=scuba.dockerutil.NoSuchImageError(DOCKER_IMAGE)):
+            assert_raises(scuba.dockerutil.NoSuchImageError, self._prepare, ['true'])
+
+    def test_metadata_not_needed(self):
+        '''Only the image metadata which is needed is fetched'''
+        with mock.patch('scuba.__main__.get_image_command') as cmd_mock, \
+             mock.patch('scuba.__main__.get_image_entrypoint') as ep_mock:
+            self._prepare(['true'])
+        assert_false(cmd_mock.called)
+        assert_true(ep_mock.called)
+
+    def test_async_rm(self):
+        '''With async_rm, the container is labelled rather than removed by docker'''
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=None):
+            dive = main.ScubaDive(['true'], async_rm=True)
+            try:
+                dive.prepare()
+                args = dive.get_docker_cmdline()
+            finally:
+                dive.cleanup_tempfiles()
+
+        assert_not_in('--rm', args)
+        assert_in('--label=scuba.reap=1', args)
+        assert_equal(scuba.reap.get_cidfile(args),
+                os.path.join(dive.scubadir_hostpath, 'container.id'))
+
+    def _main(self, args, exp_retval=0):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                main.main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def test_exec(self):
+        '''With --exec, scuba replaces itself with docker run'''
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=None), \
+             mock.patch('scuba.usage.record_image') as record_mock, \
+             mock.patch('scuba.__main__.sweep_scubadirs') as sweep_mock, \
+             mock.patch('os.execvp') as execvp_mock:
+            self._main(['--exec', 'true'])
+
+        assert_true(sweep_mock.called)
+        assert_equal(record_mock.call_args, mock.call(DOCKER_IMAGE))
+        file, args = execvp_mock.call_args[0]
+        assert_equal(file, 'docker')
+        assert_equal(args[:4], ['docker', 'run', '-i', '--rm'])
+        assert_equal(args[-1], '/.scuba/command.sh')
+
+    def test_exec_no_docker(self):
+        '''--exec fails if docker can't be executed'''
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=None), \
+             mock.patch('scuba.usage.record_image'), \
+             mock.patch('os.execvp', side_effect=FileNotFoundError(errno.ENOENT, 'nope')):
+            output = self._main(['--exec', 'true'], 2)
+        assert_in('Failed to execute docker', output)
+
+    def test_exec_async_rm(self):
+        '''--exec and --async-rm cannot be combined'''
+        self._main(['--exec', '--async-rm', 'true'], 2)
@@ -0,0 +1,165 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+
+import scuba.__main__ as main
+import scuba.plan
+
+
+class TestPlan(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # docker is mocked
+        os.environ['SCUBA_DOCKER_BACKEND'] = 'cli'
+        self.enable_cache()
+        self.calls = []
+
+    def _write_config(self, image='busybox', entrypoint='""'):
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: {}\n'.format(image))
+            if entrypoint is not None:
+                f.write('entrypoint: {}\n'.format(entrypoint))
+            f.write('hooks:\n')
+            f.write('  user: echo hello\n')
+            f.write('aliases:\n')
+            f.write('  build: make -j4\n')
+
+    def _mocked_call(self, args, **kw):
+        # Capture the args, and the scubadir content, while it exists
+        scubadir = [a for a in args if a.endswith(':/.scuba:z')][0]
+        scubadir = scubadir[len('--volume='):-len(':/.scuba:z')]
+
+        files = {}
+        for dirpath, _, filenames in os.walk(scubadir):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, scubadir)] = (f.read(), os.stat(path).st_mode)
+
+        self.calls.append((args, scubadir, files))
+        return 0
+
+    def _run_scuba(self, args):
+        with mock.patch('subprocess.call', side_effect=self._mocked_call):
+            try:
+                main.main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, 0)
+
+    def _run_twice(self, args=['build', 'all']):
+        '''Run scuba twice, returning whether the second run used a plan'''
+        self._run_scuba(args)
+        with mock.patch('scuba.__main__.ScubaDive', side_effect=main.ScubaDive) as dive_mock:
+            self._run_scuba(args)
+        return not dive_mock.called
+
+    def test_plan_used(self):
+        '''A repeated invocation uses the cached plan'''
+        self._write_config()
+        assert_true(self._run_twice())
+
+        (args1, dir1, files1), (args2, dir2, files2) = self.calls
+        assert_not_equal(dir1, dir2)
+        assert_false(os.path.exists(dir2))
+        assert_equal([a.replace(dir1, dir2) for a in args1], args2)
+        assert_equal(files1, files2)
+
+    def test_plan_different_args(self):
+        '''An invocation with different arguments doesn't use the plan'''
+        self._write_config()
+        self._run_scuba(['build', 'all'])
+        with mock.patch('scuba.__main__.ScubaDive', side_effect=main.ScubaDive) as dive_mock:
+            self._run_scuba(['build', 'clean'])
+        assert_true(dive_mock.called)
+
+    def test_plan_config_changed(self):
+        '''The plan is not used when the config changes'''
+        self._write_config()
+        self._run_scuba(['build'])
+
+        self._write_config(image='debian')
+        with mock.patch('scuba.__main__.ScubaDive', side_effect=main.ScubaDive) as dive_mock:
+            self._run_scuba(['build'])
+        assert_true(dive_mock.called)
+        assert_true('debian' in self.calls[1][0])
+
+    def test_plan_env_changed(self):
+        '''The plan is not used when a tracked environment variable changes'''
+        self._write_config()
+        self._run_scuba(['build'])
+
+        with mock.patch.dict('os.environ', SCUBA_DISCOVERY_ACROSS_FILESYSTEM='1'), \
+             mock.patch('scuba.__main__.ScubaDive', side_effect=main.ScubaDive) as dive_mock:
+            self._run_scuba(['build'])
+        assert_true(dive_mock.called)
+
+    def test_plan_code_changed(self):
+        '''The plan is not used once scuba's code changes'''
+        import shutil
+        package_dir = os.path.join(self.path, 'pkg')
+        shutil.copytree(scuba.plan.PACKAGE_DIR, package_dir,
+                ignore=shutil.ignore_patterns('__pycache__'))
+
+        self._write_config()
+        with mock.patch('scuba.plan.PACKAGE_DIR', package_dir):
+            assert_true(self._run_twice())
+
+            with open(os.path.join(package_dir, 'plan.py'), 'a') as f:
+                f.write('# Changed\n')
+            with mock.patch('scuba.__main__.ScubaDive', side_effect=main.ScubaDive) as dive_mock:
+                self._run_scuba(['build', 'all'])
+            assert_true(dive_mock.called)
+
+    def test_plan_image_id(self):
+        '''The plan is validated against the image ID when it uses image metadata'''
+        self._write_config(entrypoint=None)
+
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=['/ep']), \
+             mock.patch('scuba.imagecache.get_image_id', return_value='sha256:1'):
+            assert_true(self._run_twice())
+
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=['/ep']), \
+             mock.patch('scuba.imagecache.get_image_id', return_value='sha256:2'), \
+             mock.patch('scuba.__main__.ScubaDive', side_effect=main.ScubaDive) as dive_mock:
+            self._run_scuba(['build', 'all'])
+        assert_true(dive_mock.called)
+
+    def test_plan_records_image_id(self):
+        '''The use of the image is recorded by the ID checked by the plan'''
+        self._write_config(entrypoint=None)
+
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=['/ep']), \
+             mock.patch('scuba.imagecache.get_image_id', return_value='sha256:1'):
+            self._run_scuba(['build'])
+
+        with mock.patch('scuba.imagecache.get_image_id', return_value='sha256:1') as id_mock, \
+             mock.patch('scuba.usage.record_use') as record_mock:
+            self._run_scuba(['build'])
+        assert_equal(id_mock.call_count, 1)
+        assert_equal(record_mock.call_args_list, [mock.call('sha256:1', 'busybox')])
+
+    def test_plan_pull_policy(self):
+        '''The pull policy is applied when the plan is used'''
+        self._write_config()
+        with open('.scuba.yml', 'a') as f:
+            f.write('pull: always\n')
+
+        with mock.patch('scuba.pull.ensure_image') as ensure_mock:
+            assert_true(self._run_twice())
+        assert_equal(ensure_mock.call_args_list,
+                [mock.call('busybox', ('always', None))] * 2)
+
+    def test_plan_not_used_for_dry_run(self):
+        '''A dry run doesn't use the plan cache'''
+        self._write_config()
+        self._run_scuba(['build'])
+
+        with mock.patch('scuba.plan.Plan.load') as load_mock:
+            try:
+                main.main(argv=['--dry-run', 'build'])
+            except SystemExit:
+                pass
+        assert_false(load_mock.called)
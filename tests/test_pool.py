@@ -0,0 +1,147 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+from tempfile import TemporaryFile
+
+import scuba.pool as uut
+import scuba.__main__ as main
+import scuba.imagecache
+from .fakedockerd import FakeDockerDaemon, make_image
+
+
+class TestPool(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+        self.enable_cache()
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        # (Scuba doesn't run containers if DOCKER_HOST is set)
+        self.env = mock.patch.dict('os.environ', DOCKER_CONFIG=self.path, SCUBA_POOL_SIZE='2')
+        self.env.start()
+        os.environ.pop('DOCKER_HOST', None)
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+
+        self.patches = [
+            mock.patch('scuba.dockerapi.DEFAULT_SOCKET', self.socket),
+            mock.patch('scuba.__main__.get_image_entrypoint', return_value=None),
+            # Fill the pool synchronously
+            mock.patch('scuba.pool.fill_later', side_effect=uut.fill),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.env.stop()
+        self.daemon.stop()
+        scuba.imagecache._inspected.clear()
+        super().tearDown()
+
+    def _run_scuba(self, args, exp_retval=0, func=main.main):
+        with TemporaryFile('w+t') as out, TemporaryFile() as stdin, \
+             mock.patch('sys.stdin', stdin), \
+             mock.patch('sys.stdout', out), mock.patch('sys.stderr', out):
+            try:
+                func(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def _run_admin(self, args, exp_retval=0):
+        return self._run_scuba(args, exp_retval, main.admin_main)
+
+    def _created(self):
+        return {cid for cid, c in self.daemon.containers.items() if c.status == 'created'}
+
+    def test_hit(self):
+        '''A repeated invocation runs a container created in advance'''
+        self._run_scuba(['true'])
+        pooled = self._created()
+        assert_equal(len(pooled), 2)
+
+        self._run_scuba(['true'])
+        assert_equal(len(self.daemon.removed), 2)
+        assert_in(self.daemon.removed[-1], pooled)
+
+        # The pool is refilled
+        assert_equal(len(self._created()), 2)
+        assert_equal(uut.get_stats(), (1, 1))
+
+    def test_full(self):
+        '''The pool isn't filled while it has SCUBA_POOL_SIZE containers'''
+        self._run_scuba(['true'])
+        self._run_scuba(['true'])
+
+        os.environ['SCUBA_POOL_SIZE'] = '1'
+        with mock.patch('scuba.pool.fill_later') as fill_mock:
+            self._run_scuba(['true'])
+        assert_false(fill_mock.called)
+        assert_equal(len(self._created()), 1)
+
+    def test_no_runtime_dir(self):
+        '''Nothing is claimed without a runtime directory'''
+        plan = mock.Mock(id='abc')
+        os.mkdir('abc')
+        open('abc/record.json', 'w').close()
+
+        with mock.patch('scuba.runtime.get_runtime_dir', return_value=None):
+            assert_is_none(uut.claim(plan))
+            assert_false(uut.needs_fill(plan.id))
+        assert_true(os.path.exists('abc/record.json'))
+
+    def test_disabled(self):
+        '''No containers are created in advance without SCUBA_POOL_SIZE'''
+        del os.environ['SCUBA_POOL_SIZE']
+        self._run_scuba(['true'])
+        self._run_scuba(['true'])
+        assert_equal(self._created(), set())
+        assert_equal(uut.get_stats(), (0, 0))
+
+    def test_config_changed(self):
+        '''Pooled containers are replaced once the config changes'''
+        self._run_scuba(['true'])
+        pooled = self._created()
+
+        with open('.scuba.yml', 'a') as f:
+            f.write('environment:\n  FOO: bar\n')
+        self._run_scuba(['true'])
+
+        assert_false(pooled & set(self.daemon.containers))
+        for cid in self._created():
+            assert_in('FOO=bar', self.daemon.containers[cid].config['Env'])
+        assert_equal(uut.get_stats(), (0, 2))
+
+    def test_image_changed(self):
+        '''Pooled containers are discarded once the image changes'''
+        self._run_scuba(['true'])
+        pooled = self._created()
+
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        scuba.imagecache._inspected.clear()
+        self._run_scuba(['true'])
+
+        assert_false(pooled & set(self.daemon.containers))
+        assert_equal(uut.get_stats(), (0, 2))
+
+    def test_stats_and_clear(self):
+        '''scuba-admin pool shows the hit rate, and clears the pool'''
+        self._run_scuba(['true'])
+        self._run_scuba(['true'])
+        self._run_scuba(['true'])
+
+        output = self._run_admin(['pool'])
+        assert_in('Pooled containers: 2', output)
+        assert_in('Hits: 2, misses: 1 (67% hit rate)', output)
+
+        output = self._run_admin(['pool', 'clear'])
+        assert_in('Removed 2 pooled container(s)', output)
+        assert_equal(self._created(), set())
+        assert_equal(uut.get_stats(), (0, 0))
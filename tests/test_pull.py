@@ -0,0 +1,243 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import io
+import os
+import sys
+import threading
+import time
+from tempfile import TemporaryFile
+
+import scuba.pull as uut
+import scuba.dockerutil
+import scuba.__main__ as main
+from scuba.config import load_config, PullPolicy
+from .fakedockerd import FakeDockerDaemon, make_image
+
+
+CONFIG = '''\
+image: busybox
+aliases:
+  a:
+    image: debian:buster
+    script: make
+  b:
+    image: busybox
+    script: make
+  c: make
+'''
+
+class TestPull(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write(CONFIG)
+
+    def test_config_images(self):
+        '''config_images returns all images, without duplicates'''
+        assert_seq_equal(uut.config_images(load_config('.scuba.yml')),
+                ['busybox', 'debian:buster'])
+
+    @mock.patch.dict('os.environ', SCUBA_DOCKER_BACKEND='cli')
+    def test_inspect_many_cli(self):
+        '''docker_inspect_many inspects all images with one docker command'''
+        cp = mock.Mock(returncode=1,
+                stdout='[{"Id": "sha256:1"}, {"Id": "sha256:3"}]',
+                stderr='Error: No such image: b\n')
+        with mock.patch('subprocess.run', return_value=cp) as run_mock:
+            result = scuba.dockerutil.docker_inspect_many(['a', 'b', 'c', 'a'])
+
+        assert_equal(run_mock.call_count, 1)
+        assert_equal(run_mock.call_args[0][0],
+                ['docker', 'inspect', '--type', 'image', 'a', 'b', 'c'])
+        assert_equal(result, dict(a={'Id': 'sha256:1'}, b=None, c={'Id': 'sha256:3'}))
+
+    @mock.patch.dict('os.environ', SCUBA_DOCKER_BACKEND='cli')
+    def test_inspect_many_cli_error(self):
+        '''docker_inspect_many raises DockerError on other errors'''
+        cp = mock.Mock(returncode=1, stdout='', stderr='Cannot connect to the Docker daemon')
+        with mock.patch('subprocess.run', return_value=cp):
+            assert_raises(scuba.dockerutil.DockerError,
+                    scuba.dockerutil.docker_inspect_many, ['a'])
+
+    def test_pull_concurrent(self):
+        '''Images are pulled concurrently'''
+        barrier = threading.Barrier(3, timeout=5)
+        def mocked_pull(image, out):
+            barrier.wait()
+            print('progress', file=out)
+
+        out = io.StringIO()
+        with mock.patch('scuba.dockerutil.docker_pull_missing', side_effect=mocked_pull):
+            errors = uut.pull_images(['a', 'b', 'c'], jobs=3, out=out)
+
+        assert_equal(errors, {})
+        lines = out.getvalue().splitlines()
+        for image in ('a', 'b', 'c'):
+            assert_in(image + ': progress', lines)
+        assert_equal(len([l for l in lines if l.startswith('[')]), 3)
+        assert_true(lines[-1].startswith('[3/3] '))
+
+    def test_pull_errors(self):
+        '''Errors are returned for each image which fails to pull'''
+        def mocked_pull(image, out):
+            if image == 'b':
+                raise scuba.dockerutil.DockerError('nope')
+
+        out = io.StringIO()
+        with mock.patch('scuba.dockerutil.docker_pull_missing', side_effect=mocked_pull):
+            errors = uut.pull_images(['a', 'b'], out=out)
+        assert_equal(list(errors), ['b'])
+        assert_in('b: Failed: nope', out.getvalue())
+
+
+class TestPullMain(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write(CONFIG)
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _run_scuba(self, args, exp_retval=0, func=main.main):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                func(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def _run_admin(self, args, exp_retval=0):
+        return self._run_scuba(args, exp_retval, main.admin_main)
+
+    def test_pull(self):
+        '''scuba-admin pull pulls the missing images'''
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        self.daemon.registry['debian:buster'] = make_image('debian:buster')
+
+        output = self._run_admin(['pull', '-j', '2'])
+        assert_in('1 of 2 image(s) need to be pulled', output)
+        assert_in('[1/1] debian:buster: Done', output)
+        assert_in('debian:buster', self.daemon.images)
+
+        # Nothing to do the second time
+        output = self._run_admin(['pull'])
+        assert_in('0 of 2 image(s) need to be pulled', output)
+
+    def test_pull_failure(self):
+        '''scuba-admin pull fails if an image can't be pulled'''
+        output = self._run_admin(['pull'], 128)
+        assert_in('Failed to pull 2 image(s)', output)
+
+    def test_pull_command(self):
+        '''scuba pull runs "pull" in the container, rather than pulling images'''
+        with mock.patch('scuba.__main__.run_scuba', return_value=0) as run_mock:
+            self._run_scuba(['pull'])
+        assert_equal(self.daemon.requests, [])
+        assert_equal(run_mock.call_args[0][0].command, ['pull'])
+
+
+class TestPullPolicy(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+        self.daemon.registry['busybox:latest'] = make_image('busybox')
+
+        self.stderr = mock.patch('sys.stderr', io.StringIO())
+        self.stderr.start()
+
+    def tearDown(self):
+        self.stderr.stop()
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _pulls(self):
+        return len([r for r in self.daemon.requests if r == ('POST', '/images/create')])
+
+    def test_missing(self):
+        '''The missing policy leaves pulling to docker run'''
+        uut.ensure_image('busybox', PullPolicy('missing', None))
+        assert_equal(self.daemon.requests, [])
+
+    def test_never(self):
+        '''The never policy requires the image to exist'''
+        assert_raises(scuba.dockerutil.DockerError,
+                uut.ensure_image, 'busybox', PullPolicy('never', None))
+
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+        uut.ensure_image('busybox', PullPolicy('never', None))
+        assert_equal(self._pulls(), 0)
+
+    def test_always(self):
+        '''The always policy pulls every time'''
+        self.enable_cache()
+        for _ in range(2):
+            uut.ensure_image('busybox', PullPolicy('always', None))
+        assert_equal(self._pulls(), 2)
+        assert_in('busybox:latest', self.daemon.images)
+        assert_in('Downloaded newer image', sys.stderr.getvalue())
+
+    def test_always_digest(self):
+        '''An image referenced by digest is never refreshed'''
+        uut.ensure_image('busybox@sha256:' + '0' * 64, PullPolicy('always', None))
+        assert_equal(self.daemon.requests, [])
+
+    def test_always_concurrent(self):
+        '''Concurrent pulls for the always policy are coalesced'''
+        self.enable_cache()
+        self.daemon.pull_delay = 0.2
+        threads = [threading.Thread(target=uut.ensure_image,
+                    args=('busybox', PullPolicy('always', None))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert_equal(self._pulls(), 1)
+
+    def test_ttl(self):
+        '''The ttl policy only pulls when the last check is older than the TTL'''
+        self.enable_cache()
+        policy = PullPolicy('ttl', 60)
+        now = time.time()
+
+        uut.ensure_image('busybox', policy)
+        with mock.patch('time.time', return_value=now + 30):
+            uut.ensure_image('busybox', policy)
+        assert_equal(self._pulls(), 1)
+
+        with mock.patch('time.time', return_value=now + 90):
+            uut.ensure_image('busybox', policy)
+        assert_equal(self._pulls(), 2)
+
+    def test_ttl_no_cache(self):
+        '''Without the cache, the ttl policy always pulls'''
+        for _ in range(2):
+            uut.ensure_image('busybox', PullPolicy('ttl', 60))
+        assert_equal(self._pulls(), 2)
+
+    def test_pull_failure(self):
+        '''A failed pull raises DockerError'''
+        del self.daemon.registry['busybox:latest']
+        assert_raises(scuba.dockerutil.DockerError,
+                uut.ensure_image, 'busybox', PullPolicy('ttl', 60))
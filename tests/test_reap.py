@@ -0,0 +1,107 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+import time
+from tempfile import TemporaryFile
+
+import scuba.reap as uut
+import scuba.dockerutil
+import scuba.__main__ as main
+from .fakedockerd import FakeDockerDaemon, Container, make_image
+
+
+class TestReap(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _add_container(self, labels, exited=True):
+        container = Container(dict(Image='busybox', Labels=labels))
+        container.started.set()
+        if exited:
+            container.exited.set()
+        self.daemon.containers[container.id] = container
+        return container.id
+
+    def _run_admin(self, args, exp_retval=0):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                main.admin_main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def test_run_async_rm(self):
+        '''The container is left for a detached process to remove'''
+        cidfile = os.path.join(self.path, 'cid')
+        run_args = ['docker', 'run', '-i'] + uut.run_options(cidfile) + ['busybox', 'true']
+
+        with TemporaryFile() as fin, TemporaryFile() as fout, \
+             mock.patch('sys.stdin', fin), mock.patch('sys.stdout', fout), \
+             mock.patch('sys.stderr', fout), \
+             mock.patch('subprocess.Popen') as popen_mock:
+            rc = main.run_docker(run_args)
+        assert_equal(rc, 0)
+
+        with open(cidfile) as f:
+            cid = f.read()
+        assert_in(cid, self.daemon.containers)
+        assert_equal(self.daemon.removed, [])
+
+        args = popen_mock.call_args[0][0]
+        assert_equal(args[1:], ['-m', 'scuba.reap', cid])
+        assert_true(popen_mock.call_args[1]['start_new_session'])
+
+    def test_reaper_process(self):
+        '''The detached process removes the container'''
+        cid = self._add_container({uut.REAP_LABEL: '1'})
+        with open('cid', 'w') as f:
+            f.write(cid)
+
+        uut.reap_later('cid')
+        for _ in range(200):
+            if not cid in self.daemon.containers:
+                break
+            time.sleep(0.05)
+        assert_equal(self.daemon.removed, [cid])
+
+    def test_no_cidfile(self):
+        '''Nothing is reaped if the container wasn't created'''
+        with mock.patch('subprocess.Popen') as popen_mock:
+            uut.reap_later('nonexistent')
+        assert_false(popen_mock.called)
+
+    def test_gc_containers(self):
+        '''scuba-admin gc removes the stopped containers left by --async-rm'''
+        stopped = self._add_container({uut.REAP_LABEL: '1'})
+        running = self._add_container({uut.REAP_LABEL: '1'}, exited=False)
+        other = self._add_container({})
+
+        output = self._run_admin(['gc', '--containers'])
+        assert_in('Removed 1 stopped container(s)', output)
+        assert_equal(sorted(self.daemon.containers), sorted([running, other]))
+
+    @mock.patch.dict('os.environ', SCUBA_DOCKER_BACKEND='cli')
+    def test_stopped_containers_cli(self):
+        '''Stopped containers are found using docker ps'''
+        cp = mock.Mock(returncode=0, stdout='abc\ndef\n')
+        with mock.patch('subprocess.run', return_value=cp) as run_mock:
+            assert_equal(scuba.dockerutil.get_stopped_containers('scuba.reap'), ['abc', 'def'])
+        assert_in('label=scuba.reap', run_mock.call_args[0][0])
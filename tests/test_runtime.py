@@ -0,0 +1,115 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+import threading
+import time
+from io import StringIO
+
+import scuba.runtime as uut
+import scuba.dockerutil
+from .fakedockerd import FakeDockerDaemon, make_image
+
+
+class TestRuntimeDir(TmpDirTestCase):
+    def test_env(self):
+        '''SCUBA_RUNTIME_DIR specifies the runtime directory'''
+        assert_equal(uut.get_runtime_dir(), self.runtime_dir)
+
+    def test_xdg(self):
+        '''The runtime directory is created under XDG_RUNTIME_DIR'''
+        del os.environ['SCUBA_RUNTIME_DIR']
+        with mock.patch.dict('os.environ', XDG_RUNTIME_DIR=self.path):
+            path = uut.get_runtime_dir()
+        assert_equal(path, os.path.join(self.path, 'scuba'))
+        assert_equal(os.stat(path).st_mode & 0o777, 0o700)
+
+    def test_not_owned(self):
+        '''A runtime directory owned by another user is not used'''
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            assert_is_none(uut.get_runtime_dir())
+
+    def test_not_dir(self):
+        '''A runtime directory which is a symlink is not used'''
+        os.symlink(self.runtime_dir, 'link')
+        os.environ['SCUBA_RUNTIME_DIR'] = os.path.join(self.path, 'link')
+        assert_is_none(uut.get_runtime_dir())
+
+
+class TestFileLock(TmpDirTestCase):
+    def test_exclusive(self):
+        '''A lock is only held by one holder at a time'''
+        events = []
+        first = uut.FileLock('test.lock').__enter__()
+
+        def other():
+            with uut.FileLock('test.lock'):
+                events.append('other')
+
+        with mock.patch('sys.stderr', StringIO()):
+            t = threading.Thread(target=other)
+            t.start()
+            time.sleep(0.1)
+            events.append('first')
+            first.__exit__(None, None, None)
+            t.join()
+
+        assert_equal(events, ['first', 'other'])
+
+    def test_wait_msg(self):
+        '''A message is shown while waiting for the lock'''
+        with uut.FileLock('test.lock'):
+            def other():
+                with uut.FileLock('test.lock', wait_msg='Waiting'):
+                    pass
+            with mock.patch('sys.stderr', StringIO()) as stderr:
+                t = threading.Thread(target=other)
+                t.start()
+                time.sleep(0.1)
+        t.join()
+        assert_equal(stderr.getvalue(), 'scuba: Waiting\n')
+
+    def test_no_runtime_dir(self):
+        '''Locking does nothing if there is no runtime directory'''
+        with mock.patch('scuba.runtime.get_runtime_dir', return_value=None):
+            with uut.FileLock('test.lock'):
+                with uut.FileLock('test.lock'):
+                    pass
+
+
+class TestPullCoalescing(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def test_one_pull(self):
+        '''Concurrent pulls of a missing image only pull it once'''
+        info = self.daemon.registry['busybox:latest'] = make_image('busybox')
+        self.daemon.pull_delay = 0.2
+
+        results = []
+        def pull():
+            results.append(scuba.dockerutil.docker_inspect_or_pull('busybox'))
+
+        with mock.patch('sys.stdout', StringIO()), mock.patch('sys.stderr', StringIO()):
+            threads = [threading.Thread(target=pull) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        pulls = [r for r in self.daemon.requests if r == ('POST', '/images/create')]
+        assert_equal(len(pulls), 1)
+        assert_equal([r['Id'] for r in results], [info['Id']] * 8)
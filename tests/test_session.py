@@ -0,0 +1,182 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+import subprocess
+import time
+from tempfile import TemporaryFile
+
+import scuba.session as uut
+import scuba.__main__ as main
+from .fakedockerd import FakeDockerDaemon, Container, make_image
+
+
+CONFIG = '''\
+image: busybox
+hooks:
+  user: echo user
+'''
+
+class TestSession(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write(CONFIG)
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        # (Scuba doesn't run containers if DOCKER_HOST is set)
+        self.env = mock.patch.dict('os.environ', DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('DOCKER_HOST', None)
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+        self.daemon.images['busybox:latest'] = make_image('busybox')
+
+        self.patches = [
+            mock.patch('scuba.dockerapi.DEFAULT_SOCKET', self.socket),
+            mock.patch('scuba.__main__.get_image_entrypoint', return_value=None),
+            mock.patch('scuba.dockerutil.run_detached', side_effect=self._run_detached),
+        ]
+        for p in self.patches:
+            p.start()
+        self.started = []
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _run_detached(self, args):
+        # Act like the session container, once scubainit is done
+        scubadir = next(a for a in args if a.endswith(':/.scuba:z'))
+        scubadir = scubadir[len('--volume='):-len(':/.scuba:z')]
+        open(os.path.join(scubadir, 'ready'), 'w').close()
+
+        container = Container(dict(Image='busybox'))
+        container.started.set()
+        self.daemon.containers[container.id] = container
+        self.started.append((args, container.id))
+        return container.id
+
+    def _run_scuba(self, args, exp_retval=0, func=main.main):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                func(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def _run_admin(self, args, exp_retval=0):
+        return self._run_scuba(args, exp_retval, main.admin_main)
+
+    def _start(self, *args):
+        output = self._run_admin(['session', 'start'] + list(args))
+        assert_in('Started session', output)
+        return self.started[-1][1]
+
+    def _run_in_session(self, args):
+        '''Run scuba, returning the docker exec command line, or None'''
+        with mock.patch('subprocess.call', return_value=0) as call_mock, \
+             mock.patch('scuba.dockerutil.run', return_value=0) as run_mock:
+            self._run_scuba(args)
+        if run_mock.called:
+            return None
+        return call_mock.call_args[1]['args'] if 'args' in call_mock.call_args[1] \
+                else call_mock.call_args[0][0]
+
+    def test_start(self):
+        '''A session runs the session script, detached, as the user'''
+        cid = self._start()
+        args = self.started[0][0]
+        assert_equal(args[:3], ['docker', 'run', '--detach'])
+        assert_in('--env=SCUBAINIT_UID={}'.format(os.getuid()), args)
+        assert_in('--env=SCUBAINIT_HOOK_USER=/.scuba/hooks/user.sh', args)
+
+        sessions = uut.list_sessions()
+        assert_equal([s.container for s in sessions], [cid])
+        assert_equal(sessions[0].directory, self.path)
+        assert_true(os.path.exists(os.path.join(sessions[0].path, uut.SESSION_SCRIPT_NAME)))
+
+    def test_already_running(self):
+        '''Only one session is started for the same container setup'''
+        self._start()
+        output = self._run_admin(['session', 'start'], 128)
+        assert_in('already running', output)
+
+    def test_exec(self):
+        '''A matching invocation runs its command in the session'''
+        cid = self._start()
+        os.mkdir('sub')
+        os.chdir('sub')
+        args = self._run_in_session(['echo', 'hi'])
+
+        assert_equal(args[:3], ['docker', 'exec', '-i'])
+        assert_in('--user={}:{}'.format(os.getuid(), os.getgid()), args)
+        assert_equal(os.path.normpath(args[args.index('-w') + 1]), os.path.join(self.path, 'sub'))
+        assert_false([a for a in args if a.startswith('--env=SCUBAINIT_')])
+        assert_in(cid, args)
+        assert_equal(args[-1], '/.scuba/commands/{}.sh'.format(os.getpid()))
+
+        # The command script is removed, and the session marked as used
+        session = uut.list_sessions()[0]
+        assert_equal(os.listdir(os.path.join(session.path, 'commands')), [])
+        assert_true(os.path.exists(os.path.join(session.path, 'used')))
+
+    def test_no_match(self):
+        '''Invocations which need a different container are run as usual'''
+        self._start()
+        assert_is_none(self._run_in_session(['-r', 'true']))
+        assert_is_none(self._run_in_session(['--image', 'debian', 'true']))
+        assert_is_none(self._run_in_session(['--docker-arg=--privileged', 'true']))
+
+        with open('.scuba.yml', 'a') as f:
+            f.write('  root: echo root\n')
+        assert_is_none(self._run_in_session(['true']))
+
+    def test_stopped_session(self):
+        '''A session whose container has stopped is forgotten'''
+        cid = self._start()
+        del self.daemon.containers[cid]
+        assert_is_none(self._run_in_session(['true']))
+        assert_equal(uut.list_sessions(), [])
+        assert_false(uut.have_sessions())
+
+    def test_stop(self):
+        '''scuba-admin session stop removes the sessions of the current directory'''
+        cid = self._start()
+        output = self._run_admin(['session', 'stop'])
+        assert_in('Stopped session {}'.format(cid[:12]), output)
+        assert_equal(self.daemon.removed, [cid])
+        assert_false(uut.have_sessions())
+
+    def test_list(self):
+        '''scuba-admin session list shows the running sessions'''
+        cid = self._start()
+        output = self._run_admin(['session', 'list'])
+        assert_in('{}  busybox  {}  up 0s, idle 0s'.format(cid[:12], self.path), output)
+
+
+class TestSessionScript(TmpDirTestCase):
+    def test_idle(self):
+        '''The session script runs until it has been idle for its timeout'''
+        with open(uut.SESSION_SCRIPT_NAME, 'w') as f:
+            f.write(uut.SESSION_SCRIPT)
+        os.mkdir('commands')
+        open('commands/1.sh', 'w').close()
+
+        p = subprocess.Popen(['sh', uut.SESSION_SCRIPT_NAME, '1', '1'])
+        try:
+            time.sleep(2.5)
+            assert_true(os.path.exists('ready'))
+            assert_is_none(p.poll())    # Busy with a command
+
+            os.unlink('commands/1.sh')
+            assert_equal(p.wait(timeout=10), 0)
+        finally:
+            if p.poll() is None:
+                p.kill()
@@ -0,0 +1,159 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import json
+import os
+import time
+
+import scuba.trace as uut
+import scuba.__main__ as main
+
+
+def read_trace(path):
+    '''Read a trace file, which may be missing its closing bracket'''
+    with open(path) as f:
+        data = f.read().rstrip()
+    return json.loads(data.rstrip(',') + ']')
+
+def span_names(events):
+    return [e['name'] for e in events if e['ph'] == 'X']
+
+def slow_create(real_open):
+    '''Wrap os.open so that a process which creates a file is delayed'''
+    def wrapper(path, flags, *args):
+        existed = os.path.exists(path)
+        fd = real_open(path, flags, *args)
+        if not existed:
+            time.sleep(0.1)
+        return fd
+    return wrapper
+
+
+class TestTrace(TmpDirTestCase):
+    def tearDown(self):
+        uut.finish(None)
+        super().tearDown()
+
+    def test_inactive(self):
+        '''Nothing is recorded when tracing is not active'''
+        with uut.span('foo'):
+            pass
+        assert_false(uut.is_active())
+
+    def test_span(self):
+        '''Spans are recorded with their arguments'''
+        uut.start()
+        with uut.span('foo', cat='bar', x=1):
+            pass
+        uut.finish('trace.json')
+
+        events = read_trace('trace.json')
+        foo = [e for e in events if e['name'] == 'foo'][0]
+        assert_equal(foo['cat'], 'bar')
+        assert_equal(foo['args'], dict(x=1))
+        assert_equal(foo['pid'], os.getpid())
+        assert_greater_equal(foo['dur'], 0)
+
+    def test_traced(self):
+        '''traced() records a span for each call'''
+        @uut.traced('func')
+        def func(x):
+            return x + 1
+
+        uut.start()
+        assert_equal(func(1), 2)
+        assert_equal(func(2), 3)
+        uut.finish('trace.json')
+
+        assert_equal(span_names(read_trace('trace.json')), ['startup', 'func', 'func'])
+
+    def test_append(self):
+        '''Traces from several invocations are appended to the same file'''
+        for name in ('foo', 'bar'):
+            uut.start()
+            with uut.span(name):
+                pass
+            uut.finish('trace.json')
+
+        assert_equal(span_names(read_trace('trace.json')),
+                ['startup', 'foo', 'startup', 'bar'])
+
+    def test_concurrent(self):
+        '''Traces from concurrent processes are all appended, after one bracket'''
+        nprocs = 8
+        rfd, wfd = os.pipe()
+        pids = []
+        for i in range(nprocs):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(wfd)
+                    uut.start()
+                    with uut.span('proc{}'.format(i)):
+                        pass
+                    os.read(rfd, 1)     # Wait for all processes to be ready
+                    with mock.patch('os.open', slow_create(os.open)):
+                        uut.finish('trace.json')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        os.close(rfd)
+        os.close(wfd)       # Start them all at once
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        with open('trace.json') as f:
+            assert_true(f.read().startswith('[\n'))
+        assert_equal(sorted(n for n in span_names(read_trace('trace.json')) if n != 'startup'),
+                sorted('proc{}'.format(i) for i in range(nprocs)))
+
+    def test_finish_no_path(self):
+        '''finish() without a path discards the events'''
+        uut.start()
+        with uut.span('foo'):
+            pass
+        uut.finish(None)
+        assert_false(uut.is_active())
+        assert_equal(os.listdir('.'), [])
+
+
+class TestMainTrace(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # docker is mocked
+        os.environ['SCUBA_DOCKER_BACKEND'] = 'cli'
+
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+            f.write('entrypoint: ""\n')
+
+    def _run_scuba(self, args):
+        with mock.patch('subprocess.call', return_value=0):
+            try:
+                main.main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, 0)
+
+    def test_trace_option(self):
+        '''--trace records the phases of an invocation'''
+        self._run_scuba(['--trace', 'trace.json', 'true'])
+
+        names = span_names(read_trace('trace.json'))
+        for name in ('parse_scuba_args', 'ScubaDive.__init__', 'ScubaDive.prepare',
+                     'dockerutil.call', 'main'):
+            assert_in(name, names)
+
+    def test_trace_env(self):
+        '''SCUBA_TRACE specifies the trace file'''
+        with mock.patch.dict('os.environ', {uut.ENV_VAR: 'trace.json'}):
+            self._run_scuba(['true'])
+        assert_in('main', span_names(read_trace('trace.json')))
+
+    def test_no_trace(self):
+        '''No trace is written by default'''
+        self._run_scuba(['true'])
+        assert_equal(os.listdir('.'), ['.scuba.yml'])
+        assert_false(uut.is_active())
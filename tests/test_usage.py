@@ -0,0 +1,168 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import json
+import os
+import time
+from tempfile import TemporaryFile
+
+import scuba.lockfile
+import scuba.usage as uut
+import scuba.__main__ as main
+from .fakedockerd import FakeDockerDaemon, Container, make_image
+
+DAY = 24 * 60 * 60
+
+
+class TestSelectImages(TmpDirTestCase):
+    NOW = 1000 * DAY
+
+    def _usage(self, **ages):
+        return {i: (self.NOW - age * DAY, i) for i, age in ages.items()}
+
+    def test_max_age(self):
+        '''Images not used within max_age are selected, oldest first'''
+        usage = self._usage(a=10, b=40, c=31)
+        sizes = dict(a=1, b=1, c=1)
+        assert_equal(uut.select_images(usage, sizes, max_age=30*DAY, now=self.NOW), ['b', 'c'])
+
+    def test_max_size(self):
+        '''The least recently used images are selected until under max_size'''
+        usage = self._usage(a=1, b=3, c=2)
+        sizes = dict(a=100, b=100, c=100)
+        assert_equal(uut.select_images(usage, sizes, max_size=150, now=self.NOW), ['b', 'c'])
+        assert_equal(uut.select_images(usage, sizes, max_size=300, now=self.NOW), [])
+
+    def test_protected(self):
+        '''Protected and missing images are not selected'''
+        usage = self._usage(a=50, b=40, c=30)
+        sizes = dict(a=1, b=1)
+        assert_equal(uut.select_images(usage, sizes, protected={'a'},
+                max_age=DAY, now=self.NOW), ['b'])
+
+
+class TestUsage(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ',
+                DOCKER_HOST='unix://' + self.socket,
+                DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+
+        self.images = {}
+        for name in ('old', 'recent', 'running', 'locked', 'untracked'):
+            self.images[name] = self.daemon.images[name + ':latest'] = make_image(name)
+
+    def tearDown(self):
+        self.env.stop()
+        self.daemon.stop()
+        super().tearDown()
+
+    def _run_admin(self, args, exp_retval=0):
+        with TemporaryFile('w+t') as out, mock.patch('sys.stdout', out), \
+             mock.patch('sys.stderr', out):
+            try:
+                main.admin_main(argv=args)
+            except SystemExit as sysexit:
+                assert_equal(sysexit.code, exp_retval)
+            out.seek(0)
+            return out.read()
+
+    def _use(self, name, days_ago):
+        uut.record_image(name)
+        t = time.time() - days_ago * DAY
+        os.utime(uut._usage_path(self.images[name]['Id']), (t, t))
+
+    def test_record(self):
+        '''The last use of an image is recorded by its ID'''
+        assert_true(uut.record_image('recent'))
+        assert_false(uut.record_image('missing'))
+
+        usage = uut.get_usage()
+        assert_equal(list(usage), [self.images['recent']['Id']])
+        last_used, ref = usage[self.images['recent']['Id']]
+        assert_almost_equal(last_used, time.time(), delta=5)
+        assert_equal(ref, 'recent')
+
+    def test_run_records(self):
+        '''Running an image records its use, even if it is pulled by docker run'''
+        with mock.patch('scuba.dockerutil.run', return_value=0) as run_mock, \
+             mock.patch('scuba.usage.record_image', return_value=False) as record_mock:
+            main.run_docker(['docker', 'run'], 'busybox')
+        assert_true(run_mock.called)
+        assert_equal(record_mock.call_args_list, [mock.call('busybox')] * 2)
+
+    def test_run_records_image_id(self):
+        '''The use of an image whose ID is known is recorded without resolving it'''
+        image_id = self.images['recent']['Id']
+        with mock.patch('scuba.dockerutil.run', return_value=0), \
+             mock.patch('scuba.imagecache.get_image_id') as id_mock:
+            main.run_docker(['docker', 'run'], 'recent', image_id=image_id)
+        assert_false(id_mock.called)
+        assert_equal(list(uut.get_usage()), [image_id])
+
+    def test_gc(self):
+        '''scuba-admin gc removes old images, except those in use or locked'''
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: locked\n')
+        with open('.scuba.lock', 'w') as f:
+            json.dump(dict(version=1, images=dict(
+                locked=self.images['locked']['RepoDigests'][0])), f)
+
+        for name in ('old', 'running', 'locked'):
+            self._use(name, 60)
+        self._use('recent', 1)
+
+        container = Container(dict(Image='running'))
+        container.started.set()
+        self.daemon.containers[container.id] = container
+
+        output = self._run_admin(['gc', '--max-age', '30d', '--dry-run'])
+        assert_in('Would remove old', output)
+        assert_in('old:latest', self.daemon.images)
+
+        output = self._run_admin(['gc', '--max-age', '30d'])
+        assert_in('Removed old (1.0 KiB, last run 60.0 days ago)', output)
+        assert_equal(sorted(self.daemon.images),
+                ['locked:latest', 'recent:latest', 'running:latest', 'untracked:latest'])
+        assert_not_in(self.images['old']['Id'], uut.get_usage())
+
+    def test_gc_locked_bundle(self):
+        '''scuba-admin gc keeps pinned images which exist by their local tags'''
+        digest = 'bundled@sha256:' + '3' * 64
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: bundled\n')
+        with open('.scuba.lock', 'w') as f:
+            json.dump(dict(version=1, images=dict(bundled=digest)), f)
+
+        # As loaded from a bundle: without its digest, by its local tag
+        local_tag = scuba.lockfile.local_tag(digest)
+        image = make_image('bundled')
+        image.update(RepoTags=[local_tag], RepoDigests=[])
+        self.daemon.images[local_tag] = image
+        uut.record_use(image['Id'], 'bundled')
+        t = time.time() - 60 * DAY
+        os.utime(uut._usage_path(image['Id']), (t, t))
+
+        self._run_admin(['gc', '--max-age', '30d'])
+        assert_in(local_tag, self.daemon.images)
+
+    def test_gc_max_size(self):
+        '''scuba-admin gc removes the least recently used images to fit in max_size'''
+        for i, name in enumerate(('old', 'recent', 'locked')):
+            self._use(name, 10 - i)
+
+        output = self._run_admin(['gc', '--max-size', '1.5K'])
+        assert_in('Removed 2 image(s)', output)
+        assert_equal(sorted(self.daemon.images),
+                ['locked:latest', 'running:latest', 'untracked:latest'])
+
+    def test_gc_requires_limit(self):
+        '''scuba-admin gc requires --max-size or --max-age'''
+        self._run_admin(['gc'], 2)
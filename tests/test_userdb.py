@@ -0,0 +1,197 @@
+from nose.tools import *
+from .utils import *
+from unittest import mock
+
+import os
+import time
+
+import scuba.userdb as uut
+import scuba.__main__ as main
+import scuba.imagecache
+import scuba.plan
+from .fakedockerd import FakeDockerDaemon, make_image
+
+PASSWD = 'root:x:0:0:root:/root:/bin/sh\nbin:x:1:1:bin:/bin:/sbin/nologin\n'
+GROUP = 'root:x:0:\nbin:x:1:\n'
+SHADOW = 'root:*:18000:0:99999:7:::\n'
+
+
+class TestAddUser(unittest.TestCase):
+    def setUp(self):
+        self.files = {
+            uut.ETC_PASSWD: PASSWD,
+            uut.ETC_GROUP: GROUP,
+            uut.ETC_SHADOW: SHADOW,
+        }
+
+    def test_add(self):
+        '''The user and group are appended, like scubainit does'''
+        result = uut.add_user(self.files, 1000, 1001, 'me', 'us', '/home/me')
+        assert_equal(result[uut.ETC_PASSWD], PASSWD + 'me:x:1000:1001:me:/home/me:/bin/sh\n')
+        assert_equal(result[uut.ETC_GROUP], GROUP + 'us:x:1001:\n')
+        assert_equal(result[uut.ETC_SHADOW], SHADOW + 'me:x:::::::\n')
+        assert_equal(self.files[uut.ETC_PASSWD], PASSWD)
+
+    def test_missing_files(self):
+        '''Files missing from the image only contain the user or group'''
+        files = dict(self.files)
+        files[uut.ETC_SHADOW] = None
+        result = uut.add_user(files, 1000, 1000, 'me', 'me', '/home/me')
+        assert_equal(result[uut.ETC_SHADOW], 'me:x:::::::\n')
+
+    def test_existing(self):
+        '''An identical user or group is left alone'''
+        result = uut.add_user(self.files, 1, 1, 'bin', 'bin', '/home/bin')
+        assert_equal(result[uut.ETC_PASSWD], PASSWD)
+        assert_equal(result[uut.ETC_GROUP], GROUP)
+
+    def test_conflict(self):
+        '''A user with the same name but a different UID is an error'''
+        with assert_raises(uut.UserDBError) as ctx:
+            uut.add_user(self.files, 1000, 1, 'bin', 'bin', '/home/bin')
+        assert_equal(str(ctx.exception),
+                'User "bin" already exists with different uid in /etc/passwd')
+
+    def test_same_id(self):
+        '''A user with the same UID but a different name is a warning'''
+        with mock.patch('sys.stderr') as stderr:
+            result = uut.add_user(self.files, 1, 1000, 'me', 'me', '/home/me')
+        assert_in('me:x:1:1000:', result[uut.ETC_PASSWD])
+        assert_in('Warning: UID 1 already exists', str(stderr.write.call_args_list))
+
+
+class TestGetNames(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enable_cache()
+
+    def test_cached(self):
+        '''User and group names are looked up once'''
+        expected = uut.get_names(os.getuid(), os.getgid())
+        with mock.patch('pwd.getpwuid') as pw_mock:
+            assert_equal(uut.get_names(os.getuid(), os.getgid()), expected)
+        assert_false(pw_mock.called)
+
+    def test_expired(self):
+        '''User and group names are looked up again after NAMES_CACHE_TTL'''
+        uut.get_names(os.getuid(), os.getgid())
+        later = time.time() + uut.NAMES_CACHE_TTL + 1
+        with mock.patch('time.time', return_value=later), \
+             mock.patch('pwd.getpwuid') as pw_mock:
+            pw_mock.return_value.pw_name = 'renamed'
+            assert_equal(uut.get_names(os.getuid(), os.getgid())[0], 'renamed')
+
+
+class TestImageFiles(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('.scuba.yml', 'w') as f:
+            f.write('image: busybox\n')
+        self.enable_cache()
+
+        self.socket = os.path.join(self.path, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket).start()
+        self.env = mock.patch.dict('os.environ', DOCKER_CONFIG=self.path)
+        self.env.start()
+        os.environ.pop('DOCKER_HOST', None)
+        os.environ.pop('SCUBA_DOCKER_BACKEND', None)
+        self.sockpatch = mock.patch('scuba.dockerapi.DEFAULT_SOCKET', self.socket)
+        self.sockpatch.start()
+
+        image = self.daemon.images['busybox:latest'] = make_image('busybox')
+        self.daemon.image_files[image['Id']] = {
+            '/etc/passwd': ('link', '../usr/lib/passwd'),
+            '/usr/lib/passwd': PASSWD.encode(),
+            '/etc/group': GROUP.encode(),
+        }
+
+    def tearDown(self):
+        self.sockpatch.stop()
+        self.env.stop()
+        self.daemon.stop()
+        scuba.imagecache._inspected.clear()
+        super().tearDown()
+
+    def test_read(self):
+        '''The files are read from a container, which is removed'''
+        files = uut.get_image_files('busybox')
+        assert_equal(files, {
+            uut.ETC_PASSWD: PASSWD,
+            uut.ETC_GROUP: GROUP,
+            uut.ETC_SHADOW: None,
+        })
+        assert_equal(len(self.daemon.removed), 1)
+        assert_equal(self.daemon.containers, {})
+
+    def test_cached(self):
+        '''The files of an image are read once'''
+        expected = uut.get_image_files('busybox')
+        assert_equal(uut.get_image_files('busybox'), expected)
+        assert_equal(len(self.daemon.removed), 1)
+
+    def test_mount(self):
+        '''With mount_userdb, the generated files are bind-mounted read-only'''
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=None):
+            dive = main.ScubaDive(['true'], docker_args=['--read-only'], mount_userdb=True)
+            try:
+                dive.prepare()
+                args = dive.get_docker_cmdline()
+                with open(os.path.join(dive.scubadir_hostpath, 'etc/passwd')) as f:
+                    passwd = f.read()
+            finally:
+                dive.cleanup_tempfiles()
+
+        user = dive.env_vars['SCUBAINIT_USER']
+        assert_true(passwd.startswith(PASSWD))
+        assert_in('{}:x:{}:'.format(user, os.getuid()), passwd)
+        for path in uut.USERDB_FILES:
+            vol = '--volume={}{}:{}:ro,z'.format(dive.scubadir_hostpath, path, path)
+            assert_in(vol, args)
+        assert_equal(dive.env_vars['SCUBAINIT_USERDB_MOUNTED'], 1)
+        assert_in('--tmpfs=/home/{}:exec,mode=0700,uid={},gid={}'.format(
+                user, os.getuid(), os.getgid()), args)
+
+    def _prepare(self, docker_args=[]):
+        '''Prepare an invocation with mount_userdb
+
+        Returns: The ScubaDive, and its docker command line
+        '''
+        with mock.patch('scuba.__main__.get_image_entrypoint', return_value=None):
+            dive = main.ScubaDive(['true'], docker_args=docker_args, mount_userdb=True)
+            try:
+                dive.prepare()
+                return dive, dive.get_docker_cmdline()
+            except:
+                dive.cleanup_tempfiles()
+                raise
+
+    def test_read_only_value(self):
+        '''The home directory is a tmpfs if --read-only is given a true value'''
+        for opt, expected in (('--read-only=true', True), ('--read-only=false', False)):
+            dive, args = self._prepare([opt])
+            dive.cleanup_tempfiles()
+            tmpfs = [a for a in args if a.startswith('--tmpfs=')]
+            assert_equal(bool(tmpfs), expected, opt)
+
+    def test_plan_non_utf8(self):
+        '''Files which aren't UTF-8 (e.g. GECOS fields) are reproduced by a plan'''
+        passwd = PASSWD.encode() + 'caf\xe9:x:2:2:Caf\xe9:/:/bin/sh\n'.encode('latin-1')
+        image = self.daemon.images['busybox:latest']
+        self.daemon.image_files[image['Id']]['/usr/lib/passwd'] = passwd
+
+        key = dict(test='non-utf8')
+        dive, args = self._prepare()
+        try:
+            scuba.plan.Plan.store(key, dive, args)
+        finally:
+            dive.cleanup_tempfiles()
+
+        plan = scuba.plan.Plan.load(key)
+        args = plan.materialize()
+        try:
+            scubadir = [a for a in args if a.endswith(':/.scuba:z')][0]
+            scubadir = scubadir[len('--volume='):-len(':/.scuba:z')]
+            with open(os.path.join(scubadir, 'etc/passwd'), 'rb') as f:
+                assert_true(f.read().startswith(passwd))
+        finally:
+            plan.cleanup_tempfiles()
@@ -3,6 +3,7 @@ from unittest import TestCase
 from unittest import mock
 
 import logging
+import os
 import shlex
 from itertools import chain
 
@@ -108,3 +109,71 @@ class TestUtils(TestCase):
         exp = range(1, 18+1)
         result = scuba.utils.flatten_list(sample)
         assert_seq_equal(result, exp)
+
+    def test_parse_duration(self):
+        '''parse_duration handles units'''
+        self.assertEqual(scuba.utils.parse_duration('90'), 90)
+        self.assertEqual(scuba.utils.parse_duration('30m'), 30*60)
+        self.assertEqual(scuba.utils.parse_duration('2d'), 2*24*60*60)
+        self.assertRaises(ValueError, scuba.utils.parse_duration, '1y')
+
+    def test_parse_size(self):
+        '''parse_size handles binary units'''
+        self.assertEqual(scuba.utils.parse_size('4096'), 4096)
+        self.assertEqual(scuba.utils.parse_size('1.5K'), 1536)
+        self.assertEqual(scuba.utils.parse_size('20G'), 20 * 1024**3)
+        self.assertEqual(scuba.utils.parse_size('512MiB'), 512 * 1024**2)
+        self.assertRaises(ValueError, scuba.utils.parse_size, 'big')
+
+    def test_parse_bool_flag(self):
+        '''parse_bool_flag handles a flag with or without a value'''
+        self.assertEqual(scuba.utils.parse_bool_flag('--read-only', '--read-only'), True)
+        self.assertEqual(scuba.utils.parse_bool_flag('--read-only=true', '--read-only'), True)
+        self.assertEqual(scuba.utils.parse_bool_flag('--read-only=0', '--read-only'), False)
+        self.assertIsNone(scuba.utils.parse_bool_flag('--read-onlyx', '--read-only'))
+        self.assertIsNone(scuba.utils.parse_bool_flag('--rm', '--read-only'))
+        self.assertRaises(ValueError, scuba.utils.parse_bool_flag, '--read-only=yes', '--read-only')
+
+    def test_format_size(self):
+        '''format_size picks a suitable unit'''
+        self.assertEqual(scuba.utils.format_size(100), '100 B')
+        self.assertEqual(scuba.utils.format_size(1536), '1.5 KiB')
+        self.assertEqual(scuba.utils.format_size(3 * 1024**4), '3.0 TiB')
+
+
+class TestScubadirs(TmpDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = mock.patch('tempfile.tempdir', self.path)
+        self.tempdir.start()
+
+    def tearDown(self):
+        self.tempdir.stop()
+        super().tearDown()
+
+    def _dead_pid(self):
+        import subprocess
+        p = subprocess.Popen(['true'])
+        p.wait()
+        return p.pid
+
+    def test_make_scubadir(self):
+        '''Scubadirs are named by the PID of their process'''
+        path = scuba.utils.make_scubadir()
+        assert_equal(os.path.dirname(path), self.path)
+        assert_true(os.path.basename(path).startswith('scubadir-{}-'.format(os.getpid())))
+
+    def test_sweep(self):
+        '''Only the scubadirs of processes which no longer exist are removed'''
+        mine = scuba.utils.make_scubadir()
+        stale = os.path.join(self.path, 'scubadir-{}-abc'.format(self._dead_pid()))
+        os.mkdir(stale)
+        with open(os.path.join(stale, 'command.sh'), 'w') as f:
+            f.write('true\n')
+        other = os.path.join(self.path, 'scubadirxyz')
+        os.mkdir(other)
+
+        assert_equal(scuba.utils.sweep_scubadirs(), 1)
+        assert_true(os.path.exists(mine))
+        assert_false(os.path.exists(stale))
+        assert_true(os.path.exists(other))
@@ -130,10 +130,36 @@ class TmpDirTestCase(unittest.TestCase):
         os.chdir(self.path)
         logging.info('Temp path: ' + self.path)
 
+        # Don't use (or pollute) the user's scuba caches
+        self.cache_dir = None
+        self.runtime_dir = tempfile.mkdtemp('scubaruntime')
+        self.env_patch = mock.patch.dict('os.environ',
+                SCUBA_NO_CACHE='1',
+                SCUBA_RUNTIME_DIR=self.runtime_dir)
+        self.env_patch.start()
+
+        # Nor image metadata inspected by other tests
+        self.inspected_patch = mock.patch.dict('scuba.imagecache._inspected', clear=True)
+        self.inspected_patch.start()
+
 
     def tearDown(self):
+        self.inspected_patch.stop()
+        self.env_patch.stop()
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir)
+            self.cache_dir = None
+        shutil.rmtree(self.runtime_dir)
+        self.runtime_dir = None
+
         # Restore the working dir and cleanup the temp one
         shutil.rmtree(self.path)
         self.path = None
         os.chdir(self.orig_path)
         self.orig_path = None
+
+    def enable_cache(self):
+        '''Enable scuba's caches, using a temporary cache directory'''
+        self.cache_dir = tempfile.mkdtemp('scubacache')
+        del os.environ['SCUBA_NO_CACHE']
+        os.environ['SCUBA_CACHE_DIR'] = self.cache_dir